@@ -0,0 +1,130 @@
+import sys
+sys.path.insert(0, '.')
+import logging
+import argparse
+import os
+import copy
+import time
+
+from global_utils import *
+from generation_utils import CheckpointStore
+from editor_agent_utils import edit_simulated_narrative
+from score_evaluation import evaluate_story_ab
+from score_stat import append_story_ab_result
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    ## Path to generated data (gen_*.json or a .shards directory) whose simulation is finished
+    parser.add_argument('--data-file', type=str, required=True)
+    ## Directory of save benchmark result
+    parser.add_argument('--out-dir', type=str, required=True)
+    ## Base model of the editor agent
+    parser.add_argument('--editor-agent-base-model', type=str, required=True)
+    ## Base model of the evaluator agent for the serial vs parallel Story Quality AB Test (None: wall time only)
+    parser.add_argument('--evaluator-agent-base-model', type=str, default='None')
+    ## Reformatting Format (default = screenplay)
+    parser.add_argument('--reformat-novel', action='store_true')
+    ## Maximum number of examples to benchmark (0: all)
+    parser.add_argument('--max-examples', type=int, default=0)
+    ## LLM response cache / backend (default: env). Use bypass cache so that both modes call the editor.
+    parser.add_argument('--llm-cache-mode', type=str, default='bypass')
+    parser.add_argument('--llm-backend', type=str, default='None')
+    parser.add_argument('--llm-trace-path', type=str, default='None')
+
+    args = parser.parse_args()
+    ## evaluate_story_ab reads the edited version of both stories
+    args.data_file_b = args.data_file
+    args.formats = 'None'
+    args.evaluate_draft = False
+
+    return args
+
+def editor_call_count():
+    return sum(summary['calls'] for key, summary in get_llm_metrics().summary.items() if key.startswith('editor/'))
+
+def benchmark_edit(gen_data, parallel_chunk_edit, logger, args):
+    """ Edit a copy of gen_data in the serial or parallel chunk edit mode.
+    Returns the edited data, wall time and number of editor calls.
+    """
+    edit_args = copy.copy(args)
+    edit_args.parallel_chunk_edit = parallel_chunk_edit
+    edit_args.plan_mode = gen_data['initialization'].get('plan') is not None
+    edit_args.act_seq_mode = False
+
+    edit_data = copy.deepcopy(gen_data)
+    edit_data['edited_narrative'] = {}
+    mode = 'parallel' if parallel_chunk_edit else 'serial'
+    out_dataset = CheckpointStore(file_path=os.path.join(args.out_dir, f'benchmark_chunk_edit_{mode}.json'))
+
+    call_cnt = editor_call_count()
+    start_time = time.monotonic()
+    with llm_call_tags(example_id=gen_data['example_id'], benchmark=mode):
+        edit_simulated_narrative(gen_data=edit_data, out_dataset=out_dataset, logger=logger, args=edit_args)
+    wall_time = time.monotonic() - start_time
+    out_dataset.close()
+
+    return edit_data, wall_time, editor_call_count() - call_cnt
+
+def main():
+
+    #### setup logger ####
+    log_file_path = os.path.join(os.environ['LOG_DIR'], 'benchmark_chunk_edit.log')
+    logger = setup_logger(__name__, log_file_path, level=logging.INFO, verbose=False)
+
+    #### args ####
+    args = parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+    configure_llm_cache(mode=args.llm_cache_mode)
+    configure_llm_backend(
+        backend=args.llm_backend if args.llm_backend != 'None' else None,
+        trace_path=args.llm_trace_path if args.llm_trace_path != 'None' else None)
+    logger.info(f'Data File: {args.data_file}')
+    logger.info(f'Editor agent base model: {args.editor_agent_base_model}')
+    logger.info(f'Evaluator agent base model: {args.evaluator_agent_base_model}')
+
+    #### benchmark ####
+    benchmark_list = []
+    for gen_data in load_dataset(args.data_file):
+        if args.max_examples and len(benchmark_list) >= args.max_examples:
+            break
+        if gen_data.get('generation_state') != 'finished':
+            continue
+        if gen_data['initialization'].get('plan', {}).get('part_1_act_seq') is not None:
+            logger.info(f"({gen_data['example_id']}) Act seq mode edits acts, not chunks. Skipping...")
+            continue
+
+        serial_data, serial_time, serial_calls = benchmark_edit(gen_data, False, logger, args)
+        parallel_data, parallel_time, parallel_calls = benchmark_edit(gen_data, True, logger, args)
+
+        benchmark = {
+            'example_id': gen_data['example_id'],
+            'serial': {'wall_time': serial_time, 'editor_calls': serial_calls},
+            'parallel': {'wall_time': parallel_time, 'editor_calls': parallel_calls},
+            'speedup': serial_time / parallel_time if parallel_time > 0 else None,
+        }
+
+        ## Story Quality AB Test. A: serial, B: parallel
+        if args.evaluator_agent_base_model != 'None':
+            story_ab = evaluate_story_ab(serial_data, parallel_data, logger, args)
+            benchmark['story_quality_ab'] = append_story_ab_result(story_ab['llm_response_ab'], story_ab['llm_response_ba'], logger)
+
+        logger.info(f"({gen_data['example_id']}) serial {serial_time:.1f}s ({serial_calls} calls), parallel {parallel_time:.1f}s ({parallel_calls} calls), speedup x{benchmark['speedup'] or 0:.2f}")
+        benchmark_list.append(benchmark)
+
+    #### summary ####
+    summary = {'example_n': len(benchmark_list)}
+    if benchmark_list:
+        summary['serial_wall_time'] = sum(benchmark['serial']['wall_time'] for benchmark in benchmark_list)
+        summary['parallel_wall_time'] = sum(benchmark['parallel']['wall_time'] for benchmark in benchmark_list)
+        summary['speedup'] = summary['serial_wall_time'] / summary['parallel_wall_time'] if summary['parallel_wall_time'] > 0 else None
+        if args.evaluator_agent_base_model != 'None':
+            overall_results = [benchmark['story_quality_ab']['overall'] for benchmark in benchmark_list]
+            summary['story_quality_ab_overall'] = {result: overall_results.count(result) for result in ['A', 'B', 'DRAW']}
+    logger.info(f'Summary: {summary}')
+
+    save_path = os.path.join(args.out_dir, 'benchmark_chunk_edit.json')
+    save_json({'summary': summary, 'examples': benchmark_list}, save_path)
+    logger.info(f'Saved {save_path}')
+
+if __name__ == "__main__":
+    main()
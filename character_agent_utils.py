@@ -164,6 +164,19 @@ def update_character_utility(setup, target_character_agent, args, story_progress
     story_progress_list : list
             story progress list
     """
+    return run_coroutine_sync(update_character_utility_async(setup, target_character_agent, args, story_progress_list))
+
+async def update_character_utility_async(setup, target_character_agent, args, story_progress_list=[]):
+    """ Async twin of update_character_utility, to update several characters concurrently.
+    Parameters
+    ----------
+    setup : str
+            Setup text
+    target_character_agent : json
+            target character agent
+    story_progress_list : list
+            story progress list
+    """
     
     name = target_character_agent['name']
     profile = target_character_agent['profile']
@@ -178,9 +191,8 @@ def update_character_utility(setup, target_character_agent, args, story_progress
         ## Start of the narrative. Provide Inisital Setup without others' utility fucntions.
         story_progress_tom = remove_utility_information(setup)
     else:
-        from generation_utils import preprocess_story_progress_list
-        story_progress_text = preprocess_story_progress_list(story_progress_list)
-        story_progress_tom = hide_thought_of_others(story_progress=story_progress_text, character=name)
+        from generation_utils import preprocess_story_progress_list_tom
+        story_progress_tom = preprocess_story_progress_list_tom(story_progress_list, character=name)
     
     character_agent_system_prompt = CHARACTER_AGENT_SYSTEM_PROMPT.format(name=name)
     update_character_utility_prompt = UPDATE_CHARACTER_UTILITY_PROMPT.format(
@@ -193,7 +205,7 @@ def update_character_utility(setup, target_character_agent, args, story_progress
     retry_n = 0
     updated_character_utility = None
     while retry_n < MAX_RETRY:
-        updated_character_utility_response = run_llm(user_prompt=update_character_utility_prompt, system_prompt=character_agent_system_prompt, model=args.character_agent_base_model, temperature=1-(0.1*retry_n))
+        updated_character_utility_response = await run_llm_async(user_prompt=update_character_utility_prompt, system_prompt=character_agent_system_prompt, model=args.character_agent_base_model, temperature=1-(0.1*retry_n), tags={'agent': 'character', 'phase': 'utility_update'})
         updated_character_utility_response = validate_updated_character_utility(updated_character_utility_response, name)
         
         logger.debug(f"===Update Character Utility: {retry_n+1}'s try===\n{updated_character_utility_response}")
@@ -239,10 +251,41 @@ def update_setup_character_utility(setup, character_agent_list):
     logger.debug(f"===After Setup Update (Character Utility)===\n{updated_setup}")
     return updated_setup
 
-### Preprocess ###
-def preprocess_character_reaction(character_reaction):
-    """ Preprocess character_reaction to record it to Story Progress.
-    Preprocess Format - {character_name} (at {character_location}): {character_reaction}
+### Turn events ###
+TURN_EVENT_KINDS = ['beginning', 'description', 'intervention', 'reaction', 'end']
+
+def build_turn_event(kind, utterance, speaker=None, location=None):
+    """ Structured record of a turn. Story Progress text is derived from it by format_turn_event.
+    Parameters
+    ----------
+    kind : str
+            one of TURN_EVENT_KINDS
+    utterance : str
+            text of the turn. For reaction, the reaction without the speaker prefix.
+    speaker, location : str
+            reacting character and location (reaction only)
+    """
+    if kind not in TURN_EVENT_KINDS:
+        raise ValueError(f'Unknown turn event kind: {kind}')
+    
+    return {
+        'kind': kind,
+        'speaker': speaker,
+        'location': location,
+        'utterance': utterance,
+        'thoughts': [[match.start(), match.end()] for match in re.finditer(r"\[.*?\]", utterance)]
+    }
+
+def format_turn_event(event):
+    """ Story Progress text of a turn event.
+    Format of reaction - {character_name} (at {character_location}): {character_reaction}
+    """
+    if event['kind'] == 'reaction':
+        return f"{event['speaker']} (at {event['location']}): {event['utterance']}"
+    return event['utterance']
+
+def build_character_reaction_event(character_reaction):
+    """ Build the reaction event of character agent's response.
     Parameters
     character_reaction : dictionary
                         character_reaction['name']: {character_name}
@@ -260,7 +303,19 @@ def preprocess_character_reaction(character_reaction):
     
     reaction = ' '.join(reaction.split('\n')).strip()
     
-    return name_prefix + ' ' + reaction
+    return build_turn_event('reaction', reaction, speaker=character_reaction['name'], location=character_reaction['location'])
+
+### Preprocess ###
+def preprocess_character_reaction(character_reaction):
+    """ Preprocess character_reaction to record it to Story Progress.
+    Preprocess Format - {character_name} (at {character_location}): {character_reaction}
+    Parameters
+    character_reaction : dictionary
+                        character_reaction['name']: {character_name}
+                        character_reaction['location']: {character_location}
+                        character_reaction['reaction']: {character_reaction}
+    """
+    return format_turn_event(build_character_reaction_event(character_reaction))
 
 def hide_thought_of_others(story_progress, character=None):
     """ Hide **thought** information of other characters in character agent's reaction response.
@@ -90,7 +90,48 @@ def extract_description(response):
     else:
         logger.error(f"Unexpected response format while extracting Choice in description response.\n===Response===\n{response}")
         raise Exception("Unexpected response format while extracting Choice in description response. Check director_agent_utils.log")
-    
+
+
+### Stop streamed responses once required information is extracted ###
+class DirectorStreamParser:
+    """ Incremental parser for streamed director agent's response.
+    feed() returns True once every required field can be extracted, so the rest of the response can be cut off.
+    A field is complete when its line is terminated, matching the `Field:\s*([^\n\r]+)` patterns of the extractors above.
+    Parameters
+    ----------
+    required_fields : list
+            field names required before cut-off (e.g. ['Choice', 'Instruction'])
+    pass_field : str
+            (optional) if this field's value contains 'Pass', no other field is required
+    """
+    def __init__(self, required_fields, pass_field=None):
+        self.required_fields = required_fields
+        self.pass_field = pass_field
+        self.text = ''
+        self.fields = {}
+
+    def _complete_field(self, field):
+        if field not in self.fields:
+            match = re.search(field + r":\s*([^\n\r]+)[\n\r]", self.text)
+            if match:
+                self.fields[field] = match.group(1).strip()
+        return field in self.fields
+
+    def feed(self, delta):
+        self.text += delta
+        if self.pass_field and self._complete_field(self.pass_field) and 'Pass' in self.fields[self.pass_field]:
+            return True
+        return all(self._complete_field(field) for field in self.required_fields)
+
+def directing_decision_stream_parser():
+    return DirectorStreamParser(['Choice', 'Instruction'])
+
+def description_stream_parser():
+    return DirectorStreamParser(['Choice', 'Description'], pass_field='Choice')
+
+def intervention_stream_parser():
+    return DirectorStreamParser(['Intervention'])
+
 
 ### Remove unnecessary information from Setup ###
 def remove_utility_information(setup):
@@ -1,3 +1,9 @@
+import copy
+import queue
+import functools
+import asyncio
+import threading
+import contextvars
 import tiktoken
 
 from global_utils import *
@@ -37,12 +43,17 @@ def split_story_by_chunks(story, max_tokens=1024, min_tokens_last_chunk=256):
 
     return chunks
 
-def build_previous_context_editor(edit_data, format_key, logger, args):
+def build_previous_context_editor(edit_data, format_key, logger, args, part=None):
+    """ Previous context of a part: summaries of parts <= part-2 and the edited part-1.
+    part defaults to the last part in edit_data (parts after it may be kept from a previous edit).
+    """
     previous_context_list = []
 
-    current_part = 1
-    while edit_data.get(f'part_{current_part+1}') is not None:
-        current_part += 1
+    current_part = part
+    if current_part is None:
+        current_part = 1
+        while edit_data.get(f'part_{current_part+1}') is not None:
+            current_part += 1
     
     for part in range(current_part-2):
         previous_context_list.append(f'### PART {part+1} summary')
@@ -62,10 +73,20 @@ def build_previous_context_editor(edit_data, format_key, logger, args):
     
     return '\n'.join(previous_context_list).strip()
 
+## Version of the edit prompt templates. Bump it when the templates change so that the stored edits are regenerated
+EDIT_PROMPT_VERSION = 1
+def build_edit_fingerprint(**edit_inputs):
+    """ Fingerprint of the inputs of an edited unit (act, part or the whole story).
+    A stored unit is edited again only when its fingerprint changes.
+    """
+    edit_inputs['prompt_version'] = EDIT_PROMPT_VERSION
+    edit_inputs['temperature'] = EDITOR_AGENT_TEMP
+    return hashlib.sha1(json.dumps(edit_inputs, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+MAX_FUTURE_CONTEXT_TURN = 10
 def build_future_context_editor(gen_data, logger, args, part=0, act=0):
     future_context_list = []
     
-    MAX_FUTURE_CONTEXT_TURN = 10
     if args.plan_mode and args.act_seq_mode:
         part_storytelling = part
         act_storytelling = act + 1
@@ -100,15 +121,17 @@ def build_future_context_editor(gen_data, logger, args, part=0, act=0):
     else:
         return '\n'.join(future_context_list)
 
-def build_story_progress_for_part_summary_editor(edit_data, format_key):
+def build_story_progress_for_part_summary_editor(edit_data, format_key, part=None):
     story_progress_list = []
     
-    summary_part = 1
-    while edit_data.get(f'part_{summary_part+1}') is not None:
-        summary_part += 1
+    summary_part = part
+    if summary_part is None:
+        summary_part = 1
+        while edit_data.get(f'part_{summary_part+1}') is not None:
+            summary_part += 1
         
     part_storytelling = 1
-    while edit_data.get(f'part_{part_storytelling}') is not None:
+    while edit_data.get(f'part_{part_storytelling}') is not None and part_storytelling <= summary_part:
         if part_storytelling <= (summary_part-2):
             story_progress_list.append(f'### PART {part_storytelling} summary')
             story_progress_list.append(edit_data[f'part_{part_storytelling}']['part_summary'])
@@ -140,24 +163,299 @@ def preprocess_edited_narrative(edited_narrative):
     
     return preprocessed_narrative.strip()
 
-def edit_simulated_narrative(gen_data, out_dataset, logger, args):
-    """ Edit the simulated narrative in the form of screenplay
+## Maximum number of segments (acts or chunks) edited concurrently
+EDIT_CONCURRENCY = 8
+## Number of lines on each side of a chunk boundary given to the seam smoothing pass
+SEAM_CONTEXT_LINES = 8
+async def edit_segment_async(edit_narrative_prompt, log_prefix, logger, args, tags=None):
+    """ Edit one segment (act or chunk): the narrative pass, then the inner thoughts pass right behind it.
+    Parameters
+    ----------
+    tags : dict
+            (optional) telemetry tags of the segment (e.g. {'act': 1})
     """
+    edited_narrative_response = await run_llm_async(user_prompt=edit_narrative_prompt, system_prompt=EDITOR_AGENT_SYSTEM_PROMPT, model=args.editor_agent_base_model, temperature=EDITOR_AGENT_TEMP, tags={'agent': 'editor', 'phase': 'edit', **(tags or {})})
+    edited_narrative = preprocess_edited_narrative(edited_narrative_response)
     
-    logger.info(f"({gen_data['example_id']}) Editing the simulated narrative...")
+    logger.debug(f"==={log_prefix}===\n{edited_narrative}")
     
-    if args.reformat_novel:
-        format_key = 'story_progress_novel'
-    else:
-        format_key = 'story_progress_screenplay'
+    edit_inner_thoughts_prompt = build_edit_inner_thoughts(edited_narrative)
+    edited_inner_thoughts_response = await run_llm_async(user_prompt=edit_inner_thoughts_prompt, system_prompt=EDITOR_AGENT_SYSTEM_PROMPT, model=args.editor_agent_base_model, temperature=EDITOR_AGENT_TEMP, tags={'agent': 'editor', 'phase': 'inner_thoughts_edit', **(tags or {})})
+    edited_narrative = preprocess_edited_narrative(edited_inner_thoughts_response)
+    
+    logger.debug(f"==={log_prefix} (inner thoughts edit)===\n{edited_narrative}")
+    
+    return edited_narrative
+
+async def edit_segments_async(edit_jobs, logger, args):
+    """ Edit segments concurrently. Returns the edited narratives in the order of edit_jobs.
+    Parameters
+    ----------
+    edit_jobs : list
+            (log prefix, edit narrative prompt, telemetry tags) of the segments to edit
+    """
+    semaphore = asyncio.Semaphore(EDIT_CONCURRENCY)
+    
+    async def edit_segment(log_prefix, edit_narrative_prompt, tags):
+        async with semaphore:
+            return await edit_segment_async(edit_narrative_prompt, log_prefix, logger, args, tags=tags)
+    
+    return await asyncio.gather(*[edit_segment(*edit_job) for edit_job in edit_jobs])
 
-    ## Regenerate Edit Phase
-    gen_data['edited_narrative'] = {}
+async def smooth_seams_async(edited_chunks, log_prefix, logger, args):
+    """ Seam smoothing pass over chunks edited concurrently (--parallel-chunk-edit).
+    The opening lines of every chunk after the first are rewritten to continue from the closing lines of the previous chunk.
+    Only the first half of a chunk can be rewritten, so the seams are independent and smoothed concurrently.
+    """
+    semaphore = asyncio.Semaphore(EDIT_CONCURRENCY)
+    
+    async def smooth_seam(i):
+        chunk_lines = edited_chunks[i].splitlines()
+        opening_line_n = min(SEAM_CONTEXT_LINES, len(chunk_lines) // 2)
+        if opening_line_n == 0:
+            return edited_chunks[i]
+        
+        previous_passage = '\n'.join(edited_chunks[i-1].splitlines()[-SEAM_CONTEXT_LINES:])
+        opening_passage = '\n'.join(chunk_lines[:opening_line_n])
+        smooth_seam_prompt = build_smooth_seam(previous_passage=previous_passage, opening_passage=opening_passage)
+        async with semaphore:
+            smoothed_opening_response = await run_llm_async(user_prompt=smooth_seam_prompt, system_prompt=EDITOR_AGENT_SYSTEM_PROMPT, model=args.editor_agent_base_model, temperature=EDITOR_AGENT_TEMP, tags={'agent': 'editor', 'phase': 'seam_smoothing', 'chunk': i+1})
+        smoothed_opening = preprocess_edited_narrative(smoothed_opening_response)
+        if smoothed_opening == '':
+            return edited_chunks[i]
+        
+        logger.debug(f"==={log_prefix} Smoothed opening ({i+1}'s chunk)===\n{smoothed_opening}")
+        return '\n'.join([smoothed_opening] + chunk_lines[opening_line_n:])
+    
+    return edited_chunks[:1] + list(await asyncio.gather(*[smooth_seam(i) for i in range(1, len(edited_chunks))]))
+
+async def edit_chunks_parallel_async(edit_jobs, log_prefix, logger, args):
+    edited_chunks = await edit_segments_async(edit_jobs, logger, args)
+    return await smooth_seams_async(edited_chunks, log_prefix, logger, args)
+
+async def edit_chunks_async(story_chunks, previous_context, build_prompt, log_prefix, logger, args):
+    """ Edit the chunks of a part (plan mode) or the story in order, each with the previous edited chunk as the previous context.
+    With --parallel-chunk-edit, the chunks are edited concurrently with the raw previous chunk as the previous context, then the seams are smoothed.
+    Returns the edited chunks.
+    Parameters
+    ----------
+    previous_context : str
+            previous context of the first chunk
+    build_prompt : function
+            (previous_context, chunk) -> edit narrative prompt
+    """
+    if args.parallel_chunk_edit:
+        chunk_edit_jobs = []
+        for i, chunk in enumerate(story_chunks):
+            chunk_previous_context = story_chunks[i-1] if i > 0 else previous_context
+            chunk_edit_jobs.append((f"{log_prefix} ({i+1}'s chunk)", build_prompt(chunk_previous_context, chunk), {'chunk': i+1}))
+        return await edit_chunks_parallel_async(chunk_edit_jobs, log_prefix, logger, args)
+    
+    edited_chunks = []
+    for i, chunk in enumerate(story_chunks):
+        ## Previous chunk exists -> Use the previous chunk as the previous context. Otherwise, use the default previous context
+        chunk_previous_context = edited_chunks[i-1] if i > 0 else previous_context
+        edited_chunks.append(await edit_segment_async(build_prompt(chunk_previous_context, chunk), f"{log_prefix} ({i+1}'s chunk)", logger, args, tags={'chunk': i+1}))
+    return edited_chunks
+
+async def gather_async(coroutines):
+    return await asyncio.gather(*coroutines)
+
+def count_future_turns(gen_data, part):
+    """ Number of simulated turns after the part (turns ending a part or an act are not counted, as in build_future_context_editor).
+    """
+    future_turn_n = 0
+    part_storytelling = part + 1
+    while gen_data['narrative'].get(f'part_{part_storytelling}') is not None:
+        part_narrative = gen_data['narrative'][f'part_{part_storytelling}']
+        turn_parents = [part_narrative]
+        act_storytelling = 1
+        while part_narrative.get(f'act_{act_storytelling}') is not None:
+            turn_parents.append(part_narrative[f'act_{act_storytelling}'])
+            act_storytelling += 1
+        for turn_parent in turn_parents:
+            turn_storytelling = 1
+            while turn_parent.get(f'turn_{turn_storytelling}', {}).get('story_progress') is not None:
+                if 'ENDS' not in turn_parent[f'turn_{turn_storytelling}']['story_progress']:
+                    future_turn_n += 1
+                turn_storytelling += 1
+        part_storytelling += 1
+    return future_turn_n
+
+def last_editable_part(gen_data, is_simulation_finished):
+    """ Last part whose edit inputs are final: the part is simulated and its future context (MAX_FUTURE_CONTEXT_TURN turns) exists.
+    """
+    part_n = 0
+    while gen_data['narrative'].get(f'part_{part_n+1}', {}).get('turn_-1', {}).get('setup') is not None:
+        part_n += 1
+    if is_simulation_finished:
+        return part_n
+    
+    while part_n > 0 and count_future_turns(gen_data, part_n) < MAX_FUTURE_CONTEXT_TURN:
+        part_n -= 1
+    return part_n
+
+class StreamingEditor:
+    """ Edit phase overlapped with the simulation (--streaming-edit, plan mode).
+    The simulation submits snapshots of its data. A background thread edits every part as soon as it is simulated
+    and its future context exists, so the edit of a part runs while later parts are simulated.
+    The editor owns its edited narrative. merge() copies it to the simulated data on the simulation's thread.
+    Parameters
+    ----------
+    example_id : str
+            example id
+    edited_narrative : dict
+            (optional) edited narrative of a previous run. Its units are kept while their inputs are unchanged
+    """
+    def __init__(self, example_id, logger, args, edited_narrative=None):
+        self.logger = logger
+        self.args = args
+        self.edit_data = {'example_id': example_id, 'edited_narrative': copy.deepcopy(edited_narrative or {})}
+        self.edited_part_n = 0
+        self.is_finished = False
+        self._edited_narrative = None
+        self._lock = threading.Lock()
+        self._error = None
+        self._queue = queue.Queue()
+        self._initialization = None
+        self._narrative = {}
+        self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._edit_loop,), name=f'streaming-editor-{example_id}', daemon=True)
+        self._thread.start()
+    
+    def submit(self, gen_data, is_simulation_finished=False):
+        if self._error is not None:
+            raise self._error
+        ## The initialization and the simulated parts (with their updated setup) no longer change: copy them once, and the part in progress on every submit
+        if self._initialization is None:
+            self._initialization = copy.deepcopy(gen_data['initialization'])
+        narrative = dict(self._narrative)
+        for part_key, part_narrative in gen_data['narrative'].items():
+            if part_key in self._narrative and self._narrative[part_key].get('turn_-1', {}).get('setup') is not None:
+                continue
+            narrative[part_key] = copy.deepcopy(part_narrative)
+        self._narrative = narrative
+        self._queue.put(({'initialization': self._initialization, 'narrative': narrative}, is_simulation_finished))
+    
+    def save(self, edit_data):
+        ## Called by save_wip_data inside edit_simulated_narrative (out_dataset=self)
+        with self._lock:
+            self._edited_narrative = copy.deepcopy(edit_data['edited_narrative'])
+    
+    def merge(self, gen_data):
+        """ Copy the parts edited so far to gen_data['edited_narrative']. Returns True if anything changed.
+        """
+        with self._lock:
+            edited_narrative, self._edited_narrative = self._edited_narrative, None
+        if edited_narrative is None:
+            return False
+        gen_data['edited_narrative'] = edited_narrative
+        return True
+    
+    def _edit_loop(self):
+        while True:
+            item = self._queue.get()
+            ## Only the latest snapshot matters
+            while item is not None and not self._queue.empty():
+                item = self._queue.get()
+            if item is None:
+                return
+            snapshot, is_simulation_finished = item
+            
+            try:
+                self.edit_data.update(snapshot)
+                editable_part_n = last_editable_part(self.edit_data, is_simulation_finished)
+                if editable_part_n > self.edited_part_n or is_simulation_finished:
+                    edit_simulated_narrative(gen_data=self.edit_data, out_dataset=self, logger=self.logger, args=self.args, until_part=editable_part_n)
+                    self.edited_part_n = editable_part_n
+            except Exception as e:
+                self.logger.exception(f"({self.edit_data['example_id']}) Streaming edit failed")
+                self._error = e
+                return
+            
+            if is_simulation_finished:
+                self.is_finished = True
+                return
+    
+    def close(self):
+        """ Stop the editor without finishing the edit (e.g. the simulation failed).
+        """
+        self._queue.put(None)
+    
+    def finish(self, gen_data):
+        """ Submit the finished simulation, wait for the remaining edits and merge them into gen_data.
+        """
+        self.submit(gen_data, is_simulation_finished=True)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        self.merge(gen_data)
+
+def is_edited_unit(edited_unit, format_key, edit_fingerprint):
+    """ Whether the unit (act, part or the whole story) is already edited in the format with the same inputs.
+    """
+    return edited_unit.get('edit_fingerprint', {}).get(format_key) == edit_fingerprint and edited_unit.get(format_key) is not None
+
+def reset_edited_unit(edited_unit, format_key, edit_fingerprint):
+    """ Drop the stale edit of the unit in the format (other formats are kept) and record the fingerprint of its new inputs.
+    """
+    edited_unit.pop(format_key, None)
+    edited_unit.setdefault('edit_fingerprint', {})[format_key] = edit_fingerprint
+
+def submit_part_summary(gen_data, part, format_key, part_summaries, args):
+    """ Summarize the edited part (in format_key) in the background, unless it is already summarized with the same inputs.
+    """
+    character_agent_list = gen_data['narrative'][f'part_{part}']['turn_-1']['character_agent_list']
+    setup = gen_data['narrative'][f'part_{part}']['turn_-1']['setup']
+    cleaned_setup = remove_initial_state_information(setup)
+    cleaned_setup = remove_utility_information(cleaned_setup)
+    cleaned_setup = preprocess_setup(cleaned_setup)
+    cleaned_setup = add_summarized_profiles(cleaned_setup, character_agent_list)
+    
+    story_progress = build_story_progress_for_part_summary_editor(gen_data['edited_narrative'], format_key, part=part)
+    part_summary_prompt = PART_SUMMARY_PROMPT.format(
+        part_n=part,
+        setup=cleaned_setup,
+        story_progress=story_progress
+    )
+    
+    ## Pass if already summarized with the same inputs. Otherwise generated in the background, resolved when the edit of a later part needs it
+    summary_fingerprint = build_edit_fingerprint(part_summary_prompt=part_summary_prompt, model=args.editor_agent_base_model)
+    edited_part = gen_data['edited_narrative'][f'part_{part}']
+    if edited_part.get('part_summary_fingerprint') != summary_fingerprint or edited_part.get('part_summary') is None:
+        part_summaries.submit(
+            part,
+            edited_part,
+            submit_llm(user_prompt=part_summary_prompt, model=args.editor_agent_base_model, tags={'agent': 'editor', 'phase': 'part_summary'}),
+            log_prefix=f"({gen_data['example_id']})",
+            fingerprint=summary_fingerprint)
+
+def edit_simulated_narrative(gen_data, out_dataset, logger, args, until_part=None):
+    """ Edit the simulated narrative in the form of screenplay and/or novel (--formats)
+    Parameters
+    ----------
+    until_part : int
+            (optional, plan mode) edit only the parts <= until_part (streaming edit)
+    
+    Every format is edited concurrently from the same simulated narrative. The story segments, future context and plan
+    are built once per unit, and one part summary (of the first format) is shared by the previous context of every format.
+    Each edited unit (act, part or the whole story) and part summary stores the fingerprint of its inputs per format
+    and is edited again only when the fingerprint changes, so a re-run re-edits only the changed portions.
+    """
+    
+    if until_part is None:
+        logger.info(f"({gen_data['example_id']}) Editing the simulated narrative...")
+    else:
+        logger.debug(f"===({gen_data['example_id']}) Editing the simulated narrative until PART {until_part}===")
+    
+    format_keys = parse_edit_formats(args)
+    ## The part summary feeding the previous context of every format
+    summary_format_key = format_keys[0]
 
     if gen_data.get('edited_narrative') is None:
         gen_data['edited_narrative'] = {}
     
     example_id = gen_data['example_id']
+    part_summaries = DeferredPartSummaries()
     
     if args.plan_mode and args.act_seq_mode:
         
@@ -168,24 +466,27 @@ def edit_simulated_narrative(gen_data, out_dataset, logger, args):
             last_part += 1
         
         part_storytelling = 1
-        while gen_data.get('narrative', {}).get(f'part_{part_storytelling}') is not None:
-            ## Pass if already edited part
-            if gen_data['edited_narrative'].get(f'part_{part_storytelling}', {}).get('part_summary') is not None:
-                part_storytelling += 1
-                continue
+        while gen_data.get('narrative', {}).get(f'part_{part_storytelling}') is not None and (until_part is None or part_storytelling <= until_part):
+            ## Previous context and the part summary read the summaries of parts <= part-2
+            part_summaries.resolve(logger, wait_until_part=part_storytelling-2)
             
             ## Edit
+            set_llm_call_tags(part=part_storytelling, act=None)
             if gen_data['edited_narrative'].get(f'part_{part_storytelling}') is None:
                 gen_data['edited_narrative'][f'part_{part_storytelling}'] = {}
             act_sequence = [list(act.values())[0] for act in plan[f'part_{part_storytelling}_act_seq']]
             
+            ## Previous context of the acts (except the start of the story) in each format
+            previous_contexts = {}
+            for format_key in format_keys:
+                previous_contexts[format_key] = build_previous_context_editor(gen_data['edited_narrative'], format_key, logger, args, part=part_storytelling)
+            
+            ## Acts of a part do not read each other's edits (previous context is built from the previous parts),
+            ## so every act of the part is edited concurrently in every format and the results are written in order.
+            act_edit_jobs = []
+            act_edit_targets = []
             act_storytelling = 1
             while gen_data.get('narrative', {}).get(f'part_{part_storytelling}').get(f'act_{act_storytelling}') is not None:
-                if gen_data['edited_narrative'].get(f'part_{part_storytelling}', {}).get(f'act_{act_storytelling}', {}).get('story_progress') is not None:
-                    act_storytelling += 1
-                    continue
-                
-                gen_data['edited_narrative'][f'part_{part_storytelling}'][f'act_{act_storytelling}'] = {}
                 is_last_act = ((act_storytelling >= len(act_sequence)))
                 
                 act_story_list = []
@@ -197,70 +498,76 @@ def edit_simulated_narrative(gen_data, out_dataset, logger, args):
                 act_story = '\n'.join(act_story_list)
                 
                 if len(act_story_list) <= 1:
-                    gen_data['edited_narrative'][f'part_{part_storytelling}'][f'act_{act_storytelling}']['story_progress'] = ''
-                    gen_data['edited_narrative'][f'part_{part_storytelling}'][f'act_{act_storytelling}']['story_progress_before_feedback'] = ''
+                    gen_data['edited_narrative'][f'part_{part_storytelling}'][f'act_{act_storytelling}'] = {'story_progress': '', 'story_progress_before_feedback': ''}
                     act_storytelling += 1
                     continue
                 
-                if part_storytelling == 1 and act_storytelling == 1:
-                    previous_context = "The simulated narrative is the start of the story."
-                else:
-                    previous_context = build_previous_context_editor(gen_data['edited_narrative'], format_key, logger, args)
-                    
                 future_context = build_future_context_editor(gen_data, logger, args, part=part_storytelling, act=act_storytelling)
+                plan_segment = list(plan[f'part_{part_storytelling}_act_seq'][act_storytelling-1].values())[0]
+                edited_act = gen_data['edited_narrative'][f'part_{part_storytelling}'].setdefault(f'act_{act_storytelling}', {})
                 
-                edit_narrative_prompt = build_edit_narrative(
-                    previous_context=previous_context,
-                    story_segment=act_story,
-                    plan_segment=list(plan[f'part_{part_storytelling}_act_seq'][act_storytelling-1].values())[0],
-                    plan_mode=True,
-                    act_seq_mode=True,
-                    is_last_part=(part_storytelling >= last_part),
-                    is_last_act=is_last_act,
-                    format_key=format_key
-                )
-                edited_narrative_response = run_llm(user_prompt=edit_narrative_prompt, system_prompt=EDITOR_AGENT_SYSTEM_PROMPT, model=args.editor_agent_base_model, temperature=EDITOR_AGENT_TEMP)
-                edited_narrative = preprocess_edited_narrative(edited_narrative_response)
-                
-                logger.debug(f"===({example_id}) Edited PART {part_storytelling} Act {act_storytelling}===\n{edited_narrative}")
-                
-                edit_inner_thoughts_prompt = build_edit_inner_thoughts(edited_narrative)
-                edited_inner_thoughts_response = run_llm(user_prompt=edit_inner_thoughts_prompt, system_prompt=EDITOR_AGENT_SYSTEM_PROMPT, model=args.editor_agent_base_model, temperature=EDITOR_AGENT_TEMP)
-                edited_narrative = preprocess_edited_narrative(edited_inner_thoughts_response)
-                
-                logger.debug(f"===({example_id}) Edited PART {part_storytelling} Act {act_storytelling} (inner thoughts edit)===\n{edited_narrative}")
-                
-                gen_data['edited_narrative'][f'part_{part_storytelling}'][f'act_{act_storytelling}'][format_key] = edited_narrative
-                
-                save_wip_data(wip_data=gen_data, out_dataset=out_dataset, logger=logger, args=args)
+                for format_key in format_keys:
+                    if part_storytelling == 1 and act_storytelling == 1:
+                        previous_context = "The simulated narrative is the start of the story."
+                    else:
+                        previous_context = previous_contexts[format_key]
+                    
+                    ## Pass if already edited with the same inputs
+                    edit_fingerprint = build_edit_fingerprint(
+                        story_segment=act_story,
+                        previous_context=previous_context,
+                        future_context=future_context,
+                        plan_segment=plan_segment,
+                        is_last_part=(part_storytelling >= last_part),
+                        is_last_act=is_last_act,
+                        model=args.editor_agent_base_model,
+                        format_key=format_key
+                    )
+                    if is_edited_unit(edited_act, format_key, edit_fingerprint):
+                        continue
+                    reset_edited_unit(edited_act, format_key, edit_fingerprint)
+                    
+                    edit_narrative_prompt = build_edit_narrative(
+                        previous_context=previous_context,
+                        story_segment=act_story,
+                        plan_segment=plan_segment,
+                        plan_mode=True,
+                        act_seq_mode=True,
+                        is_last_part=(part_storytelling >= last_part),
+                        is_last_act=is_last_act,
+                        format_key=format_key
+                    )
+                    act_edit_jobs.append((f'({example_id}) Edited PART {part_storytelling} Act {act_storytelling} ({format_key})', edit_narrative_prompt, {'act': act_storytelling}))
+                    act_edit_targets.append((edited_act, format_key))
                 
                 act_storytelling += 1
-                
-            ## Summary
-            character_agent_list = gen_data['narrative'][f'part_{part_storytelling}']['turn_-1']['character_agent_list']
-            setup = gen_data['narrative'][f'part_{part_storytelling}']['turn_-1']['setup']
-            cleaned_setup = remove_initial_state_information(setup)
-            cleaned_setup = remove_utility_information(cleaned_setup)
-            cleaned_setup = preprocess_setup(cleaned_setup)
-            cleaned_setup = add_summarized_profiles(cleaned_setup, character_agent_list)
-            
-            story_progress = build_story_progress_for_part_summary_editor(gen_data['edited_narrative'], format_key)
-            part_summary_prompt = PART_SUMMARY_PROMPT.format(
-                part_n=part_storytelling,
-                setup=cleaned_setup,
-                story_progress=story_progress
-            )
             
-            part_summary_response = run_llm(user_prompt=part_summary_prompt, model=args.editor_agent_base_model)
-            part_summary = part_summary_response.strip()
+            ## Drop the acts of a previous edit that are no longer simulated
+            while gen_data['edited_narrative'][f'part_{part_storytelling}'].pop(f'act_{act_storytelling}', None) is not None:
+                act_storytelling += 1
             
-            gen_data['edited_narrative'][f'part_{part_storytelling}']['part_summary'] = part_summary
+            edited_act_narratives = run_coroutine_sync(edit_segments_async(act_edit_jobs, logger, args))
+            for (edited_act, format_key), edited_narrative in zip(act_edit_targets, edited_act_narratives):
+                edited_act[format_key] = edited_narrative
             
-            logger.debug(f"===({example_id}) PART {part_storytelling} Summary===\n{part_summary}")
+            if act_edit_jobs:
+                save_wip_data(wip_data=gen_data, out_dataset=out_dataset, logger=logger, args=args)
+                
+            ## Summary
+            submit_part_summary(gen_data, part_storytelling, summary_format_key, part_summaries, args)
+            part_summaries.resolve(logger, wait_until_part=0)
             
             save_wip_data(wip_data=gen_data, out_dataset=out_dataset, logger=logger, args=args)
             
             part_storytelling += 1
+        
+        ## Drop the parts of a previous edit that are no longer simulated
+        if until_part is None:
+            while gen_data['edited_narrative'].pop(f'part_{part_storytelling}', None) is not None:
+                part_storytelling += 1
+        
+        if part_summaries.resolve(logger):
+            save_wip_data(wip_data=gen_data, out_dataset=out_dataset, logger=logger, args=args)
             
         return gen_data
             
@@ -273,14 +580,15 @@ def edit_simulated_narrative(gen_data, out_dataset, logger, args):
             last_part += 1
         
         part_storytelling = 1
-        while gen_data.get('narrative', {}).get(f'part_{part_storytelling}') is not None:
-            ## Pass if already edited part
-            if gen_data['edited_narrative'].get(f'part_{part_storytelling}', {}).get('part_summary') is not None:
-                part_storytelling += 1
-                continue
+        while gen_data.get('narrative', {}).get(f'part_{part_storytelling}') is not None and (until_part is None or part_storytelling <= until_part):
+            ## Previous context and the part summary read the summaries of parts <= part-2
+            part_summaries.resolve(logger, wait_until_part=part_storytelling-2)
             
             ## Edit
-            gen_data['edited_narrative'][f'part_{part_storytelling}'] = {}
+            set_llm_call_tags(part=part_storytelling)
+            if gen_data['edited_narrative'].get(f'part_{part_storytelling}') is None:
+                gen_data['edited_narrative'][f'part_{part_storytelling}'] = {}
+            edited_part = gen_data['edited_narrative'][f'part_{part_storytelling}']
             part_story_list = []
             part_story_list.append(f'### PART {part_storytelling}')
             turn_storytelling = 1
@@ -291,83 +599,75 @@ def edit_simulated_narrative(gen_data, out_dataset, logger, args):
             part_story = '\n'.join(part_story_list)
             
             if len(part_story_list) < 1:
-                gen_data['edited_narrative'][f'part_{part_storytelling}']['story_progress_before_feedback'] = ''
-                gen_data['edited_narrative'][f'part_{part_storytelling}']['part_summary'] = ''
+                edited_part['story_progress_before_feedback'] = ''
+                edited_part['part_summary'] = ''
                 continue
             
+            future_context = build_future_context_editor(gen_data, logger, args, part=part_storytelling)
+            plan_segment = plan[f'part_{part_storytelling}']
+            
             ## story length exceeds the output token length -> split to chunks
             story_chunks = split_story_by_chunks(part_story)
             
-            edited_chunks = []
-            for i, chunk in enumerate(story_chunks):
-                ## Previous chunk exists -> Use the previous chunk as the previous context
-                if i > 0:
-                    previous_context = edited_chunks[i-1]
-                ## Otherwise, Use default previous context
-                else:
-                    if part_storytelling == 1:
-                        previous_context = "The simulated narrative is the start of the story."
-                    else:
-                        previous_context = build_previous_context_editor(gen_data['edited_narrative'], format_key, logger, args)
-                
-                ## Next chunk exists -> Use the next chunk as the future context
-                if i+1 < len(story_chunks):
-                    future_context = story_chunks[i+1]
-                ## Otherwise, Use default future context
-                else:
-                    future_context = build_future_context_editor(gen_data, logger, args, part=part_storytelling)
-                    
-            
-                edit_narrative_prompt = build_edit_narrative(
+            def build_part_prompt(previous_context, chunk, format_key):
+                return build_edit_narrative(
                     previous_context=previous_context,
                     story_segment=chunk,
-                    plan_segment=plan[f'part_{part_storytelling}'],
+                    plan_segment=plan_segment,
                     plan_mode=True,
                     is_last_part=(part_storytelling >= last_part),
                     format_key=format_key
                 )
             
-                edited_narrative_response = run_llm(user_prompt=edit_narrative_prompt, system_prompt=EDITOR_AGENT_SYSTEM_PROMPT, model=args.editor_agent_base_model, temperature=EDITOR_AGENT_TEMP)
-                edited_narrative = preprocess_edited_narrative(edited_narrative_response)
-                
-                logger.debug(f"===({example_id}) Edited PART {part_storytelling} ({i+1}'s chunk)===\n{edited_narrative}")
-                
-                edit_inner_thoughts_prompt = build_edit_inner_thoughts(edited_narrative)
-                edited_inner_thoughts_response = run_llm(user_prompt=edit_inner_thoughts_prompt, system_prompt=EDITOR_AGENT_SYSTEM_PROMPT, model=args.editor_agent_base_model, temperature=EDITOR_AGENT_TEMP)
-                edited_narrative = preprocess_edited_narrative(edited_inner_thoughts_response)
+            chunk_edits = []
+            for format_key in format_keys:
+                if part_storytelling == 1:
+                    previous_context = "The simulated narrative is the start of the story."
+                else:
+                    previous_context = build_previous_context_editor(gen_data['edited_narrative'], format_key, logger, args, part=part_storytelling)
                 
-                logger.debug(f"===({example_id}) Edited PART {part_storytelling} (inner thoughts edit) ({i+1}'s chunk)===\n{edited_narrative}")
+                ## Pass if already edited with the same inputs
+                edit_fingerprint = build_edit_fingerprint(
+                    story_segment=part_story,
+                    previous_context=previous_context,
+                    future_context=future_context,
+                    plan_segment=plan_segment,
+                    is_last_part=(part_storytelling >= last_part),
+                    parallel_chunk_edit=args.parallel_chunk_edit,
+                    model=args.editor_agent_base_model,
+                    format_key=format_key
+                )
+                if is_edited_unit(edited_part, format_key, edit_fingerprint):
+                    continue
+                reset_edited_unit(edited_part, format_key, edit_fingerprint)
                 
-                edited_chunks.append(edited_narrative)
+                chunk_edits.append((format_key, edit_chunks_async(
+                    story_chunks, previous_context, functools.partial(build_part_prompt, format_key=format_key),
+                    f'({example_id}) Edited PART {part_storytelling} ({format_key})', logger, args)))
             
-            gen_data['edited_narrative'][f'part_{part_storytelling}'][format_key] = "\n\n".join(edited_chunks)
-            gen_data['edited_narrative'][f'part_{part_storytelling}']['chunk_num'] = len(story_chunks)
+            ## Every format is edited concurrently
+            if chunk_edits:
+                edited_chunks_list = run_coroutine_sync(gather_async([chunk_edit for _, chunk_edit in chunk_edits]))
+                for (format_key, _), edited_chunks in zip(chunk_edits, edited_chunks_list):
+                    edited_part[format_key] = "\n\n".join(edited_chunks)
+                edited_part['chunk_num'] = len(story_chunks)
             
             ## Summary
-            character_agent_list = gen_data['narrative'][f'part_{part_storytelling}']['turn_-1']['character_agent_list']
-            setup = gen_data['narrative'][f'part_{part_storytelling}']['turn_-1']['setup']
-            cleaned_setup = remove_initial_state_information(setup)
-            cleaned_setup = remove_utility_information(cleaned_setup)
-            cleaned_setup = preprocess_setup(cleaned_setup)
-            cleaned_setup = add_summarized_profiles(cleaned_setup, character_agent_list)
-            
-            story_progress = build_story_progress_for_part_summary_editor(gen_data['edited_narrative'], format_key)
-            part_summary_prompt = PART_SUMMARY_PROMPT.format(
-                part_n=part_storytelling,
-                setup=cleaned_setup,
-                story_progress=story_progress
-            )
-            part_summary_response = run_llm(user_prompt=part_summary_prompt, model=args.editor_agent_base_model)
-            part_summary = part_summary_response.strip()
-            
-            gen_data['edited_narrative'][f'part_{part_storytelling}']['part_summary'] = part_summary
-            
-            logger.debug(f"===({example_id}) PART {part_storytelling} Summary===\n{part_summary}")
+            submit_part_summary(gen_data, part_storytelling, summary_format_key, part_summaries, args)
+            part_summaries.resolve(logger, wait_until_part=0)
             
             save_wip_data(wip_data=gen_data, out_dataset=out_dataset, logger=logger, args=args)
             
             part_storytelling += 1
         
+        ## Drop the parts of a previous edit that are no longer simulated
+        if until_part is None:
+            while gen_data['edited_narrative'].pop(f'part_{part_storytelling}', None) is not None:
+                part_storytelling += 1
+        
+        if part_summaries.resolve(logger):
+            save_wip_data(wip_data=gen_data, out_dataset=out_dataset, logger=logger, args=args)
+        
         return gen_data
     
     elif args.act_seq_mode:
@@ -375,10 +675,6 @@ def edit_simulated_narrative(gen_data, out_dataset, logger, args):
         raise NotImplementedError
     
     else:
-        ## Pass if already edited
-        if gen_data['edited_narrative'].get(format_key) is not None:
-            return gen_data
-        
         setup = gen_data['initialization']['initial_setup']
         cleaned_setup = remove_initial_state_information(setup=setup)
         cleaned_setup, utility_narrative = remove_and_extract_utility_information(setup=cleaned_setup, character='narrative')
@@ -392,48 +688,48 @@ def edit_simulated_narrative(gen_data, out_dataset, logger, args):
             turn_storytelling += 1
         story = story.strip()
         
+        future_context = build_future_context_editor(gen_data, logger, args)
+        
         ## story length exceeds the output token length -> split to chunks
         story_chunks = split_story_by_chunks(story)
         
-        edited_chunks = []
-        for i, chunk in enumerate(story_chunks):
-            ## Previous chunk exists -> Use the previous chunk as the previous context
-            if i > 0:
-                previous_context = edited_chunks[i-1]
-            ## Otherwise, None
-            else:
-                previous_context = None
-        
-            ## Next chunk exists -> Use the next chunk as the future context
-            if i+1 < len(story_chunks):
-                future_context = story_chunks[i+1]
-            ## Otherwise, no future context
-            else:
-                future_context = build_future_context_editor(gen_data, logger, args)
-
-            edit_narrative_prompt = build_edit_narrative(
+        def build_story_prompt(previous_context, chunk, format_key):
+            return build_edit_narrative(
                 previous_context=previous_context,
                 story_segment=chunk,
                 plan_segment=utility_narrative,
                 format_key=format_key
             )
+        
+        edited_story = gen_data['edited_narrative']
+        chunk_edits = []
+        for format_key in format_keys:
+            ## Pass if already edited with the same inputs
+            edit_fingerprint = build_edit_fingerprint(
+                story_segment=story,
+                future_context=future_context,
+                plan_segment=utility_narrative,
+                parallel_chunk_edit=args.parallel_chunk_edit,
+                model=args.editor_agent_base_model,
+                format_key=format_key
+            )
+            if is_edited_unit(edited_story, format_key, edit_fingerprint):
+                continue
+            reset_edited_unit(edited_story, format_key, edit_fingerprint)
             
-            edited_narrative_response = run_llm(user_prompt=edit_narrative_prompt, system_prompt=EDITOR_AGENT_SYSTEM_PROMPT, model=args.editor_agent_base_model, temperature=EDITOR_AGENT_TEMP)
-            edited_narrative = preprocess_edited_narrative(edited_narrative_response)
-            
-            logger.debug(f"===({example_id}) Edited Narrative ({i+1}'s chunk)===\n{edited_narrative}")
-            
-            edit_inner_thoughts_prompt = build_edit_inner_thoughts(edited_narrative)
-            edited_inner_thoughts_response = run_llm(user_prompt=edit_inner_thoughts_prompt, system_prompt=EDITOR_AGENT_SYSTEM_PROMPT, model=args.editor_agent_base_model, temperature=EDITOR_AGENT_TEMP)
-            edited_narrative = preprocess_edited_narrative(edited_inner_thoughts_response)
-            
-            logger.debug(f"===({example_id}) Edited Narrative (inner thoughts edit) ({i+1}'s chunk)===\n{edited_narrative}")
-            
-            edited_chunks.append(edited_narrative)
+            chunk_edits.append((format_key, edit_chunks_async(
+                story_chunks, None, functools.partial(build_story_prompt, format_key=format_key),
+                f'({example_id}) Edited Narrative ({format_key})', logger, args)))
+        
+        if not chunk_edits:
+            return gen_data
         
-        gen_data['edited_narrative'][format_key] = "\n\n".join(edited_chunks)
-        gen_data['edited_narrative']['chunk_num'] = len(story_chunks)
+        ## Every format is edited concurrently
+        edited_chunks_list = run_coroutine_sync(gather_async([chunk_edit for _, chunk_edit in chunk_edits]))
+        for (format_key, _), edited_chunks in zip(chunk_edits, edited_chunks_list):
+            edited_story[format_key] = "\n\n".join(edited_chunks)
+        edited_story['chunk_num'] = len(story_chunks)
         
         save_wip_data(wip_data=gen_data, out_dataset=out_dataset, logger=logger, args=args)
         
-        return gen_data
\ No newline at end of file
+        return gen_data
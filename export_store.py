@@ -0,0 +1,54 @@
+import sys
+sys.path.insert(0, '.')
+import logging
+import argparse
+import os
+
+from global_utils import *
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    ## Shard directories to export (e.g. ./outputs/generation/gen_d_..._c_....shards). Later directories win for duplicated example_ids.
+    parser.add_argument('--shard-dir', type=str, nargs='+', required=True)
+    ## Path to the monolithic JSON file (default: first shard directory with .shards replaced by .json)
+    parser.add_argument('--out-file', type=str, default='None')
+    
+    args = parser.parse_args()
+    if args.out_file == 'None':
+        shard_dir = args.shard_dir[0].rstrip('/')
+        if shard_dir.endswith('.shards'):
+            shard_dir = shard_dir[:-len('.shards')]
+        args.out_file = shard_dir + '.json'
+    
+    return args
+
+def main():
+    
+    #### setup logger ####
+    log_file_path = os.path.join(os.environ['LOG_DIR'], 'export.log')
+    logger = setup_logger(__name__, log_file_path, level=logging.INFO, verbose=False)
+    
+    #### args ####
+    args = parse_args()
+    logger.info(f'Shard Directories: {args.shard_dir}')
+    logger.info(f'Out File: {args.out_file}')
+    
+    #### export ####
+    if len(args.shard_dir) == 1:
+        store = ShardedStore(args.shard_dir[0])
+        store.export(args.out_file)
+        logger.info(f'Exported {len(store)} examples to {args.out_file}')
+        return
+    
+    ## Merge: keep the first position of each example_id, take the data of the last directory containing it
+    merged = {}
+    for shard_dir in args.shard_dir:
+        store = ShardedStore(shard_dir)
+        for example_id in dataset_example_ids(store):
+            merged[example_id] = store
+    
+    save_json([merged[example_id].find(example_id) for example_id in merged], args.out_file, fsync=True)
+    logger.info(f'Exported {len(merged)} examples from {len(args.shard_dir)} shard directories to {args.out_file}')
+    
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,11 @@ import logging
 import argparse
 import os
 import copy
+import queue
+import asyncio
+import threading
+import contextvars
+import concurrent.futures
 
 from global_utils import *
 from generation_utils import *
@@ -35,17 +40,51 @@ def parse_args():
     parser.add_argument('--no-description', action='store_true')
     ## Reformatting Format (default = screenplay)
     parser.add_argument('--reformat-novel', action='store_true')
+    ## Reformatting Formats edited concurrently from one simulation (e.g. screenplay,novel). Overrides --reformat-novel
+    parser.add_argument('--formats', type=str, default='None')
+    ## Edit each part in the background as soon as it and its future context are simulated (plan mode)
+    parser.add_argument('--streaming-edit', action='store_true')
+    ## Edit the chunks of a part (plan mode) or a story (no-plan mode) concurrently, then smooth the chunk boundaries
+    parser.add_argument('--parallel-chunk-edit', action='store_true')
     ## Maximum number of feedbacks during the Setup construction
     parser.add_argument('--max-setup-feedback', type=int, default=3)
     ## Maximum number of turns allowed
     parser.add_argument('--max-turn', type=int, default=200)
     parser.add_argument('--max-turn-part', type=int, default=200)
     parser.add_argument('--max-turn-act', type=int, default=50)
+    ## Token budget of Story Progress per agent. Older turns are folded into a rolling summary (0: whole Story Progress)
+    parser.add_argument('--context-budget-director', type=int, default=0)
+    parser.add_argument('--context-budget-character', type=int, default=0)
+    ## Output backend: monolithic (one gen_*.json + write-ahead log) / sharded (one file per example + index)
+    parser.add_argument('--output-backend', type=str, default='monolithic', choices=['monolithic', 'sharded'])
+    ## Number of examples generated concurrently (threads sharing the LLM rate limits and the output store)
+    parser.add_argument('--workers', type=int, default=1)
+    ## Stage pipeline (setup -> character -> plan -> simulation -> edit -> output) with a worker pool per stage
+    ## e.g. --stage-workers simulation=8,edit=4 (unspecified stages use DEFAULT_STAGE_WORKERS)
+    parser.add_argument('--pipeline', action='store_true')
+    parser.add_argument('--stage-workers', type=str, default='None')
+    parser.add_argument('--stage-queue-size', type=int, default=2)
+    ## Checkpoint: number of per-turn saves (appended to a write-ahead log) between full snapshots, and background writing
+    parser.add_argument('--checkpoint-compact-every', type=int, default=50)
+    parser.add_argument('--checkpoint-background', action='store_true')
     ## Base models of agents
     parser.add_argument('--planner-agent-base-model', type=str, default='None')
     parser.add_argument('--director-agent-base-model', type=str, default='None')
     parser.add_argument('--editor-agent-base-model', type=str, default='None')
     parser.add_argument('--character-agent-base-model', type=str, default='None')
+    ## Stream Director Agent's decisions and stop generating once the required fields are parsed
+    parser.add_argument('--director-stream-cutoff', action='store_true')
+    ## LLM response cache (readwrite / readonly / bypass; default: LLM_CACHE_MODE env)
+    parser.add_argument('--llm-cache-mode', type=str, default='None')
+    parser.add_argument('--llm-cache-path', type=str, default='None')
+    ## LLM backend (live / record / replay; default: LLM_BACKEND env)
+    parser.add_argument('--llm-backend', type=str, default='None')
+    parser.add_argument('--llm-trace-path', type=str, default='None')
+    parser.add_argument('--llm-replay-order', type=str, default='None')
+    parser.add_argument('--llm-replay-latency', action='store_true')
+    ## LLM telemetry (JSONL per call; Prometheus exporter port, 0: disabled)
+    parser.add_argument('--llm-metrics-path', type=str, default='None')
+    parser.add_argument('--llm-prometheus-port', type=int, default=0)
     
     args = parser.parse_args()
     
@@ -79,12 +118,22 @@ def log_generation_setting(logger, args):
         logger.info(f'Maximum turn per Part: {args.max_turn_part}')
     else:
         logger.info(f'Maximum turn: {args.max_turn}') 
-    if args.reformat_novel:
-        logger.info(f'Narrative Format: Novel')
-    else:
-        logger.info(f'Narrative Format: Screenplay')
+    if args.context_budget_director or args.context_budget_character:
+        logger.info(f'Story Progress token budget: director {args.context_budget_director}, character {args.context_budget_character}')
+    if args.pipeline:
+        logger.info(f'Stage pipeline: {parse_stage_workers(args.stage_workers)} workers, queue size {args.stage_queue_size}')
+    elif args.workers > 1:
+        logger.info(f'Workers: {args.workers} (per-worker logs: generation_worker_*.log)')
+    if args.streaming_edit and args.plan_mode:
+        logger.info(f'Streaming edit: True')
+    elif args.streaming_edit:
+        logger.warning('Streaming edit is available with plan mode only. The story is edited after the simulation.')
+    if args.parallel_chunk_edit:
+        logger.info(f'Parallel chunk edit: True')
+    edit_formats = [format_key[len('story_progress_'):] for format_key in parse_edit_formats(args)]
+    logger.info(f"Narrative Format: {', '.join(edit_formats)}")
 
-def generate_narrative(data, setting_data, out_dataset, logger, args):
+def generate_narrative(data, setting_data, out_dataset, logger, args, streaming_editor=None):
     
     logger.info(f"({data['example_id']}) Simulating narrative... (Refer ./log/generation.log file for the simulation details)")
     
@@ -95,6 +144,8 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
     plan = data['initialization'].get('plan')
 
     data = init_narrative_generation(data, setting_data, args)
+    setup_views = SetupViewCache()
+    part_summaries = DeferredPartSummaries()
 
     # Determine Part Iteration
     part_iterations = [None]  # For no-plan mode, loop once with part=None
@@ -107,16 +158,23 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
 
     # Part-level Loop
     for part in part_iterations:
-        story_progress_list = []
+        story_progress_list = StoryProgressBuffer()
+        story_progress_contexts = build_story_progress_contexts(args)
         part_force_quit = False
         if args.plan_mode:
-            # Check if part is already completed
-            if data.get('narrative', {}).get(f'part_{part}', {}).get('turn_-1', {}).get('part_summary') is not None:
+            # Check if part is already completed (the part end writes the updated setup synchronously, the summary in the background)
+            if data.get('narrative', {}).get(f'part_{part}', {}).get('turn_-1', {}).get('setup') is not None:
                 logger.debug(f'...({example_id}) Part {part}... already ended')
                 character_agent_list = data['narrative'][f'part_{part}']['turn_-1']['character_agent_list']
                 setup = data['narrative'][f'part_{part}']['turn_-1']['setup']
+                ## Interrupted before the part summary was written -> summarize the part again
+                if data['narrative'][f'part_{part}']['turn_-1'].get('part_summary') is None:
+                    part_summaries.resolve(logger, wait_until_part=part-2)
+                    submit_director_part_summary(data, part, setup, build_story_progress_end_of_part(data, part, args), part_summaries, args)
                 continue
 
+            ## The context of this part reads the summaries of parts <= part-2
+            part_summaries.resolve(logger, wait_until_part=part-2)
             story_progress_list = build_context_start_of_new_part(data, part, args)
             
             if data.get('narrative', {}).get(f'part_{part}') is None:
@@ -165,6 +223,7 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
 
             # Turn-level Loop
             while turn <= max_turn:
+                set_llm_call_tags(part=part, act=act, turn=turn)
                 # Check for existing data
                 turn_data_parent = data
                 for key in data_path_keys:
@@ -175,10 +234,10 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
                 if turn_data.get('story_progress') is not None:
                     if end_phrase in turn_data['story_progress']:
                         logger.debug(f'...{log_prefix} ended in Turn {turn}...')
-                        story_progress_list.append(turn_data['story_progress'])
+                        story_progress_list.append_turn(turn_data)
                         break
                     logger.debug(f'...{log_prefix} Trun {turn}... already exist')
-                    story_progress_list.append(turn_data['story_progress'])
+                    story_progress_list.append_turn(turn_data)
                     turn += 1
                     continue
                 
@@ -191,19 +250,15 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
                     turn_parent_dict[f'turn_{turn}'] = {}
                 
                 # Build context
-                cleaned_setup = remove_initial_state_information(setup=setup)
-                cleaned_setup, utility_narrative = remove_and_extract_utility_information(setup=cleaned_setup, character='narrative')
-                cleaned_setup = preprocess_setup(cleaned_setup)
-                cleaned_setup = add_summarized_profiles(cleaned_setup, character_agent_list)
-                story_progress_text = preprocess_story_progress_list(story_progress_list)
+                cleaned_setup = setup_views.get('director', setup, character_agent_list)
+                utility_narrative = setup_views.get('narrative_utility', setup, character_agent_list)
+                story_progress_text = story_progress_contexts['director'].build(story_progress_list)
                 
                 # Build director prompt
                 is_beginning = (turn == 1) and (part is None or (part == 1 and (act is None or act == 1)))
                 
                 if is_beginning:
-                    cleaned_setup_for_beginning = remove_utility_information(setup)
-                    cleaned_setup_for_beginning = preprocess_setup(cleaned_setup_for_beginning)
-                    cleaned_setup_for_beginning = add_summarized_profiles(cleaned_setup_for_beginning, character_agent_list)
+                    cleaned_setup_for_beginning = setup_views.get('beginning', setup, character_agent_list)
                     direct_prompt = build_beginning_prompt(
                         setup=cleaned_setup_for_beginning,
                         story_prompt=data['inputs'],
@@ -224,7 +279,7 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
                         current_act=current_act,
                         is_last_act=(args.act_seq_mode and is_last_act))
                 elif is_character_reaction(story_progress_list) and not is_description_decided and not args.no_description:
-                    story_progress_tom = hide_thought_of_others(story_progress=story_progress_text)
+                    story_progress_tom = story_progress_contexts['director'].build_tom(story_progress_list)
                     direct_prompt = build_description_prompt(
                         setup=cleaned_setup,
                         story_progress=story_progress_tom,
@@ -257,7 +312,18 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
                             act_end_phrase=end_phrase if args.act_seq_mode else None,
                             is_last_act=(args.act_seq_mode and is_last_act))
 
-                direct_response = run_llm(user_prompt=direct_prompt, system_prompt=DIRECTOR_AGENT_SYSTEM_PROMPT, model=args.director_agent_base_model)
+                # Telemetry phase and stream cut-off rule follow the branch that processes direct_response below
+                if is_beginning:
+                    direct_phase, direct_stream_parser_factory = 'turn', None
+                elif turn < max_turn and is_character_reaction(story_progress_list) and not is_description_decided and not args.no_description:
+                    direct_phase, direct_stream_parser_factory = 'description', description_stream_parser
+                elif resolve_wrong_character_choice_mode:
+                    direct_phase, direct_stream_parser_factory = 'intervention', intervention_stream_parser
+                else:
+                    direct_phase, direct_stream_parser_factory = 'turn', directing_decision_stream_parser
+
+                direct_response = run_llm(user_prompt=direct_prompt, system_prompt=DIRECTOR_AGENT_SYSTEM_PROMPT, model=args.director_agent_base_model,
+                                          stream_parser_factory=direct_stream_parser_factory if args.director_stream_cutoff else None, tags={'agent': 'director', 'phase': direct_phase})
                 
                 logger.debug(f'==={log_prefix} Trun {turn} direct===\n{direct_response}')
                 turn_parent_dict[f'turn_{turn}']['direct_response'] = direct_response
@@ -266,8 +332,7 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
                 if is_beginning:
                     beginning_record_story_progress = preprocess_beginning_story(direct_response)
                     logger.debug(f'==={log_prefix} Trun {turn}==={beginning_record_story_progress}')
-                    turn_parent_dict[f'turn_{turn}']['story_progress'] = beginning_record_story_progress
-                    story_progress_list.append(beginning_record_story_progress)
+                    record_turn_event(turn_parent_dict[f'turn_{turn}'], story_progress_list, build_turn_event('beginning', beginning_record_story_progress))
                 elif turn < max_turn and is_character_reaction(story_progress_list) and not is_description_decided and not args.no_description: # Director Agent decided to use Description
                     is_description_decided = True
                     description_choice, description_content = extract_description(direct_response)
@@ -276,27 +341,24 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
                         turn -= 1 # Redo the turn
                     else:
                         logger.debug(f'==={log_prefix} Trun {turn}==={description_content}')
-                        turn_parent_dict[f'turn_{turn}']['story_progress'] = description_content
-                        story_progress_list.append(description_content)
+                        record_turn_event(turn_parent_dict[f'turn_{turn}'], story_progress_list, build_turn_event('description', description_content))
                 elif resolve_wrong_character_choice_mode: # Director Agent chose a character not in the setup. Utilize Intervention to generate temporary NPC response
                     is_description_decided = False
                     intervention_record_story_progress = extract_intervention(direct_response)
                     logger.debug(f'==={log_prefix} Trun {turn}==={intervention_record_story_progress}')
-                    turn_parent_dict[f'turn_{turn}']['story_progress'] = intervention_record_story_progress
-                    story_progress_list.append(intervention_record_story_progress)
+                    record_turn_event(turn_parent_dict[f'turn_{turn}'], story_progress_list, build_turn_event('intervention', intervention_record_story_progress))
                 else:
                     is_description_decided = False
                     directing_instruction, directing_choice = extract_directing_decision(direct_response)
                     
                     if end_phrase in directing_choice or 'end' in directing_choice.lower(): # Director Agent: End
                         logger.debug(f'==={log_prefix} Trun {turn}==={end_phrase}')
-                        story_progress_list.append(end_phrase)
-                        turn_parent_dict[f'turn_{turn}']['story_progress'] = end_phrase
+                        record_turn_event(turn_parent_dict[f'turn_{turn}'], story_progress_list, build_turn_event('end', end_phrase))
                         save_wip_data(wip_data=data, out_dataset=out_dataset, logger=logger, args=args)
                         break
                     elif 'intervention' in directing_choice.lower(): # Director Agent: Intervention
-                        cleaned_setup_for_intervention = remove_utility_information(cleaned_setup)
-                        story_progress_text_for_intervention = preprocess_story_progress_list(story_progress_list)
+                        cleaned_setup_for_intervention = setup_views.get('intervention', setup, character_agent_list)
+                        story_progress_text_for_intervention = story_progress_contexts['director'].build(story_progress_list)
                         intervention_prompt = build_intervention_prompt(
                             setup=cleaned_setup_for_intervention,
                             story_progress=story_progress_text_for_intervention,
@@ -308,11 +370,11 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
                             act_seq_mode=args.act_seq_mode,
                             current_act=current_act)
                         
-                        intervention_response = run_llm(user_prompt=intervention_prompt, system_prompt=DIRECTOR_AGENT_SYSTEM_PROMPT, model=args.director_agent_base_model)
+                        intervention_response = run_llm(user_prompt=intervention_prompt, system_prompt=DIRECTOR_AGENT_SYSTEM_PROMPT, model=args.director_agent_base_model,
+                                                        stream_parser_factory=intervention_stream_parser if args.director_stream_cutoff else None, tags={'agent': 'director', 'phase': 'intervention'})
                         intervention_record_story_progress = extract_intervention(intervention_response)
                         logger.debug(f'==={log_prefix} Trun {turn}==={intervention_record_story_progress}')
-                        turn_parent_dict[f'turn_{turn}']['story_progress'] = intervention_record_story_progress
-                        story_progress_list.append(intervention_record_story_progress)
+                        record_turn_event(turn_parent_dict[f'turn_{turn}'], story_progress_list, build_turn_event('intervention', intervention_record_story_progress))
                     else: # Director Agent: Character Reaction
                         instruction = directing_instruction + ' Interpret this instruction in a way that fits your persona. Then react accordingly.'
                         chosen_character_name, chosen_character_location = extract_chosen_character_information(directing_choice)
@@ -335,9 +397,8 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
                                 wrong_direct_response = direct_response
                                 continue
                         
-                        story_progress_tom = hide_thought_of_others(story_progress=story_progress_text, character=chosen_character_agent['name'])
-                        setup_tom = remove_utility_information(setup=cleaned_setup)
-                        setup_tom = remove_summarized_character_profiles(setup=setup_tom)
+                        story_progress_tom = story_progress_contexts['character'].build_tom(story_progress_list, character=chosen_character_agent['name'])
+                        setup_tom = setup_views.get('character_tom', setup, character_agent_list)
 
                         character_agent_system_prompt = CHARACTER_AGENT_SYSTEM_PROMPT.format(name=chosen_character_agent['name'])
                             
@@ -348,36 +409,35 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
                             story_progress=story_progress_tom,
                             instruction=instruction)
                         
-                        generate_character_reaction_response = run_llm(user_prompt=generate_character_reaction_prompt, system_prompt=character_agent_system_prompt, model=args.character_agent_base_model)
+                        generate_character_reaction_response = run_llm(user_prompt=generate_character_reaction_prompt, system_prompt=character_agent_system_prompt, model=args.character_agent_base_model, tags={'agent': 'character', 'phase': 'turn'})
                         
                         character_reaction = {'name': chosen_character_agent['name'], 'location': chosen_character_location, 'reaction': generate_character_reaction_response}
                         
-                        character_reaction_text = preprocess_character_reaction(character_reaction)
+                        character_reaction_text = record_turn_event(turn_parent_dict[f'turn_{turn}'], story_progress_list, build_character_reaction_event(character_reaction))
                         logger.debug(f'==={log_prefix} Trun {turn}===\n{character_reaction_text}')
-                        turn_parent_dict[f'turn_{turn}']['story_progress'] = character_reaction_text
-                        story_progress_list.append(character_reaction_text)
                 
                 # Update dynamic attributes every 100'th turn
                 if turn % 100 == 0:
                     # Update character agents' dynamic attribute
-                    updated_character_agent_list = copy.deepcopy(character_agent_list)
-                    for updated_character_agent in updated_character_agent_list:
-                        name = updated_character_agent['name']
-                        updated_character_utility = update_character_utility(
-                            setup=setup,
-                            target_character_agent=updated_character_agent,
-                            story_progress_list=story_progress_list,
-                            args=args)
-                        updated_character_agent['character_utility'] = updated_character_utility
-                        logger.debug(f'===({example_id}) Turn {turn} Update utility({name})===' + updated_character_utility)
-                    
-                    setup = update_setup_character_utility(setup, updated_character_agent_list)
-                    logger.debug(f'===({example_id}) Turn {turn} Update Setup===' + setup)
+                    updated_character_agent_list, setup = update_character_agents_utility(
+                        setup=setup,
+                        character_agent_list=character_agent_list,
+                        story_progress_list=story_progress_list,
+                        logger=logger,
+                        log_prefix=f'({example_id}) Turn {turn}',
+                        args=args)
                     
                     turn_parent_dict[f'turn_{turn}']['character_agent_list'] = updated_character_agent_list
                     turn_parent_dict[f'turn_{turn}']['setup'] = setup
 
-                save_wip_data(wip_data=data, out_dataset=out_dataset, logger=logger, args=args)
+                ## Write the part summaries finished so far, so that this checkpoint includes them
+                is_summary_resolved = part_summaries.resolve(logger, wait_until_part=0)
+                ## Only the turn changed since the last save (unless a summary was written): save the delta of the turn
+                changed_paths = None if is_summary_resolved else [data_path_keys + [f'turn_{turn}']]
+                save_wip_data(wip_data=data, out_dataset=out_dataset, logger=logger, args=args, changed_paths=changed_paths)
+                ## The future context of the previous part is complete
+                if streaming_editor is not None and turn == MAX_FUTURE_CONTEXT_TURN + 1:
+                    streaming_editor.submit(data)
                 
                 cnt_retry = 0 
                 resolve_wrong_character_choice_mode = False
@@ -392,6 +452,9 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
                 act_summary_dict = act_summary_dict_parent[f'act_{act}']
                 if 'turn_-1' not in act_summary_dict: act_summary_dict['turn_-1'] = {}
                 act_summary_dict['turn_-1']['force_quit'] = force_quit
+                save_wip_data(wip_data=data, out_dataset=out_dataset, logger=logger, args=args, changed_paths=[['narrative', f'part_{part}', f'act_{act}', 'turn_-1']])
+                if streaming_editor is not None:
+                    streaming_editor.submit(data)
             
             part_force_quit = force_quit
 
@@ -401,45 +464,242 @@ def generate_narrative(data, setting_data, out_dataset, logger, args):
             data['narrative'][f'part_{part}']['turn_-1']['force_quit'] = part_force_quit
             
             # Update character agents' dynamic attribute
-            updated_character_agent_list = copy.deepcopy(character_agent_list)
-            for updated_character_agent in updated_character_agent_list:
-                name = updated_character_agent['name']
-                updated_character_utility = update_character_utility(
-                    setup=setup,
-                    target_character_agent=updated_character_agent,
-                    story_progress_list=story_progress_list,
-                    args=args)
-                updated_character_agent['character_utility'] = updated_character_utility
-                logger.debug(f'===({example_id}) PART {part} Update utility({name})===' + updated_character_utility)
-            
-            setup = update_setup_character_utility(setup, updated_character_agent_list)
-            logger.debug(f'===({example_id}) PART {part} Update Setup===' + setup)
+            updated_character_agent_list, setup = update_character_agents_utility(
+                setup=setup,
+                character_agent_list=character_agent_list,
+                story_progress_list=story_progress_list,
+                logger=logger,
+                log_prefix=f'({example_id}) PART {part}',
+                args=args)
                 
             data['narrative'][f'part_{part}']['turn_-1']['character_agent_list'] = updated_character_agent_list
             data['narrative'][f'part_{part}']['turn_-1']['setup'] = setup
             
-            # PART Summary
-            setup_without_utility = remove_utility_information(setup)
-            story_progress_text_for_summary = preprocess_story_progress_list(story_progress_list)
-            part_summary_prompt = PART_SUMMARY_PROMPT.format(
-                part_n=part,
-                setup=setup_without_utility,
-                story_progress=story_progress_text_for_summary)
-            part_summary_response = run_llm(user_prompt=part_summary_prompt, model=args.director_agent_base_model)
-            part_summary = part_summary_response.strip()
-            
-            data['narrative'][f'part_{part}']['turn_-1']['part_summary'] = part_summary
-            logger.debug(f'===({example_id}) PART {part} Summary===' + part_summary)
+            # PART Summary (in the background, resolved when a later part needs it)
+            submit_director_part_summary(data, part, setup, story_progress_list, part_summaries, args)
+            ## Write the summaries finished so far, so that this checkpoint includes them
+            part_summaries.resolve(logger, wait_until_part=0)
+            if streaming_editor is not None:
+                streaming_editor.merge(data)
             
             save_wip_data(wip_data=data, out_dataset=out_dataset, logger=logger, args=args)
+            if streaming_editor is not None:
+                streaming_editor.submit(data)
 
     # After Part Loop (Overall)
     if not args.plan_mode:
         data['narrative']['turn_-1'] = {}
         data['narrative']['turn_-1']['force_quit'] = part_force_quit
+    elif part_summaries.resolve(logger):
+        save_wip_data(wip_data=data, out_dataset=out_dataset, logger=logger, args=args)
 
     return data
 
+#### Generation stages ####
+## Each stage takes the story state ({'example_id', 'wip_data', 'setting_data'}), saves its progress
+## and returns False if the story cannot continue. Finished stages are skipped through the stored data.
+def prepare_story(tmas_data, out_dataset, setting_dataset, logger, args):
+    """ Load the stored progress of one example. None if every phase is already finished.
+    """
+    example_id = tmas_data['example_id']
+    inputs = tmas_data['inputs']
+
+    out_data = out_dataset.find(example_id)
+
+    ## Remove this annotation block to regenerate Edit Phase (acts and parts whose inputs are unchanged are kept)
+    """
+    if out_data is not None and out_data['edit_state'] == 'finished':
+        out_data['edit_state'] = 'wip'
+    """
+    
+    ## One simulation holds every edited format: a finished example is edited again if a requested format (--formats) is missing
+    is_edit_finished = out_data is not None and out_data['edit_state'] == 'finished' and has_edit_formats(out_data, args)
+    
+    if out_data is not None and out_data['generation_state'] == 'finished' and is_edit_finished:
+        logger.debug(f'==={example_id} already finished...===')
+        return None
+    
+    wip_data = {'example_id': example_id, 'inputs': inputs, 'generation_state': 'wip', 'edit_state': 'wip'}
+    if out_data is not None:
+        wip_data = copy.deepcopy(out_data)
+        if not is_edit_finished:
+            wip_data['edit_state'] = 'wip'
+    
+    target_setting_data = {}
+    for setting_data in setting_dataset:
+        if setting_data['example_id'] != example_id:
+            continue
+        target_setting_data = setting_data
+    
+    ## Initialization (Setup, Character Agents, Plan)
+    if args.setting_file != 'None' and target_setting_data.get('initialization') is not None:
+        wip_data['initialization'] = copy.deepcopy(target_setting_data['initialization'])
+    
+    if wip_data.get('initialization') is None:
+        wip_data['initialization'] = {}
+    
+    return {'example_id': example_id, 'wip_data': wip_data, 'setting_data': target_setting_data}
+
+def setup_stage(story, out_dataset, logger, args):
+    wip_data = story['wip_data']
+    initial_setup, initial_setup_edit_cnt = generate_initial_setup(data=wip_data, logger=logger, args=args)
+    wip_data['initialization']['initial_setup'] = initial_setup
+    wip_data['initialization']['initial_setup_edit_cnt'] = initial_setup_edit_cnt
+    return True
+
+def character_stage(story, out_dataset, logger, args):
+    wip_data = story['wip_data']
+    updated_initial_setup, character_agent_list = generate_character_agents(data=wip_data, logger=logger, args=args)
+    if updated_initial_setup == False or character_agent_list == False:
+        logger.error(f"({story['example_id']}) Error while Character Agent Creation. Maybe Initial Setup format issue.")
+        return False
+    wip_data['initialization']['initial_setup'] = updated_initial_setup
+    wip_data['initialization']['character_agent_list'] = character_agent_list
+    
+    save_wip_data(wip_data=wip_data, out_dataset=out_dataset, logger=logger, args=args)
+    return True
+
+def plan_stage(story, out_dataset, logger, args):
+    wip_data = story['wip_data']
+    if args.plan_mode:
+        plan = generate_plan(data=wip_data, logger=logger, args=args)
+        wip_data['initialization']['plan'] = plan
+        save_wip_data(wip_data=wip_data, out_dataset=out_dataset, logger=logger, args=args)
+    
+    if not args.plan_mode and args.act_seq_mode:
+        raise Exception("No Plan to Act Seq is not implemented")
+    return True
+
+def simulation_stage(story, out_dataset, logger, args):
+    with llm_call_tags():
+        ## Streaming edit: parts are edited in the background while later parts are simulated
+        streaming_editor = None
+        if args.streaming_edit and args.plan_mode and story['wip_data']['generation_state'] != 'finished':
+            logger.info(f"({story['example_id']}) Editing the simulated narrative along with the simulation...")
+            streaming_editor = StreamingEditor(story['example_id'], logger, args, edited_narrative=story['wip_data'].get('edited_narrative'))
+        
+        try:
+            story['wip_data'] = generate_narrative(data=story['wip_data'], setting_data=story['setting_data'], out_dataset=out_dataset, logger=logger, args=args, streaming_editor=streaming_editor)
+        except BaseException:
+            if streaming_editor is not None:
+                streaming_editor.close()
+            raise
+        
+        if streaming_editor is not None:
+            streaming_editor.finish(story['wip_data'])
+            story['is_edited'] = True
+    
+    story['wip_data']['generation_state'] = 'finished'
+    save_wip_data(wip_data=story['wip_data'], out_dataset=out_dataset, logger=logger, args=args)
+    return True
+
+def edit_stage(story, out_dataset, logger, args):
+    if not story.get('is_edited'):
+        with llm_call_tags():
+            edit_simulated_narrative(gen_data=story['wip_data'], out_dataset=out_dataset, logger=logger, args=args)
+    story['wip_data']['edit_state'] = 'finished'
+    save_wip_data(wip_data=story['wip_data'], out_dataset=out_dataset, logger=logger, args=args)
+    return True
+
+def output_stage(story, out_dataset, logger, args):
+    output_story(story['wip_data'], args)
+    return True
+
+GENERATION_STAGES = {
+    'setup': setup_stage,
+    'character': character_stage,
+    'plan': plan_stage,
+    'simulation': simulation_stage,
+    'edit': edit_stage,
+    'output': output_stage,
+}
+## Worker pool size per stage in --pipeline mode (override with --stage-workers)
+DEFAULT_STAGE_WORKERS = {'setup': 2, 'character': 2, 'plan': 2, 'simulation': 4, 'edit': 2, 'output': 1}
+
+def generate_story(tmas_data, out_dataset, setting_dataset, logger, args):
+    """ Run every phase (initialization, simulation, edit, output) for one example.
+    Finished phases stored in out_dataset are skipped.
+    """
+    story = prepare_story(tmas_data, out_dataset, setting_dataset, logger, args)
+    if story is None:
+        return
+    
+    for stage_func in GENERATION_STAGES.values():
+        if not stage_func(story, out_dataset, logger, args):
+            return
+
+def parse_stage_workers(stage_workers):
+    """ Parse --stage-workers (e.g. 'simulation=8,edit=4'). Unspecified stages use DEFAULT_STAGE_WORKERS.
+    """
+    parsed_stage_workers = dict(DEFAULT_STAGE_WORKERS)
+    if stage_workers == 'None':
+        return parsed_stage_workers
+    
+    for stage_worker in stage_workers.split(','):
+        stage, n_workers = stage_worker.split('=')
+        stage = stage.strip()
+        if stage not in GENERATION_STAGES:
+            raise ValueError(f'Unknown stage in --stage-workers: {stage} (stages: {", ".join(GENERATION_STAGES)})')
+        parsed_stage_workers[stage] = max(1, int(n_workers))
+    return parsed_stage_workers
+
+async def run_generation_pipeline(tmas_dataset, out_dataset, setting_dataset, logger, args):
+    """ Run the generation stages as a pipeline: every stage has its own worker pool and a bounded input queue,
+    so the setup/planning of upcoming stories overlaps with the simulation and edit of earlier ones.
+    Stage functions are blocking, so they run on a thread pool; their LLM calls share the LLM event loop and its rate limits.
+    Returns the number of failed examples.
+    """
+    stage_names = list(GENERATION_STAGES)
+    stage_workers = parse_stage_workers(args.stage_workers)
+    stage_queues = [asyncio.Queue(maxsize=args.stage_queue_size) for _ in stage_names]
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=sum(stage_workers.values()), thread_name_prefix='generation-stage')
+    loop = asyncio.get_running_loop()
+    failed_example_ids = []
+    
+    def run_stage(stage, story):
+        with llm_call_tags(example_id=story['example_id']):
+            return GENERATION_STAGES[stage](story, out_dataset, logger, args)
+    
+    async def stage_worker(k):
+        stage = stage_names[k]
+        while True:
+            story = await stage_queues[k].get()
+            try:
+                logger.debug(f"==={story['example_id']}... {stage} stage===")
+                is_continued = await loop.run_in_executor(executor, contextvars.copy_context().run, run_stage, stage, story)
+                if is_continued and k + 1 < len(stage_names):
+                    await stage_queues[k + 1].put(story)
+            except LLMCallError as e:
+                ## Progress so far is saved. Rerun with --load-file to resume.
+                logger.error(f"({story['example_id']}) LLM call failed permanently in {stage} stage. Skipping this example...\n{e}")
+                failed_example_ids.append(story['example_id'])
+            except Exception:
+                logger.exception(f"({story['example_id']}) {stage} stage failed. Skipping this example...")
+                failed_example_ids.append(story['example_id'])
+            finally:
+                stage_queues[k].task_done()
+    
+    workers = [[asyncio.create_task(stage_worker(k)) for _ in range(stage_workers[stage])] for k, stage in enumerate(stage_names)]
+    try:
+        for tmas_data in tmas_dataset:
+            story = prepare_story(tmas_data, out_dataset, setting_dataset, logger, args)
+            if story is not None:
+                await stage_queues[0].put(story)
+        
+        ## A stage is drained once its queue is joined, as its workers hand a story over before task_done()
+        for k in range(len(stage_names)):
+            await stage_queues[k].join()
+            for worker in workers[k]:
+                worker.cancel()
+    finally:
+        for stage_worker_tasks in workers:
+            for worker in stage_worker_tasks:
+                worker.cancel()
+        await asyncio.gather(*[worker for stage_worker_tasks in workers for worker in stage_worker_tasks], return_exceptions=True)
+        executor.shutdown(wait=True)
+    
+    return len(failed_example_ids)
+
 def main():
     
     #### setup logger ####
@@ -449,88 +709,98 @@ def main():
     #### args ####
     args = parse_args()
     log_generation_setting(logger=logger, args=args)
+    configure_llm_cache(
+        mode=args.llm_cache_mode if args.llm_cache_mode != 'None' else None,
+        path=args.llm_cache_path if args.llm_cache_path != 'None' else None)
+    logger.info(f'LLM cache mode: {get_llm_cache().mode}')
+    configure_llm_backend(
+        backend=args.llm_backend if args.llm_backend != 'None' else None,
+        trace_path=args.llm_trace_path if args.llm_trace_path != 'None' else None,
+        replay_order=args.llm_replay_order if args.llm_replay_order != 'None' else None,
+        replay_latency=True if args.llm_replay_latency else None)
+    logger.info(f'LLM backend: {get_llm_trace().backend}')
+    configure_llm_metrics(
+        path=args.llm_metrics_path if args.llm_metrics_path != 'None' else None,
+        prometheus_port=args.llm_prometheus_port if args.llm_prometheus_port else None)
+    logger.info(f'LLM metrics: {get_llm_metrics().path}')
     
     #### load ####
     tmas_dataset = read_jsonl(args.data_file)
     
-    out_dataset = []
-    if args.load_file != 'None':
-        out_dataset = read_json(args.load_file)
+    if args.output_backend == 'sharded':
+        shard_dir = os.path.join(args.out_dir, out_file_name(args)[:-len('.json')] + '.shards')
+        out_dataset = []
+        if args.load_file != 'None' and os.path.abspath(args.load_file) != os.path.abspath(shard_dir):
+            out_dataset = load_checkpoint(args.load_file)
+        out_dataset = ShardedStore(shard_dir, out_dataset=out_dataset)
+    else:
+        out_dataset = []
+        if args.load_file != 'None':
+            out_dataset = load_checkpoint(args.load_file)
+        out_dataset = CheckpointStore(
+            file_path=os.path.join(args.out_dir, out_file_name(args)),
+            out_dataset=out_dataset,
+            compact_every=args.checkpoint_compact_every,
+            background=args.checkpoint_background)
     
     setting_dataset = []
     if args.setting_file != 'None':
         setting_dataset = read_json(args.setting_file)
     
     #### generate narrative ####
-    for i, tmas_data in enumerate(tmas_dataset):
-        example_id = tmas_data['example_id']
-        inputs = tmas_data['inputs']
-
-        ## Remove this annotation block to regenerate Edit Phase
-        """
-        if any(out_data['example_id'] == example_id and out_data['edit_state'] == 'finished' for out_data in out_dataset):
-            for out_data in out_dataset:
-                if out_data['example_id'] != example_id:
-                    continue
-                out_data['edit_state'] = 'wip'
-        """
-        
-        if any(out_data['example_id'] == example_id and out_data['generation_state'] == 'finished' and out_data['edit_state'] == 'finished' for out_data in out_dataset):
-            logger.debug(f'==={example_id} already finished... ({i+1}/{len(tmas_dataset)})===')
-            continue
-        
-        wip_data = {'example_id': example_id, 'inputs': inputs, 'generation_state': 'wip', 'edit_state': 'wip'}
-        for out_data in out_dataset:
-            if out_data['example_id'] != example_id:
-                continue
-            wip_data = copy.deepcopy(out_data)
-        
-        target_setting_data = {}
-        for setting_data in setting_dataset:
-            if setting_data['example_id'] != example_id:
-                continue
-            target_setting_data = setting_data
-        
-        ## Initialization (Setup, Character Agents, Plan)
-        if args.setting_file != 'None' and target_setting_data.get('initialization') is not None:
-            wip_data['initialization'] = copy.deepcopy(target_setting_data['initialization'])
-        
-        if wip_data.get('initialization') is None:
-            wip_data['initialization'] = {}
-            
-        initial_setup, initial_setup_edit_cnt = generate_initial_setup(data=wip_data, logger=logger, args=args)
-        wip_data['initialization']['initial_setup'] = initial_setup
-        wip_data['initialization']['initial_setup_edit_cnt'] = initial_setup_edit_cnt
-        
-        updated_initial_setup, character_agent_list = generate_character_agents(data=wip_data, logger=logger, args=args)
-        if updated_initial_setup == False or character_agent_list == False:
-            logger.error(f'({example_id}) Error while Character Agent Creation. Maybe Initial Setup format issue.')
-            continue
-        wip_data['initialization']['initial_setup'] = updated_initial_setup
-        wip_data['initialization']['character_agent_list'] = character_agent_list
-        
-        save_wip_data(wip_data=wip_data, out_dataset=out_dataset, logger=logger, args=args)
-        
-        if args.plan_mode:
-            plan = generate_plan(data=wip_data, logger=logger, args=args)
-            wip_data['initialization']['plan'] = plan
-            save_wip_data(wip_data=wip_data, out_dataset=out_dataset, logger=logger, args=args)
-        
-        if not args.plan_mode and args.act_seq_mode:
-            raise Exception("No Plan to Act Seq is not implemented")
+    def generate_example(i, tmas_data, logger):
+        try:
+            with llm_call_tags(example_id=tmas_data['example_id']):
+                generate_story(tmas_data, out_dataset, setting_dataset, logger, args)
+        except LLMCallError as e:
+            ## Progress so far is saved. Move on to the next example; rerun with --load-file to resume.
+            logger.error(f"({tmas_data['example_id']}) LLM call failed permanently. Skipping this example... ({i+1}/{len(tmas_dataset)})\n{e}")
+    
+    if args.pipeline:
+        failed_cnt = asyncio.run(run_generation_pipeline(tmas_dataset, out_dataset, setting_dataset, logger, args))
+        if failed_cnt:
+            logger.error(f'{failed_cnt}/{len(tmas_dataset)} examples failed. Check generation.log and rerun with --load-file to resume.')
+    elif args.workers <= 1:
+        for i, tmas_data in enumerate(tmas_dataset):
+            generate_example(i, tmas_data, logger)
+    else:
+        ## Threads, not processes: LLM calls already run on one shared event loop, so the workers share
+        ## the provider rate limits, the LLM cache and the output store (whose save() is thread-safe).
+        worker_ids = queue.Queue()
+        for worker_id in range(args.workers):
+            worker_ids.put(worker_id)
+        worker_local = threading.local()
         
-        wip_data = generate_narrative(data=wip_data, setting_data=target_setting_data, out_dataset=out_dataset, logger=logger, args=args)
+        def init_worker():
+            worker_id = worker_ids.get()
+            worker_log_file_path = os.path.join(os.environ['LOG_DIR'], f'generation_worker_{worker_id}.log')
+            worker_local.logger = setup_logger(f'generation_worker_{worker_id}', worker_log_file_path, level=logging.INFO, verbose=False)
         
-        wip_data['generation_state'] = 'finished'
-        save_wip_data(wip_data=wip_data, out_dataset=out_dataset, logger=logger, args=args)
-
-        ## Edit Phase
-        edit_simulated_narrative(gen_data=wip_data, out_dataset=out_dataset, logger=logger, args=args)
-        wip_data['edit_state'] = 'finished'
-        save_wip_data(wip_data=wip_data, out_dataset=out_dataset, logger=logger, args=args)
+        def run_worker(i, tmas_data):
+            try:
+                generate_example(i, tmas_data, worker_local.logger)
+            except Exception as e:
+                worker_local.logger.exception(f"({tmas_data['example_id']}) Generation failed. Skipping this example... ({i+1}/{len(tmas_dataset)})")
+                raise
         
-        ## Output the story
-        output_story(wip_data, args)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='generation-worker', initializer=init_worker) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, run_worker, i, tmas_data) for i, tmas_data in enumerate(tmas_dataset)]
+            failed_cnt = 0
+            for future in concurrent.futures.as_completed(futures):
+                if future.exception() is not None:
+                    failed_cnt += 1
+        if failed_cnt:
+            logger.error(f'{failed_cnt}/{len(tmas_dataset)} examples failed. Check generation_worker_*.log and rerun with --load-file to resume.')
+    
+    out_dataset.close()
+    if args.output_backend == 'sharded':
+        logger.info(f'Saved {out_dataset.shard_dir} (merge into one JSON file with export_store.py)')
+    else:
+        logger.info(f'Saved {out_dataset.file_path}')
+    
+    logger.info(f'LLM cache stats: {get_llm_cache_stats()}')
+    logger.info(f'LLM trace stats: {get_llm_trace_stats()}')
+    logger.info(f'LLM usage by agent/phase:\n{get_llm_metrics().format_summary()}')
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,9 +1,14 @@
 import copy
+import queue
+import asyncio
+import threading
 
 from global_utils import *
 from planner_agent_utils import *
 from character_agent_utils import *
+from director_agent_utils import remove_initial_state_information, remove_utility_information
 from prompts.planner_agent_prompt import *
+from prompts.director_agent_prompt import ROLLING_SUMMARY_PROMPT, PART_SUMMARY_PROMPT
 
 
 #################################
@@ -13,6 +18,9 @@ from prompts.planner_agent_prompt import *
 #################################
 
 def out_file_name(args):
+    """ File name of the generated data. The format is not part of the name: one simulation holds every edited format
+    (see has_edit_formats), and the story files (out_file_name_story) are written per format.
+    """
     
     out_file_name = "gen"
     
@@ -38,7 +46,230 @@ def out_file_name(args):
     return out_file_name
 
 
-def save_wip_data(wip_data, out_dataset, logger, args):
+def diff_json(old, new, path=()):
+    """ Recursive diff of JSON-like data as a list of ops: ['set', path, value] / ['del', path].
+    Dicts are diffed key by key; other values (including lists) are replaced as a whole when changed.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key, value in new.items():
+            if key not in old:
+                ops.append(['set', list(path) + [key], copy.deepcopy(value)])
+            else:
+                ops += diff_json(old[key], value, path + (key,))
+        for key in old:
+            if key not in new:
+                ops.append(['del', list(path) + [key]])
+        return ops
+    
+    if type(old) == type(new) and old == new:
+        return []
+    return [['set', list(path), copy.deepcopy(new)]]
+
+def diff_json_at(old, new, path):
+    """ diff_json of the subtrees at path only, so the cost depends on the subtree (e.g. one turn), not on the whole example.
+    A parent missing from old is set as a whole.
+    """
+    for i, key in enumerate(path):
+        if key not in new:
+            return [['del', list(path[:i+1])]] if key in old else []
+        if not isinstance(old.get(key), dict) or not isinstance(new[key], dict):
+            return diff_json(old.get(key), new[key], tuple(path[:i+1])) if key in old else [['set', list(path[:i+1]), copy.deepcopy(new[key])]]
+        old, new = old[key], new[key]
+    return diff_json(old, new, tuple(path))
+
+def apply_json_ops(records, example_id, ops):
+    """ Apply diff_json ops of an example to records ({example_id: data}).
+    """
+    for op in ops:
+        path = op[1]
+        if path == []:
+            records[example_id] = op[2]
+            continue
+        
+        target = records[example_id]
+        for key in path[:-1]:
+            target = target[key]
+        if op[0] == 'set':
+            target[path[-1]] = op[2]
+        else:
+            target.pop(path[-1], None)
+
+def load_checkpoint(file_path):
+    """ Load a checkpoint (list of examples) and replay its write-ahead log if the last run did not compact it.
+    """
+    if os.path.isdir(file_path):
+        return list(ShardedStore(file_path))
+    
+    records = {}
+    if os.path.exists(file_path):
+        records = {data['example_id']: data for data in read_json(file_path)}
+    
+    wal_path = file_path + '.wal.jsonl'
+    if os.path.exists(wal_path):
+        with open(wal_path, 'r', encoding='UTF-8') as f:
+            for line in f:
+                try:
+                    wal_entry = json.loads(line)
+                except json.JSONDecodeError:
+                    ## Torn last line of a crashed run
+                    break
+                apply_json_ops(records, wal_entry['example_id'], wal_entry['ops'])
+    
+    return list(records.values())
+
+class CheckpointStore(list):
+    """ Journaled checkpoint of the generated dataset (a list of examples, same as out_dataset).
+    save() appends the delta from the last saved state of the example to a JSONL write-ahead log (<path>.wal.jsonl).
+    The caller can name the paths it changed (e.g. the current turn), so only those subtrees are compared.
+    The full dataset is written to <path> in the gen_*.json format (temp file + rename) and the log is truncated
+    at close(), and with background=True also every compact_every saves on the writer thread,
+    so a full rewrite never runs on the caller's thread during the run. load_checkpoint() replays the log of an interrupted run.
+    save() is thread-safe, so several workers (--workers) can share one store.
+    Parameters
+    ----------
+    file_path : str
+        path of the gen_*.json snapshot
+    out_dataset : list
+        loaded examples
+    compact_every : int
+        number of saves between compactions (background=True)
+    background : bool
+        write the log and the compactions on a background thread
+    """
+    def __init__(self, file_path, out_dataset=None, compact_every=50, background=False):
+        super().__init__(out_dataset or [])
+        self.file_path = file_path
+        self.wal_path = file_path + '.wal.jsonl'
+        self.compact_every = compact_every
+        self.background = background
+        self._index = {data['example_id']: i for i, data in enumerate(self)}
+        ## Last saved state per example (diff base). Owned by the caller.
+        self._shadow = {data['example_id']: copy.deepcopy(data) for data in self}
+        ## State written to disk. Owned by the writer (the shadow itself when writing on the caller's thread).
+        self._records = {data['example_id']: copy.deepcopy(data) for data in self} if background else self._shadow
+        self._saves_since_compaction = 0
+        self._wal_file = None
+        self._writer_error = None
+        self._lock = threading.Lock()
+        
+        if self._records:
+            self._compact()
+        self._wal_file = open(self.wal_path, 'w', encoding='UTF-8')
+        
+        self._queue = None
+        if background:
+            self._queue = queue.Queue()
+            self._writer = threading.Thread(target=self._write_loop, name='checkpoint-writer', daemon=True)
+            self._writer.start()
+    
+    def find(self, example_id):
+        if example_id not in self._index:
+            return None
+        return self[self._index[example_id]]
+    
+    def save(self, wip_data, changed_paths=None):
+        """ Parameters
+        ----------
+        changed_paths : list
+            (optional) paths of the only subtrees changed since the last save (e.g. [['narrative', 'part_1', 'turn_3']]).
+            None compares the whole example.
+        """
+        if self._writer_error is not None:
+            raise self._writer_error
+        
+        example_id = wip_data['example_id']
+        with self._lock:
+            if example_id in self._index:
+                self[self._index[example_id]] = wip_data
+            else:
+                self._index[example_id] = len(self)
+                self.append(wip_data)
+            
+            if changed_paths is None or example_id not in self._shadow:
+                ops = diff_json(self._shadow.get(example_id), wip_data)
+            else:
+                ops = []
+                for changed_path in changed_paths:
+                    ops += diff_json_at(self._shadow[example_id], wip_data, changed_path)
+            if ops == []:
+                return
+            
+            if self._queue is not None:
+                apply_json_ops(self._shadow, example_id, copy.deepcopy(ops))
+                self._queue.put((example_id, ops))
+            else:
+                apply_json_ops(self._shadow, example_id, ops)
+                self._write(example_id, ops)
+    
+    def _write(self, example_id, ops):
+        if self._records is not self._shadow:
+            apply_json_ops(self._records, example_id, ops)
+        self._wal_file.write(json.dumps({'example_id': example_id, 'ops': ops}, ensure_ascii=False) + '\n')
+        self._wal_file.flush()
+        
+        self._saves_since_compaction += 1
+        if self._queue is not None and self._saves_since_compaction >= self.compact_every:
+            self._compact()
+    
+    def _compact(self):
+        save_json(list(self._records.values()), self.file_path, fsync=True)
+        if self._wal_file is not None:
+            self._wal_file.truncate(0)
+            self._wal_file.seek(0)
+        self._saves_since_compaction = 0
+    
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                logger.error(f'Checkpoint writer failed: {e}')
+                self._writer_error = e
+            finally:
+                self._queue.task_done()
+    
+    def flush(self):
+        if self._queue is not None:
+            self._queue.join()
+    
+    def close(self):
+        """ Wait for pending writes, compact and stop the writer.
+        """
+        if self._queue is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._queue = None
+        if self._wal_file is not None:
+            self._compact()
+            self._wal_file.close()
+            self._wal_file = None
+            os.remove(self.wal_path)
+
+def save_wip_data(wip_data, out_dataset, logger, args, changed_paths=None):
+    """ Parameters
+    ----------
+    changed_paths : list
+        (optional) paths of the only subtrees of wip_data changed since its last save (CheckpointStore writes their delta)
+    """
+    
+    if isinstance(out_dataset, CheckpointStore):
+        out_dataset.save(wip_data, changed_paths=changed_paths)
+        logger.debug(f"===Saved {wip_data['example_id']} to {out_dataset.wal_path}===")
+        return
+    
+    if isinstance(out_dataset, ShardedStore):
+        out_dataset.save(wip_data)
+        logger.debug(f"===Saved {wip_data['example_id']} to {out_dataset.shard_dir}===")
+        return
+    
+    ## Other stores with save() (e.g. StreamingEditor)
+    if hasattr(out_dataset, 'save'):
+        out_dataset.save(wip_data)
+        return
     
     if any(out_data['example_id'] == wip_data['example_id'] for out_data in out_dataset):
         
@@ -65,7 +296,7 @@ def preprocess_story_segment(story_segment, hide_thoughts, target_character):
 
     return story_segment
 
-def out_file_name_story(data, args):
+def out_file_name_story(data, args, format_key):
     
     out_file_name = data['example_id']
     
@@ -86,21 +317,64 @@ def out_file_name_story(data, args):
 
     out_file_name += f'_d_{args.director_agent_base_model}_c_{args.character_agent_base_model}'
     
-    if args.reformat_novel:
-        out_file_name += '_novel'
-    else:
-        out_file_name += '_screenplay'
+    out_file_name += '_' + format_key[len('story_progress_'):]
     
     out_file_name += '.txt'
     
     return out_file_name
 
-def output_story(data, args):
-    if args.reformat_novel:
-        format_key = 'story_progress_novel'
+## Formats of the edited narrative
+EDIT_FORMATS = ['screenplay', 'novel']
+def parse_edit_formats(args):
+    """ Parse --formats (e.g. 'screenplay,novel'). Without it, --reformat-novel chooses novel over the default screenplay.
+    Returns the format keys of the edited narrative (e.g. ['story_progress_screenplay', 'story_progress_novel']).
+    """
+    if args.formats == 'None':
+        edit_formats = ['novel'] if args.reformat_novel else ['screenplay']
     else:
-        format_key = 'story_progress_screenplay'
+        edit_formats = []
+        for edit_format in args.formats.split(','):
+            edit_format = edit_format.strip()
+            if edit_format not in EDIT_FORMATS:
+                raise ValueError(f'Unknown format in --formats: {edit_format} (formats: {", ".join(EDIT_FORMATS)})')
+            if edit_format not in edit_formats:
+                edit_formats.append(edit_format)
+    return [f'story_progress_{edit_format}' for edit_format in edit_formats]
+
+def has_edit_formats(data, args):
+    """ Whether the edited narrative of data has every requested format (--formats) in every part and act.
+    """
+    edited_narrative = data.get('edited_narrative') or {}
+    for format_key in parse_edit_formats(args):
+        if edited_narrative.get('part_1') is None:
+            if edited_narrative.get(format_key) is None:
+                return False
+            continue
         
+        part_storytelling = 1
+        while edited_narrative.get(f'part_{part_storytelling}') is not None:
+            edited_part = edited_narrative[f'part_{part_storytelling}']
+            if edited_part.get('act_1') is None:
+                if edited_part.get(format_key) is None:
+                    return False
+            else:
+                act_storytelling = 1
+                while edited_part.get(f'act_{act_storytelling}') is not None:
+                    edited_act = edited_part[f'act_{act_storytelling}']
+                    ## Acts of at most one turn are not edited
+                    if edited_act.get(format_key) is None and edited_act.get('story_progress') != '':
+                        return False
+                    act_storytelling += 1
+            part_storytelling += 1
+    return True
+
+def output_story(data, args):
+    """ Write the edited story in every requested format (--formats)
+    """
+    for format_key in parse_edit_formats(args):
+        output_story_format(data, format_key, args)
+
+def output_story_format(data, format_key, args):
     story = ''
     
     part_storytelling = 1
@@ -122,7 +396,7 @@ def output_story(data, args):
     if part_storytelling == 1:
         story = data['edited_narrative'][format_key]
         
-    save_path = os.path.join(args.out_dir, out_file_name_story(data, args))
+    save_path = os.path.join(args.out_dir, out_file_name_story(data, args, format_key))
     
     save_txt(story.strip(), save_path)
     logger.debug(f'===Saved {save_path}===')
@@ -198,18 +472,211 @@ def add_summarized_profiles(setup, character_agent_list):
     
     return cleaned_setup
 
+class SetupViewCache:
+    """ Derived views of Setup for prompting, computed once per Setup / character agent list version.
+    Setup only changes at part boundaries and utility updates (update_narrative_utility, update_setup_character_utility),
+    so the views are reused for every turn in between.
+    Views
+    -----
+    director : Setup without Initial State and narrative utility, with summarized profiles
+    narrative_utility : utility(narrative) extracted from Setup
+    beginning : Setup without utilities, with summarized profiles
+    intervention : director view without utilities
+    character_tom : director view without utilities and summarized profiles
+    """
+    def __init__(self):
+        self._version = None
+        self._views = {}
+    
+    def get(self, view, setup, character_agent_list):
+        version = (setup, tuple((character_agent['name'], character_agent['role'], character_agent['summarized_profile']) for character_agent in character_agent_list))
+        if version != self._version:
+            self._version = version
+            self._views = {}
+        
+        if view not in self._views:
+            if view in ['director', 'narrative_utility']:
+                cleaned_setup = remove_initial_state_information(setup=setup)
+                cleaned_setup, utility_narrative = remove_and_extract_utility_information(setup=cleaned_setup, character='narrative')
+                cleaned_setup = preprocess_setup(cleaned_setup)
+                self._views['director'] = add_summarized_profiles(cleaned_setup, character_agent_list)
+                self._views['narrative_utility'] = utility_narrative
+            elif view == 'beginning':
+                cleaned_setup_for_beginning = remove_utility_information(setup)
+                cleaned_setup_for_beginning = preprocess_setup(cleaned_setup_for_beginning)
+                self._views['beginning'] = add_summarized_profiles(cleaned_setup_for_beginning, character_agent_list)
+            elif view == 'intervention':
+                self._views['intervention'] = remove_utility_information(self.get('director', setup, character_agent_list))
+            elif view == 'character_tom':
+                self._views['character_tom'] = remove_summarized_character_profiles(setup=self.get('intervention', setup, character_agent_list))
+            else:
+                raise ValueError(f'Unknown Setup view: {view}')
+        
+        return self._views[view]
+
+
+LATEST_STORY_PROGRESS_PHRASE = "### Latest Story Progress"
+
+def latest_story_progress_index(story_progress_list):
+    """ Index where "### Latest Story Progress" is inserted.
+    The latest segment, or the one before the header of a new PART.
+    """
+    if '### PART' in story_progress_list[-1] and 'PART 1' not in story_progress_list[-1]:
+        return max(len(story_progress_list) - 2, 0)
+    return len(story_progress_list) - 1
+
+class StoryProgressBuffer(list):
+    """ Append-only list of Story Progress segments that renders Story Progress text incrementally.
+    The text of the committed prefix (segments before the latest story progress marker) is cached,
+    so each render only joins the segments appended since the last render.
+    Mutations other than append/extend drop the cache.
+    events holds the structured turn event of each segment (None for plain text such as PART headers).
+    """
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.events = [None] * len(self)
+        self._reset_prefix()
+    
+    def append(self, story_progress_segment):
+        super().append(story_progress_segment)
+        self.events.append(None)
+    
+    def extend(self, story_progress_segments):
+        for story_progress_segment in story_progress_segments:
+            self.append(story_progress_segment)
+    
+    def __iadd__(self, story_progress_segments):
+        self.extend(story_progress_segments)
+        return self
+    
+    def append_event(self, event):
+        super().append(format_turn_event(event))
+        self.events.append(event)
+    
+    def append_turn(self, turn_data):
+        """ Append a recorded turn. Turns recorded before turn events existed are appended as text.
+        """
+        if turn_data.get('event') is not None:
+            self.append_event(turn_data['event'])
+        else:
+            self.append(turn_data['story_progress'])
+    
+    def _reset_prefix(self):
+        self._prefix_text = ''
+        self._prefix_n = 0
+        self._segment_lines = []
+        self._tom_prefix = {}
+    
+    def _tom_segment(self, i, character):
+        """ ToM view (hide_thought_of_others) of the i'th segment.
+        Thoughts are stripped once per line and shared by every character except the speaker.
+        """
+        while len(self._segment_lines) <= i:
+            segment_lines = []
+            event = self.events[len(self._segment_lines)]
+            if event is not None and event['kind'] == 'reaction':
+                ## Reaction: the speaker and thought spans are recorded in the event
+                utterance = event['utterance']
+                cleaned_utterance, last_end = '', 0
+                for thought_start, thought_end in event['thoughts']:
+                    cleaned_utterance += utterance[last_end:thought_start]
+                    last_end = thought_end
+                cleaned_utterance += utterance[last_end:]
+                speaker_prefix = f"{event['speaker']} (at {event['location']})"
+                cleaned_paragraph = re.sub(r'\s+', ' ', f"{speaker_prefix}: {cleaned_utterance}").strip()
+                self._segment_lines.append([(speaker_prefix, self[len(self._segment_lines)], cleaned_paragraph)])
+                continue
+            
+            for paragraph in self[len(self._segment_lines)].split('\n'):
+                if paragraph == '':
+                    continue
+                cleaned_paragraph = re.sub(r'\s+', ' ', re.sub(r"\[.*?\]", '', paragraph)).strip()
+                segment_lines.append((paragraph.split(':')[0], paragraph, cleaned_paragraph))
+            self._segment_lines.append(segment_lines)
+        
+        tom_lines = []
+        for paragraph_character, paragraph, cleaned_paragraph in self._segment_lines[i]:
+            if character != None and character in paragraph_character:
+                tom_lines.append(paragraph)
+            elif cleaned_paragraph != '':
+                tom_lines.append(cleaned_paragraph)
+        return '\n'.join(tom_lines)
+    
+    def render_tom(self, character=None):
+        """ Same as hide_thought_of_others(self.render(), character), with the prefix cached per character.
+        """
+        if len(self) == 0:
+            return hide_thought_of_others("This is the start of the story.", character)
+        
+        latest_index = latest_story_progress_index(self)
+        prefix_n, prefix_text = self._tom_prefix.get(character, (0, ''))
+        if latest_index < prefix_n:
+            prefix_n, prefix_text = 0, ''
+        if latest_index > prefix_n:
+            new_prefix_text = '\n'.join(tom_segment for tom_segment in (self._tom_segment(i, character) for i in range(prefix_n, latest_index)) if tom_segment != '')
+            prefix_text = '\n'.join(text for text in [prefix_text, new_prefix_text] if text != '')
+            prefix_n = latest_index
+            self._tom_prefix[character] = (prefix_n, prefix_text)
+        
+        latest_text = '\n'.join(text for text in [prefix_text, hide_thought_of_others(LATEST_STORY_PROGRESS_PHRASE, character)] if text != '')
+        for i in range(latest_index, len(self)):
+            tom_segment = self._tom_segment(i, character)
+            if tom_segment != '':
+                latest_text += '\n' + tom_segment
+        return latest_text
+    
+    def render(self):
+        if len(self) == 0:
+            return "This is the start of the story."
+        
+        latest_index = latest_story_progress_index(self)
+        if latest_index < self._prefix_n:
+            self._reset_prefix()
+        if latest_index > self._prefix_n:
+            new_prefix_text = '\n'.join(self[self._prefix_n:latest_index])
+            self._prefix_text = new_prefix_text if self._prefix_n == 0 else self._prefix_text + '\n' + new_prefix_text
+            self._prefix_n = latest_index
+        
+        latest_text = LATEST_STORY_PROGRESS_PHRASE + '\n' + '\n'.join(self[latest_index:])
+        if self._prefix_n == 0:
+            return latest_text
+        return self._prefix_text + '\n' + latest_text
+    
+    def _mutated(method):
+        def mutate(self, *args, **kwargs):
+            result = method(self, *args, **kwargs)
+            self.events = [None] * len(self)
+            self._reset_prefix()
+            return result
+        return mutate
+    
+    __setitem__ = _mutated(list.__setitem__)
+    __delitem__ = _mutated(list.__delitem__)
+    insert = _mutated(list.insert)
+    pop = _mutated(list.pop)
+    remove = _mutated(list.remove)
+    clear = _mutated(list.clear)
+    sort = _mutated(list.sort)
+    reverse = _mutated(list.reverse)
+    __imul__ = _mutated(list.__imul__)
+    del _mutated
+
 def preprocess_story_progress_list(story_progress_list):
     """ Preprocess story_progress_list to Story Progress text for prompting
+    StoryProgressBuffer renders the text incrementally.
     Parameters
     ----------
     story_progress_list : list
         list of Story Progress segments
     """
     
+    if isinstance(story_progress_list, StoryProgressBuffer):
+        return story_progress_list.render()
+    
     if story_progress_list == []:
         return "This is the start of the story."
     
-    last_story_progress_phrase = "### Latest Story Progress"
+    last_story_progress_phrase = LATEST_STORY_PROGRESS_PHRASE
     story_progress_list_copy = story_progress_list.copy()
     if '### PART' in story_progress_list_copy[-1] and 'PART 1' not in story_progress_list_copy[-1]:
         story_progress_list_copy.insert(-2, last_story_progress_phrase)
@@ -218,6 +685,102 @@ def preprocess_story_progress_list(story_progress_list):
     
     return '\n'.join(story_progress_list_copy)
 
+def preprocess_story_progress_list_tom(story_progress_list, character=None):
+    """ Story Progress text seen by the character (hide_thought_of_others).
+    StoryProgressBuffer renders the view incrementally per character.
+    Parameters
+    ----------
+    story_progress_list : list
+        list of Story Progress segments
+    character : str
+        character's name. None = hide **thought** of all of the characters
+    """
+    if isinstance(story_progress_list, StoryProgressBuffer):
+        return story_progress_list.render_tom(character)
+    return hide_thought_of_others(story_progress=preprocess_story_progress_list(story_progress_list), character=character)
+
+def record_turn_event(turn_dict, story_progress_list, event):
+    """ Record a turn event to the turn data and Story Progress.
+    story_progress of the turn data is derived from the event for the readers of the saved data.
+    """
+    turn_dict['event'] = event
+    turn_dict['story_progress'] = format_turn_event(event)
+    story_progress_list.append_event(event)
+    return turn_dict['story_progress']
+
+
+## Context policy of Story Progress (sliding window + rolling summary)
+CONTEXT_MIN_WINDOW_SEGMENTS = 4
+ROLLING_SUMMARY_MAX_WORDS = 300
+class StoryProgressContext:
+    """ Build Story Progress text for prompting within a token budget.
+    The latest segments are kept verbatim and older segments are folded into a rolling summary.
+    The summary is updated incrementally: once the window exceeds the budget, the oldest segments are folded
+    until the window fits in half of the budget, so the summary is updated once per half budget of new story.
+    Parameters
+    ----------
+    budget_tokens : int
+        token budget of Story Progress text. 0 = no limit (whole Story Progress)
+    args : argparse.Namespace
+        director-agent-base-model summarizes the folded segments
+    """
+    def __init__(self, budget_tokens, args):
+        self.budget_tokens = budget_tokens
+        self.args = args
+        self.summary = ''
+        self.summarized_n = 0
+        self.segment_tokens = []
+    
+    def fold(self, story_progress_segments):
+        ## Thoughts are hidden since the summary is shared by every agent.
+        story_progress = hide_thought_of_others('\n'.join(story_progress_segments))
+        rolling_summary_prompt = ROLLING_SUMMARY_PROMPT.format(
+            max_words=ROLLING_SUMMARY_MAX_WORDS,
+            summary=self.summary if self.summary else 'This is the start of the story.',
+            story_progress=story_progress)
+        self.summary = run_llm(user_prompt=rolling_summary_prompt, model=self.args.director_agent_base_model, tags={'agent': 'director', 'phase': 'rolling_summary'}).strip()
+    
+    def build(self, story_progress_list):
+        if not self.budget_tokens:
+            return preprocess_story_progress_list(story_progress_list)
+        
+        ## story_progress_list was rebuilt (e.g. a new part). Start over.
+        if len(story_progress_list) < len(self.segment_tokens):
+            self.summary, self.summarized_n, self.segment_tokens = '', 0, []
+        for story_progress_segment in story_progress_list[len(self.segment_tokens):]:
+            self.segment_tokens.append(count_prompt_tokens(story_progress_segment))
+        
+        window_tokens = sum(self.segment_tokens[self.summarized_n:])
+        if window_tokens + count_prompt_tokens(self.summary) > self.budget_tokens:
+            fold_end = self.summarized_n
+            while fold_end < len(story_progress_list) - CONTEXT_MIN_WINDOW_SEGMENTS and window_tokens > self.budget_tokens // 2:
+                window_tokens -= self.segment_tokens[fold_end]
+                fold_end += 1
+            if fold_end > self.summarized_n:
+                self.fold(story_progress_list[self.summarized_n:fold_end])
+                self.summarized_n = fold_end
+        
+        if self.summarized_n == 0:
+            return preprocess_story_progress_list(story_progress_list)
+        story_progress_text = preprocess_story_progress_list(story_progress_list[self.summarized_n:])
+        return f"### Story So Far (summary)\n{self.summary}\n\n{story_progress_text}"
+    
+    def build_tom(self, story_progress_list, character=None):
+        """ build() as seen by the character (hide_thought_of_others).
+        """
+        if self.budget_tokens:
+            story_progress_text = self.build(story_progress_list)
+            if self.summarized_n > 0:
+                return hide_thought_of_others(story_progress=story_progress_text, character=character)
+        return preprocess_story_progress_list_tom(story_progress_list, character)
+
+def build_story_progress_contexts(args):
+    """ Story Progress context per agent. Agents with the same budget share the rolling summary.
+    """
+    budgets = {'director': args.context_budget_director, 'character': args.context_budget_character}
+    contexts_by_budget = {budget: StoryProgressContext(budget, args) for budget in set(budgets.values())}
+    return {agent: contexts_by_budget[budget] for agent, budget in budgets.items()}
+
 
 def preprocess_beginning_story(response):
     """ Preprocess LLM response of beginning generation to record it to story progress
@@ -299,7 +862,7 @@ def init_narrative_generation(data, setting_data, args):
 
 
 def build_context_start_of_new_part(data, part, args):
-    story_progress_list = []
+    story_progress_list = StoryProgressBuffer()
     
     for part_n in range(part-2):
         story_progress_list.append(f'### PART {part_n+1} summary')
@@ -328,6 +891,115 @@ def build_context_start_of_new_part(data, part, args):
     
     return story_progress_list
 
+def build_story_progress_end_of_part(data, part, args):
+    """ Story Progress at the end of a simulated part: the context at the start of the part and the turns of the part.
+    Reads the summaries of parts <= part-2.
+    """
+    story_progress_list = build_context_start_of_new_part(data, part, args)
+    
+    turn_parents = [data['narrative'][f'part_{part}']]
+    if args.act_seq_mode:
+        turn_parents = []
+        act_storytelling = 1
+        while data['narrative'][f'part_{part}'].get(f'act_{act_storytelling}') is not None:
+            turn_parents.append(data['narrative'][f'part_{part}'][f'act_{act_storytelling}'])
+            act_storytelling += 1
+    
+    for turn_parent in turn_parents:
+        turn_storytelling = 1
+        while turn_parent.get(f'turn_{turn_storytelling}', {}).get('story_progress') is not None:
+            story_progress_list.append_turn(turn_parent[f'turn_{turn_storytelling}'])
+            turn_storytelling += 1
+    
+    return story_progress_list
+
+def submit_director_part_summary(data, part, setup, story_progress_list, part_summaries, args):
+    """ Summarize the simulated part in the background. The summary is written to the part's 'turn_-1' when resolved.
+    """
+    setup_without_utility = remove_utility_information(setup)
+    story_progress_text_for_summary = preprocess_story_progress_list(story_progress_list)
+    part_summary_prompt = PART_SUMMARY_PROMPT.format(
+        part_n=part,
+        setup=setup_without_utility,
+        story_progress=story_progress_text_for_summary)
+    part_summaries.submit(
+        part,
+        data['narrative'][f'part_{part}']['turn_-1'],
+        submit_llm(user_prompt=part_summary_prompt, model=args.director_agent_base_model, tags={'agent': 'director', 'phase': 'part_summary', 'turn': None}),
+        log_prefix=f"({data['example_id']})")
+
+
+class DeferredPartSummaries:
+    """ Part summaries generated in the background (submit_llm).
+    A part summary is only read when the context of a part two parts later is built, so the next part starts without waiting for it.
+    resolve() writes the finished summaries to their records ('part_summary'), blocking only for the parts that are needed.
+    """
+    def __init__(self):
+        self.pending = {}
+    
+    def submit(self, part, summary_record, future, log_prefix='', fingerprint=None):
+        """ fingerprint (optional) is written with the summary ('part_summary_fingerprint'). The stale summary is dropped until then.
+        """
+        summary_record.pop('part_summary', None)
+        self.pending[part] = (summary_record, future, log_prefix, fingerprint)
+    
+    def resolve(self, logger, wait_until_part=None):
+        """ Write every finished summary, and wait for the summaries of parts <= wait_until_part (every part if None).
+        Returns True if any summary was written.
+        """
+        is_resolved = False
+        for part in sorted(self.pending):
+            summary_record, future, log_prefix, fingerprint = self.pending[part]
+            if wait_until_part is None or part <= wait_until_part or future.done():
+                part_summary = future.result().strip()
+                summary_record['part_summary'] = part_summary
+                if fingerprint is not None:
+                    summary_record['part_summary_fingerprint'] = fingerprint
+                logger.debug(f'==={log_prefix} PART {part} Summary===\n{part_summary}')
+                del self.pending[part]
+                is_resolved = True
+        return is_resolved
+
+## Maximum number of concurrent character utility updates
+UTILITY_UPDATE_CONCURRENCY = 8
+async def update_character_utilities_async(setup, character_agent_list, story_progress_list, args):
+    semaphore = asyncio.Semaphore(UTILITY_UPDATE_CONCURRENCY)
+    
+    async def update(character_agent):
+        async with semaphore:
+            return await update_character_utility_async(
+                setup=setup,
+                target_character_agent=character_agent,
+                story_progress_list=story_progress_list,
+                args=args)
+    
+    return await asyncio.gather(*[update(character_agent) for character_agent in character_agent_list])
+
+def update_character_agents_utility(setup, character_agent_list, story_progress_list, logger, log_prefix, args):
+    """ Update every character's utility function concurrently (each update reads only the Setup and the Story Progress)
+    and merge them into the Setup.
+    Returns the updated copy of character_agent_list and the updated Setup.
+    Parameters
+    ----------
+    setup : str
+            Setup text
+    character_agent_list : list
+            character agents (not modified)
+    story_progress_list : list
+            story progress list
+    log_prefix : str
+            log prefix (e.g. '(example_id) PART 1')
+    """
+    updated_character_agent_list = copy.deepcopy(character_agent_list)
+    updated_character_utilities = run_coroutine_sync(update_character_utilities_async(setup, updated_character_agent_list, story_progress_list, args))
+    for updated_character_agent, updated_character_utility in zip(updated_character_agent_list, updated_character_utilities):
+        updated_character_agent['character_utility'] = updated_character_utility
+        logger.debug(f"==={log_prefix} Update utility({updated_character_agent['name']})===" + updated_character_utility)
+    
+    setup = update_setup_character_utility(setup, updated_character_agent_list)
+    logger.debug(f'==={log_prefix} Update Setup===' + setup)
+    
+    return updated_character_agent_list, setup
 
 #####################################
 ####                             ####
@@ -391,5 +1063,8 @@ def is_character_reaction(story_progress_list):
     """
     if story_progress_list == []:
         return False
+    
+    if isinstance(story_progress_list, StoryProgressBuffer) and story_progress_list.events[-1] is not None:
+        return story_progress_list.events[-1]['kind'] == 'reaction'
 
     return bool(re.match(r"^[^:]+(?: \([^)]+\))?: .+", story_progress_list[-1]))
\ No newline at end of file
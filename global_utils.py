@@ -4,13 +4,30 @@ sys.path.insert(0, '.')
 import logging
 import openai
 import os
-from openai import OpenAI
+from openai import AsyncOpenAI
 from google import genai
 from google.genai import types
+from google.genai import errors as genai_errors
 import re
 import json
 import ast
 import time
+import threading
+import asyncio
+import hashlib
+import sqlite3
+import email.utils
+import random
+import httpx
+import tiktoken
+import contextvars
+import contextlib
+import textwrap
+import tempfile
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
 
 #### logger ####
 def setup_logger(name, log_file_path, level=logging.INFO, verbose=False):
@@ -51,9 +68,22 @@ def read_json(file_path):
     with open(file_path, 'r', encoding='UTF-8') as f:
         return json.load(f)
 
-def save_json(save_json, file_path):
-    with open(file_path, 'w', encoding='UTF-8') as f:
-        json.dump(save_json, f, indent=2, ensure_ascii=False)
+def save_json(save_json, file_path, fsync=False):
+    ## Write to a temp file and rename, so a crash mid-write never corrupts the previous file.
+    ## The temp file name is unique, so concurrent writers of the same file never share it (the last rename wins).
+    ## fsync: flush to disk before the rename (compacted snapshots and exports)
+    with tempfile.NamedTemporaryFile('w', encoding='UTF-8', dir=os.path.dirname(file_path) or '.', prefix=os.path.basename(file_path) + '.', suffix='.tmp', delete=False) as f:
+        temp_file_path = f.name
+        try:
+            json.dump(save_json, f, indent=2, ensure_ascii=False)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.remove(temp_file_path)
+            raise
+    os.replace(temp_file_path, file_path)
 
 def read_jsonl(file_path):
     with open(file_path, 'r', encoding='UTF-8') as f:
@@ -70,6 +100,121 @@ def save_txt(txt, file_path):
     with open(file_path, 'w', encoding='UTF-8') as f:
         f.write(txt)
 
+#### Output store ####
+class ShardedStore:
+    """ Output store with one JSON file per example and an index (index.json: example_id -> file name).
+    Only the index is kept in memory; find() reads one example and save() writes one example,
+    so memory and save cost depend on one story, not on the dataset size.
+    export() reproduces the monolithic gen_*.json / eval_*.json.
+    Parameters
+    ----------
+    shard_dir : str
+        directory of the shards (e.g. ./outputs/generation/gen_d_..._c_....shards)
+    out_dataset : list
+        (optional) examples to import if they are not in the store yet
+    """
+    def __init__(self, shard_dir, out_dataset=None):
+        self.shard_dir = shard_dir
+        self.index_path = os.path.join(shard_dir, 'index.json')
+        self._lock = threading.Lock()
+        os.makedirs(shard_dir, exist_ok=True)
+        
+        self.index = {}
+        if os.path.exists(self.index_path):
+            self.index = read_json(self.index_path)
+        
+        imported_n = 0
+        for data in out_dataset or []:
+            if data['example_id'] not in self.index:
+                self.save(data, persist_index=False)
+                imported_n += 1
+        if imported_n > 0:
+            self.persist_index()
+    
+    def shard_file_name(self, example_id):
+        file_name = re.sub(r'[^A-Za-z0-9._-]', '_', str(example_id))
+        if file_name != str(example_id):
+            file_name += '_' + hashlib.sha1(str(example_id).encode('utf-8')).hexdigest()[:8]
+        return file_name + '.json'
+    
+    def find(self, example_id):
+        if example_id not in self.index:
+            return None
+        return read_json(os.path.join(self.shard_dir, self.index[example_id]))
+    
+    def save(self, data, persist_index=True):
+        """ Write the shard of the example. The index is rewritten only when the example is new.
+        """
+        example_id = data['example_id']
+        with self._lock:
+            is_new = example_id not in self.index
+            if is_new:
+                self.index[example_id] = self.shard_file_name(example_id)
+        
+        save_json(data, os.path.join(self.shard_dir, self.index[example_id]))
+        
+        if is_new and persist_index:
+            self.persist_index()
+    
+    def persist_index(self, fsync=False):
+        with self._lock:
+            save_json(self.index, self.index_path, fsync=fsync)
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def __iter__(self):
+        for example_id in list(self.index):
+            yield self.find(example_id)
+    
+    def export(self, file_path):
+        """ Write every example to one JSON file, in the same format as save_json(list, file_path).
+        Examples are streamed one at a time, and the file is flushed to disk before the rename.
+        """
+        with tempfile.NamedTemporaryFile('w', encoding='UTF-8', dir=os.path.dirname(file_path) or '.', prefix=os.path.basename(file_path) + '.', suffix='.tmp', delete=False) as f:
+            temp_file_path = f.name
+            if len(self) == 0:
+                f.write('[]')
+            else:
+                f.write('[\n')
+                for i, data in enumerate(self):
+                    f.write(textwrap.indent(json.dumps(data, indent=2, ensure_ascii=False), '  '))
+                    f.write(',\n' if i < len(self) - 1 else '\n')
+                f.write(']')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file_path, file_path)
+    
+    def close(self):
+        """ Flush the index to disk (shards and the index are written on save(), without fsync).
+        """
+        self.persist_index(fsync=True)
+
+def load_dataset(path):
+    """ Load generated/evaluated data: a shard directory (ShardedStore) or a monolithic JSON file (list).
+    """
+    if os.path.isdir(path):
+        return ShardedStore(path)
+    return read_json(path)
+
+def dataset_example_ids(dataset):
+    if isinstance(dataset, ShardedStore):
+        return list(dataset.index)
+    return [data['example_id'] for data in dataset]
+
+def find_example(dataset, example_id):
+    """ Find the example in a list, a dict (example_id -> data) or a store (ShardedStore / CheckpointStore). None if not found.
+    """
+    if hasattr(dataset, 'find'):
+        return dataset.find(example_id)
+    if isinstance(dataset, dict):
+        return dataset.get(example_id)
+    for data in dataset:
+        if data['example_id'] == example_id:
+            return data
+    return None
+
+
 #### LLM calls ####
 def preprocess_llm_response(response):
     pattern_json = r'```json\s*(.*?)\s*```'
@@ -107,107 +252,1184 @@ def preprocess_llm_response(response):
     except:
         return '\n'.join([l for l in response.splitlines() if "```" not in l]).strip()
 
-def run_gpt(user_prompt, developer_prompt, model='gpt-4o-mini-2024-07-18', temperature=1):
-    logger.debug(f"\nmodel: {model}\n===developer_prompt===\n{developer_prompt}\n===user_prompt===\n{user_prompt}")
+#### LLM providers ####
+## provider -> API key environment variable and base URL
+LLM_PROVIDERS = {
+    'openai': {'api_key_env': 'OPENAI_API_KEY', 'base_url': None},
+    'deepseek': {'api_key_env': 'DEEPSEEK_API_KEY', 'base_url': 'https://api.deepseek.com'},
+    'gemini': {'api_key_env': 'GOOGLE_API_KEY', 'base_url': None},
+}
+
+## Explicit model -> provider routing. Dated snapshots are resolved by MODEL_PROVIDER_PREFIXES.
+MODEL_PROVIDERS = {
+    'gpt-4o': 'openai',
+    'gpt-4o-mini': 'openai',
+    'gpt-4o-2024-11-20': 'openai',
+    'gpt-4o-mini-2024-07-18': 'openai',
+    'deepseek-chat': 'deepseek',
+    'deepseek-reasoner': 'deepseek',
+    'gemini-2.0-flash': 'gemini',
+    'gemini-1.5-pro': 'gemini',
+    'gemini-1.5-flash': 'gemini',
+}
+MODEL_PROVIDER_PREFIXES = [
+    ('gpt-', 'openai'),
+    ('deepseek-', 'deepseek'),
+    ('gemini-', 'gemini'),
+]
+
+LLM_TIMEOUT = 60.0
+LLM_MAX_CONNECTIONS = 64
+LLM_MAX_KEEPALIVE_CONNECTIONS = 32
+LLM_KEEPALIVE_EXPIRY = 120.0
+
+## Provider-specific sampling parameters sent with every call
+LLM_SAMPLING_PARAMS = {
+    'openai': {},
+    'deepseek': {},
+    'gemini': {'top_p': 0.95, 'frequency_penalty': 0.23, 'presence_penalty': 0.23},
+}
+
+## Maximum number of in-flight calls per provider and per model (model limits are optional)
+LLM_PROVIDER_CONCURRENCY = {
+    'openai': 16,
+    'deepseek': 16,
+    'gemini': 16,
+}
+LLM_MODEL_CONCURRENCY = {}
+
+_llm_client_pool = {}
+_llm_client_pool_lock = threading.Lock()
+
+_llm_loop = None
+_llm_loop_lock = threading.Lock()
+_llm_semaphores = {}
+
+def register_model(model, provider):
+    """ Route a model card to a provider.
+    Parameters
+    ----------
+    model : str
+            model card (e.g. gpt-4o-2024-11-20)
+    provider : str
+            one of LLM_PROVIDERS
+    """
+    if provider not in LLM_PROVIDERS:
+        raise KeyError(f"Unknown provider: {provider}")
+    MODEL_PROVIDERS[model] = provider
+
+def resolve_model_provider(model):
+    """ Return the provider serving the given model card.
+    Parameters
+    ----------
+    model : str
+            model card
+    """
+    if model in MODEL_PROVIDERS:
+        return MODEL_PROVIDERS[model]
     
-    client = OpenAI(api_key=os.environ['OPENAI_API_KEY'], timeout=60.0)
+    for prefix, provider in MODEL_PROVIDER_PREFIXES:
+        if model.startswith(prefix):
+            return provider
     
-    wait_time = 2
-    completion = None
-    while completion is None:
-        wait_time = wait_time * 2
-        
-        try:
-            completion = client.chat.completions.create(
-                model=model,
-                temperature=temperature,
-                messages=[
-                    {"role": "developer", "content": developer_prompt},
-                    {"role": "user", "content": user_prompt}
-                ]
-            )
+    logger.error(f"Invalid model card: {model}")
+    raise KeyError(f"Invalid model card: {model}")
+
+def set_llm_concurrency(limit, provider=None, model=None):
+    """ Set the maximum number of in-flight calls for a provider or a model.
+    Takes effect for calls issued afterwards.
+    Parameters
+    ----------
+    limit : int
+            maximum in-flight calls (None removes a model limit)
+    provider : str
+            provider to limit
+    model : str
+            model card to limit
+    """
+    if model is not None:
+        if limit is None:
+            LLM_MODEL_CONCURRENCY.pop(model, None)
+        else:
+            LLM_MODEL_CONCURRENCY[model] = limit
+    elif provider is not None:
+        if provider not in LLM_PROVIDERS:
+            raise KeyError(f"Unknown provider: {provider}")
+        LLM_PROVIDER_CONCURRENCY[provider] = limit
+    else:
+        raise ValueError('Either provider or model should be given.')
+
+def _create_llm_client(provider, api_key, base_url):
+    if provider == 'gemini':
+        return genai.Client(api_key=api_key).aio
+    
+    http_client = openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY))
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=LLM_TIMEOUT, http_client=http_client)
+
+def get_llm_client(provider):
+    """ Return the long-lived async client of the provider.
+    One client (and its connection pool) is kept per (provider, API key, base URL).
+    The clients are bound to the LLM event loop (see get_llm_event_loop).
+    Parameters
+    ----------
+    provider : str
+            one of LLM_PROVIDERS
+    """
+    provider_config = LLM_PROVIDERS[provider]
+    api_key = os.environ[provider_config['api_key_env']]
+    base_url = provider_config['base_url']
+    
+    pool_key = (provider, api_key, base_url)
+    with _llm_client_pool_lock:
+        if pool_key not in _llm_client_pool:
+            logger.debug(f"Creating {provider} client (base_url: {base_url})")
+            _llm_client_pool[pool_key] = _create_llm_client(provider, api_key, base_url)
+        return _llm_client_pool[pool_key]
+
+def get_llm_event_loop():
+    """ Return the background event loop which runs every LLM call of the process.
+    Sync and async callers share this loop, so the pooled clients, concurrency limits
+    and connections are shared by every thread.
+    """
+    global _llm_loop
+    with _llm_loop_lock:
+        if _llm_loop is None or _llm_loop.is_closed():
+            loop = asyncio.new_event_loop()
+            loop_thread = threading.Thread(target=loop.run_forever, name='llm-event-loop', daemon=True)
+            loop_thread.start()
+            _llm_loop = loop
+        return _llm_loop
+
+def _get_llm_semaphore(key, limit):
+    semaphore, semaphore_limit = _llm_semaphores.get(key, (None, None))
+    if semaphore is None or semaphore_limit != limit:
+        semaphore = asyncio.Semaphore(limit)
+        _llm_semaphores[key] = (semaphore, limit)
+    return semaphore
+
+async def _stream_chat_completion(client, stream_parser, **kwargs):
+    """ Stream an OpenAI-compatible chat completion, feeding each delta to stream_parser.
+    The stream is closed (generation stops) as soon as stream_parser.feed returns True.
+    """
+    stream = await client.chat.completions.create(stream=True, stream_options={'include_usage': True}, **kwargs)
+    
+    response = None
+    usage = {'prompt_tokens': None, 'completion_tokens': None}
+    try:
+        async for chunk in stream:
+            if chunk.usage:
+                usage = {'prompt_tokens': chunk.usage.prompt_tokens, 'completion_tokens': chunk.usage.completion_tokens}
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            
+            delta = chunk.choices[0].delta.content
+            response = delta if response is None else response + delta
+            if stream_parser.feed(delta):
+                logger.debug('Stream cut off: required fields are parsed.')
+                break
+    finally:
+        await stream.close()
+    
+    return response, usage
+
+async def run_gpt_async(user_prompt, developer_prompt, model='gpt-4o-mini-2024-07-18', temperature=1, stream_parser=None):
+    client = get_llm_client('openai')
+    messages = [
+        {"role": "developer", "content": developer_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    
+    if stream_parser is not None:
+        return await _stream_chat_completion(client, stream_parser, model=model, temperature=temperature, messages=messages)
+    
+    completion = await client.chat.completions.create(
+        model=model,
+        temperature=temperature,
+        messages=messages
+    )
+    
+    usage = {
+        'prompt_tokens': completion.usage.prompt_tokens if completion.usage else None,
+        'completion_tokens': completion.usage.completion_tokens if completion.usage else None,
+    }
+    return completion.choices[0].message.content, usage
             
-            gpt_response = completion.choices[0].message.content
-            logger.debug(f"\n===response===\n{gpt_response}")
-            return preprocess_llm_response(gpt_response)
-        
-        except openai.APITimeoutError as e:
-            logger.warning(f"OpenAI API returned an API Error: {e}; waiting for {wait_time} seconds")
-            time.sleep(wait_time)
-        except openai.APIError as e:
-            logger.warning(f"OpenAI API returned an API Error: {e}; waiting for {wait_time} seconds")
-            time.sleep(wait_time)
-        except openai.APIConnectionError as e:
-            logger.warning(f"Failed to connect to OpenAI API: {e}; waiting for {wait_time} seconds")
-            time.sleep(wait_time)
+async def run_deepseek_async(user_prompt, system_prompt, model='deepseek-chat', temperature=1, stream_parser=None):
+    client = get_llm_client('deepseek')
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    
+    if stream_parser is not None:
+        return await _stream_chat_completion(client, stream_parser, model=model, temperature=temperature, messages=messages)
+    
+    completion = await client.chat.completions.create(
+        model=model,
+        temperature=temperature,
+        messages=messages,
+        stream=False
+    )
+    
+    usage = {
+        'prompt_tokens': completion.usage.prompt_tokens if completion.usage else None,
+        'completion_tokens': completion.usage.completion_tokens if completion.usage else None,
+    }
+    return completion.choices[0].message.content, usage
             
-def run_deepseek(user_prompt, system_prompt, model='deepseek-chat', temperature=1):
-    logger.debug(f"\nmodel: {model}\n===system_prompt===\n{system_prompt}\n===user_prompt===\n{user_prompt}")
+async def run_gemini_async(user_prompt, system_prompt, model="gemini-2.0-flash", temperature=1, stream_parser=None):
+    client = get_llm_client('gemini')
+    config = types.GenerateContentConfig(
+        system_instruction=system_prompt,
+        temperature=temperature,
+        **LLM_SAMPLING_PARAMS['gemini'])
+    
+    if stream_parser is not None:
+        response = None
+        usage_metadata = None
+        stream = await client.models.generate_content_stream(model=model, config=config, contents=user_prompt)
+        try:
+            async for chunk in stream:
+                if chunk.usage_metadata:
+                    usage_metadata = chunk.usage_metadata
+                if not chunk.text:
+                    continue
+                
+                response = chunk.text if response is None else response + chunk.text
+                if stream_parser.feed(chunk.text):
+                    logger.debug('Stream cut off: required fields are parsed.')
+                    break
+        finally:
+            await stream.aclose()
+    else:
+        generated = await client.models.generate_content(model=model, config=config, contents=user_prompt)
+        response = generated.text
+        usage_metadata = generated.usage_metadata
+    
+    usage = {
+        'prompt_tokens': usage_metadata.prompt_token_count if usage_metadata else None,
+        'completion_tokens': usage_metadata.candidates_token_count if usage_metadata else None,
+    }
+    return response, usage
+
+LLM_PROVIDER_NAMES = {
+    'openai': 'OpenAI',
+    'deepseek': 'DeepSeek',
+    'gemini': 'Gemini',
+}
+
+
+#### LLM response cache ####
+LLM_CACHE_MODES = ['readwrite', 'readonly', 'bypass']
+LLM_CACHE_MODE = os.environ.get('LLM_CACHE_MODE', 'bypass')
+LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH', os.path.join('.', 'cache', 'llm_cache.sqlite'))
+LLM_CACHE_MAX_BYTES = int(os.environ.get('LLM_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+LLM_CACHE_MAX_AGE_DAYS = float(os.environ.get('LLM_CACHE_MAX_AGE_DAYS', 30))
+LLM_CACHE_EVICTION_INTERVAL = 100
+
+def hash_llm_request(model, system_prompt, user_prompt, temperature, sampling_params):
+    request = json.dumps([model, system_prompt, user_prompt, temperature, sampling_params], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+class LLMResponseCache:
+    """ Content-addressed LLM response cache backed by SQLite.
+    Key: hash of (model, system prompt, user prompt, temperature, sampling params, occurrence).
+    The occurrence is the number of identical requests issued before with the same call tags
+    (example_id, agent, phase, part, act, turn, ...), so a retry of the same prompt is cached as a separate sample.
+    The count does not depend on the other stories running concurrently (--workers, --pipeline)
+    or on the turns skipped by a resumed run, so a resumed run replays the samples in the same order.
+    Modes: readwrite, readonly (replay without writing), bypass (no cache).
+    Entries are evicted by age and by total size in LRU order.
+    """
+    def __init__(self, path, mode='readwrite', max_bytes=LLM_CACHE_MAX_BYTES, max_age_days=LLM_CACHE_MAX_AGE_DAYS):
+        if mode not in LLM_CACHE_MODES:
+            raise ValueError(f"Unknown LLM cache mode: {mode} (available: {LLM_CACHE_MODES})")
+        
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.stats = {'hit': 0, 'miss': 0, 'write': 0, 'evict': 0}
+        self._occurrences = {}
+        self._writes_since_eviction = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        
+        if mode != 'bypass':
+            cache_dir = os.path.dirname(path)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS llm_cache ('
+                'key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, '
+                'created_at REAL, last_access REAL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache (last_access)')
+            self._conn.commit()
+            self.evict()
     
-    client = OpenAI(api_key=os.environ['DEEPSEEK_API_KEY'], base_url="https://api.deepseek.com", timeout=60.0)
+    def build_key(self, model, system_prompt, user_prompt, temperature, sampling_params, scope=None):
+        """ scope: the call tags the occurrence is counted within (llm_occurrence_scope)
+        """
+        request_hash = hash_llm_request(model, system_prompt, user_prompt, temperature, sampling_params)
+        with self._lock:
+            occurrence = self._occurrences.get((request_hash, scope), 0)
+            self._occurrences[(request_hash, scope)] = occurrence + 1
+        return f'{request_hash}:{occurrence}'
     
-    wait_time = 2
-    completion = None
-    while completion is None:
-        wait_time = wait_time * 2
+    def get(self, key):
+        if self.mode == 'bypass':
+            return None
         
-        try:
-            completion = client.chat.completions.create(
-                model=model,
-                temperature=temperature,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                stream=False
-            )
+        with self._lock:
+            row = self._conn.execute('SELECT response FROM llm_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.stats['miss'] += 1
+                return None
             
-            deepseek_response = completion.choices[0].message.content
-            logger.debug(f"\n===response===\n{deepseek_response}")
-            return preprocess_llm_response(deepseek_response)
+            self._conn.execute('UPDATE llm_cache SET last_access = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+            self.stats['hit'] += 1
+            return row[0]
+    
+    def put(self, key, model, response):
+        if self.mode != 'readwrite' or response is None:
+            return
+        
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO llm_cache (key, model, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, model, response, len(response.encode('utf-8')), now, now))
+            self._conn.commit()
+            self.stats['write'] += 1
+            self._writes_since_eviction += 1
+        
+        if self._writes_since_eviction >= LLM_CACHE_EVICTION_INTERVAL:
+            self.evict()
+    
+    def evict(self):
+        if self.mode != 'readwrite':
+            return
         
+        with self._lock:
+            self._writes_since_eviction = 0
+            
+            expired = self._conn.execute('DELETE FROM llm_cache WHERE last_access < ?', (time.time() - self.max_age_seconds,)).rowcount
+            self.stats['evict'] += max(expired, 0)
+            
+            total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0]
+            if total_bytes > self.max_bytes:
+                evict_keys = []
+                for key, size in self._conn.execute('SELECT key, size FROM llm_cache ORDER BY last_access ASC'):
+                    if total_bytes <= self.max_bytes:
+                        break
+                    evict_keys.append((key,))
+                    total_bytes -= size
+                self._conn.executemany('DELETE FROM llm_cache WHERE key = ?', evict_keys)
+                self.stats['evict'] += len(evict_keys)
+            
+            self._conn.commit()
+    
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+_llm_cache = None
+
+def configure_llm_cache(mode=None, path=None, max_bytes=None, max_age_days=None):
+    """ (Re)configure the LLM response cache used by run_llm / run_llm_async.
+    Parameters
+    ----------
+    mode : str
+            readwrite / readonly / bypass (default: LLM_CACHE_MODE)
+    path : str
+            SQLite file path (default: LLM_CACHE_PATH)
+    """
+    global _llm_cache
+    if _llm_cache is not None:
+        _llm_cache.close()
+    
+    _llm_cache = LLMResponseCache(
+        path=path or LLM_CACHE_PATH,
+        mode=mode or LLM_CACHE_MODE,
+        max_bytes=max_bytes or LLM_CACHE_MAX_BYTES,
+        max_age_days=max_age_days or LLM_CACHE_MAX_AGE_DAYS)
+    logger.debug(f"LLM cache mode: {_llm_cache.mode} ({_llm_cache.path})")
+    return _llm_cache
+
+def get_llm_cache():
+    if _llm_cache is None:
+        configure_llm_cache()
+    return _llm_cache
+
+def get_llm_cache_stats():
+    return dict(get_llm_cache().stats)
+
+
+#### LLM rate limiter ####
+## Requests-per-minute / tokens-per-minute budgets. Keys are model cards or provider names.
+## e.g. LLM_RATE_LIMITS='{"gemini-2.0-flash": {"rpm": 2000, "tpm": 4000000}, "openai": {"rpm": 500}}'
+LLM_RATE_LIMITS = json.loads(os.environ.get('LLM_RATE_LIMITS', '{}'))
+
+_llm_token_encoder = None
+
+def count_prompt_tokens(*texts):
+    """ Estimate the number of tokens of the given prompts with tiktoken (o200k_base).
+    """
+    global _llm_token_encoder
+    if _llm_token_encoder is None:
+        try:
+            _llm_token_encoder = tiktoken.encoding_for_model('gpt-4o')
         except Exception as e:
-            logger.warning(f"DeepSeek API returned an API Error: {e}; waiting for {wait_time} seconds")
-            time.sleep(wait_time)
+            logger.warning(f"Could not load tiktoken encoding: {e}; estimating tokens by characters")
+            _llm_token_encoder = False
+    
+    if _llm_token_encoder is False:
+        return sum(len(text) // 4 for text in texts if text)
+    return sum(len(_llm_token_encoder.encode(text, disallowed_special=())) for text in texts if text)
+
+def extract_retry_after(error):
+    """ Return the Retry-After delay (seconds) of an API error, or None if the provider did not send one.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms is not None:
+        try:
+            return max(0.0, float(retry_after_ms) / 1000)
+        except ValueError:
+            pass
+    
+    retry_after = headers.get('retry-after')
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except Exception:
+            return None
+
+class TokenBucket:
+    """ Token bucket refilled continuously at capacity-per-minute.
+    """
+    def __init__(self, capacity_per_minute):
+        self.capacity = float(capacity_per_minute)
+        self.tokens = self.capacity
+        self.refill_rate = self.capacity / 60
+        self.updated_at = time.monotonic()
+    
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+    
+    def wait_time(self, amount, now):
+        self._refill(now)
+        ## Requests larger than the whole budget are let through once the bucket is full.
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_rate
+    
+    def consume(self, amount, now):
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+    
+    def refund(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class LLMRateLimiter:
+    """ Shared RPM/TPM scheduler for every LLM call.
+    A call waits until the request and token budgets of both its provider and its model
+    have room, so calls are spread under the quota instead of failing with 429s.
+    Runs on the LLM event loop only.
+    """
+    def __init__(self, rate_limits):
+        self.rate_limits = rate_limits
+        self.buckets = {}
+        self.blocked_until = {}
+    
+    def _get_buckets(self, provider, model):
+        buckets = []
+        for key in (provider, model):
+            if key not in self.buckets:
+                limit = self.rate_limits.get(key)
+                if not limit:
+                    continue
+                self.buckets[key] = {
+                    'rpm': TokenBucket(limit['rpm']) if limit.get('rpm') else None,
+                    'tpm': TokenBucket(limit['tpm']) if limit.get('tpm') else None,
+                }
+            buckets.append(self.buckets[key])
+        return buckets
+    
+    async def acquire(self, provider, model, estimated_tokens):
+        buckets = self._get_buckets(provider, model)
+        
+        while True:
+            now = time.monotonic()
+            wait = 0.0
+            for key in (provider, model):
+                wait = max(wait, self.blocked_until.get(key, 0.0) - now)
+            for bucket in buckets:
+                if bucket['rpm'] is not None:
+                    wait = max(wait, bucket['rpm'].wait_time(1, now))
+                if bucket['tpm'] is not None:
+                    wait = max(wait, bucket['tpm'].wait_time(estimated_tokens, now))
             
-def run_gemini(user_prompt, system_prompt, model="gemini-2.0-flash", temperature=1):
-    logger.debug(f"\nmodel: {model}\n===system_prompt===\n{system_prompt}\n===user_prompt===\n{user_prompt}")
+            if wait <= 0:
+                for bucket in buckets:
+                    if bucket['rpm'] is not None:
+                        bucket['rpm'].consume(1, now)
+                    if bucket['tpm'] is not None:
+                        bucket['tpm'].consume(estimated_tokens, now)
+                return
+            
+            logger.debug(f"Rate limit ({model}): waiting for {wait:.2f} seconds")
+            await asyncio.sleep(wait)
     
-    client = genai.Client(api_key=os.environ['GOOGLE_API_KEY'])
+    def record_usage(self, provider, model, estimated_tokens, usage):
+        """ Reconcile the reserved prompt tokens with the tokens actually billed.
+        """
+        actual_tokens = (usage.get('prompt_tokens') or estimated_tokens) + (usage.get('completion_tokens') or 0)
+        now = time.monotonic()
+        for bucket in self._get_buckets(provider, model):
+            if bucket['tpm'] is None:
+                continue
+            if actual_tokens >= estimated_tokens:
+                bucket['tpm'].consume(actual_tokens - estimated_tokens, now)
+            else:
+                bucket['tpm'].refund(estimated_tokens - actual_tokens)
     
-    wait_time = 2
-    response = None
-    while response is None:
-        wait_time = wait_time * 2
+    def penalize(self, provider, model, retry_after):
+        """ Hold every call of the provider/model for the Retry-After delay sent by the provider.
+        """
+        blocked_until = time.monotonic() + retry_after
+        for key in (provider, model):
+            self.blocked_until[key] = max(self.blocked_until.get(key, 0.0), blocked_until)
+
+_llm_rate_limiter = LLMRateLimiter(LLM_RATE_LIMITS)
+
+def set_llm_rate_limit(key, rpm=None, tpm=None):
+    """ Set the RPM/TPM budgets of a provider or a model card.
+    """
+    LLM_RATE_LIMITS[key] = {'rpm': rpm, 'tpm': tpm}
+    _llm_rate_limiter.buckets.pop(key, None)
+
+
+#### LLM retry policy ####
+class LLMCallError(Exception):
+    """ An LLM call failed permanently (fatal error or retry budget exhausted). """
+
+class LLMCircuitOpenError(LLMCallError):
+    """ The provider's circuit breaker is open; the call was not sent. """
+
+class LLMEmptyResponseError(Exception):
+    """ The provider answered without any text (e.g. blocked candidate). """
+
+## HTTP status codes worth retrying (others such as 400/401/403/404/422 are fatal)
+LLM_RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+class LLMRetryPolicy:
+    """ Bounded retries with full-jitter exponential backoff.
+    Errors are classified as
+        rate_limit  : 429 (retried, honoring Retry-After)
+        unavailable : timeouts, connection errors, 5xx (retried, counted by the circuit breaker)
+        retryable   : other transient failures such as empty responses (retried)
+        fatal       : invalid requests, authentication, context too long, programming errors (raised immediately)
+    """
+    def __init__(self, max_attempts=6, base_delay=2.0, max_delay=60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+    
+    def classify(self, error):
+        if isinstance(error, LLMEmptyResponseError):
+            return 'retryable'
+        if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, httpx.TimeoutException, httpx.TransportError, asyncio.TimeoutError, ConnectionError)):
+            return 'unavailable'
         
-        try:
-            response = client.models.generate_content(
-                model="gemini-2.0-flash",
-                config=types.GenerateContentConfig(
-                    system_instruction=system_prompt,
-                    temperature=temperature,
-                    top_p=0.95,
-                    frequency_penalty=0.23,
-                    presence_penalty=0.23),
-                contents=user_prompt,
-            )
+        status_code = None
+        if isinstance(error, openai.APIStatusError):
+            status_code = error.status_code
+        elif isinstance(error, genai_errors.APIError):
+            status_code = error.code
+        elif isinstance(error, openai.APIError):
+            return 'retryable'
+        
+        if status_code is None:
+            return 'fatal'
+        if status_code == 429:
+            return 'rate_limit'
+        if status_code >= 500:
+            return 'unavailable'
+        if status_code in LLM_RETRYABLE_STATUS_CODES:
+            return 'retryable'
+        return 'fatal'
+
+class LLMCircuitBreaker:
+    """ Per-provider circuit breaker.
+    After failure_threshold consecutive 'unavailable' failures the circuit opens and calls fail fast
+    with LLMCircuitOpenError. After reset_timeout seconds one probe call is let through (half-open);
+    its success closes the circuit and its failure opens it again.
+    """
+    def __init__(self, provider, failure_threshold=5, reset_timeout=60.0):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failure_cnt = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+    
+    def before_call(self):
+        if self.state == 'open':
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise LLMCircuitOpenError(f"{LLM_PROVIDER_NAMES[self.provider]} API is unavailable (circuit open)")
+            self.state = 'half_open'
+            self.probe_in_flight = False
+        
+        if self.state == 'half_open':
+            if self.probe_in_flight:
+                raise LLMCircuitOpenError(f"{LLM_PROVIDER_NAMES[self.provider]} API is unavailable (circuit half-open, probing)")
+            self.probe_in_flight = True
+    
+    def record_success(self):
+        if self.state != 'closed':
+            logger.info(f"{LLM_PROVIDER_NAMES[self.provider]} API recovered. Closing the circuit.")
+        self.state = 'closed'
+        self.failure_cnt = 0
+        self.probe_in_flight = False
+    
+    def record_failure(self):
+        self.failure_cnt += 1
+        self.probe_in_flight = False
+        if self.state == 'half_open' or self.failure_cnt >= self.failure_threshold:
+            if self.state != 'open':
+                logger.error(f"{LLM_PROVIDER_NAMES[self.provider]} API looks down ({self.failure_cnt} consecutive failures). Opening the circuit for {self.reset_timeout} seconds.")
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+LLM_RETRY_POLICY = LLMRetryPolicy(
+    max_attempts=int(os.environ.get('LLM_MAX_ATTEMPTS', 6)),
+    base_delay=float(os.environ.get('LLM_BACKOFF_BASE', 2.0)),
+    max_delay=float(os.environ.get('LLM_BACKOFF_MAX', 60.0)))
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('LLM_CIRCUIT_FAILURE_THRESHOLD', 5))
+LLM_CIRCUIT_RESET_SECONDS = float(os.environ.get('LLM_CIRCUIT_RESET_SECONDS', 60.0))
+
+_llm_circuit_breakers = {}
+
+def get_llm_circuit_breaker(provider):
+    if provider not in _llm_circuit_breakers:
+        _llm_circuit_breakers[provider] = LLMCircuitBreaker(provider, LLM_CIRCUIT_FAILURE_THRESHOLD, LLM_CIRCUIT_RESET_SECONDS)
+    return _llm_circuit_breakers[provider]
+
+
+#### LLM backend (live / record / replay) ####
+LLM_BACKENDS = ['live', 'record', 'replay']
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'live')
+LLM_TRACE_PATH = os.environ.get('LLM_TRACE_PATH', os.path.join('.', 'cache', 'llm_trace.jsonl'))
+LLM_REPLAY_ORDERS = ['hash', 'order']
+LLM_REPLAY_ORDER = os.environ.get('LLM_REPLAY_ORDER', 'hash')
+LLM_REPLAY_LATENCY = os.environ.get('LLM_REPLAY_LATENCY', '0') == '1'
+
+class LLMReplayMissError(LLMCallError):
+    pass
+
+class LLMTrace:
+    """ Trace of LLM calls for deterministic offline runs and benchmarks.
+    record: every (prompt, response, latency) is appended to a JSONL trace file.
+    replay: responses are served from the trace without API calls, rate limits or retries.
+            by hash: matched by hash of the request and its occurrence within the call tags (same key as LLMResponseCache)
+            by order: served in the recorded order regardless of the request
+    Parameters
+    ----------
+    path : str
+            JSONL trace file path
+    backend : str
+            live / record / replay
+    replay_order : str
+            hash / order
+    replay_latency : bool
+            sleep the recorded latency before serving a replayed response
+    """
+    def __init__(self, path, backend='live', replay_order=LLM_REPLAY_ORDER, replay_latency=LLM_REPLAY_LATENCY):
+        if backend not in LLM_BACKENDS:
+            raise ValueError(f"Unknown LLM backend: {backend} (available: {LLM_BACKENDS})")
+        if replay_order not in LLM_REPLAY_ORDERS:
+            raise ValueError(f"Unknown LLM replay order: {replay_order} (available: {LLM_REPLAY_ORDERS})")
+        
+        self.path = path
+        self.backend = backend
+        self.replay_order = replay_order
+        self.replay_latency = replay_latency
+        self.stats = {'record': 0, 'replay': 0, 'miss': 0}
+        self._occurrences = {}
+        self._records = {}
+        self._ordered_records = []
+        self._next_record = 0
+        self._lock = threading.Lock()
+        self._file = None
+        
+        if backend == 'record':
+            trace_dir = os.path.dirname(path)
+            if trace_dir:
+                os.makedirs(trace_dir, exist_ok=True)
+            self._file = open(path, 'a', encoding='utf-8')
+        elif backend == 'replay':
+            for record in read_jsonl(path):
+                self._records[record['key']] = record
+                self._ordered_records.append(record)
+            logger.info(f"Loaded {len(self._ordered_records)} LLM calls from trace {path}")
+    
+    def build_key(self, model, system_prompt, user_prompt, temperature, sampling_params, scope=None):
+        """ scope: the call tags the occurrence is counted within (llm_occurrence_scope)
+        """
+        request_hash = hash_llm_request(model, system_prompt, user_prompt, temperature, sampling_params)
+        with self._lock:
+            occurrence = self._occurrences.get((request_hash, scope), 0)
+            self._occurrences[(request_hash, scope)] = occurrence + 1
+        return f'{request_hash}:{occurrence}'
+    
+    def record(self, key, model, system_prompt, user_prompt, temperature, response, latency, usage=None, cached=False):
+        if self.backend != 'record':
+            return
+        
+        record = {
+            'key': key,
+            'model': model,
+            'temperature': temperature,
+            'system_prompt': system_prompt,
+            'user_prompt': user_prompt,
+            'response': response,
+            'latency': latency,
+            'usage': usage,
+            'cached': cached,
+        }
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._file.flush()
+            self.stats['record'] += 1
+    
+    async def replay(self, key):
+        with self._lock:
+            if self.replay_order == 'order':
+                if self._next_record >= len(self._ordered_records):
+                    record = None
+                else:
+                    record = self._ordered_records[self._next_record]
+                    self._next_record += 1
+                    if record['key'] != key:
+                        logger.warning(f"Replayed LLM call {self._next_record} does not match the request (recorded: {record['key']}, requested: {key})")
+            else:
+                record = self._records.get(key)
             
-            gemini_response = response.text
-            logger.debug(f"\n===response===\n{gemini_response}")
-            return preprocess_llm_response(gemini_response)
+            if record is None:
+                self.stats['miss'] += 1
+            else:
+                self.stats['replay'] += 1
+        
+        if record is None:
+            raise LLMReplayMissError(f"LLM call not found in trace {self.path} (key: {key})")
+        
+        if self.replay_latency and record['latency']:
+            await asyncio.sleep(record['latency'])
+        return record['response']
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+_llm_trace = None
+
+def configure_llm_backend(backend=None, trace_path=None, replay_order=None, replay_latency=None):
+    """ (Re)configure the backend used by run_llm / run_llm_async.
+    Parameters
+    ----------
+    backend : str
+            live / record / replay (default: LLM_BACKEND)
+    trace_path : str
+            JSONL trace file path (default: LLM_TRACE_PATH)
+    replay_order : str
+            hash / order (default: LLM_REPLAY_ORDER)
+    replay_latency : bool
+            reproduce the recorded latencies in replay (default: LLM_REPLAY_LATENCY)
+    """
+    global _llm_trace
+    if _llm_trace is not None:
+        _llm_trace.close()
+    
+    _llm_trace = LLMTrace(
+        path=trace_path or LLM_TRACE_PATH,
+        backend=backend or LLM_BACKEND,
+        replay_order=replay_order or LLM_REPLAY_ORDER,
+        replay_latency=LLM_REPLAY_LATENCY if replay_latency is None else replay_latency)
+    logger.debug(f"LLM backend: {_llm_trace.backend} ({_llm_trace.path})")
+    return _llm_trace
+
+def get_llm_trace():
+    if _llm_trace is None:
+        configure_llm_backend()
+    return _llm_trace
+
+def get_llm_trace_stats():
+    return dict(get_llm_trace().stats)
+
+
+#### LLM telemetry ####
+## Tags of the LLM calls issued in the current context (agent, phase, example_id, part, act, turn,
+## chunk of an edited part or story, benchmark mode).
+llm_call_context = contextvars.ContextVar('llm_call_context', default={})
+
+LLM_METRICS_PATH = os.environ.get('LLM_METRICS_PATH', os.path.join(os.environ.get('LOG_DIR', '.'), 'llm_metrics.jsonl'))
+LLM_PROMETHEUS_PORT = int(os.environ.get('LLM_PROMETHEUS_PORT', 0))
+LLM_CALL_TAG_KEYS = ['agent', 'phase', 'example_id', 'part', 'act', 'turn', 'chunk', 'benchmark']
+
+## USD per 1M (prompt, completion) tokens. Model cards are matched by the longest prefix.
+LLM_PRICES = {
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'deepseek-chat': (0.27, 1.10),
+    'deepseek-reasoner': (0.55, 2.19),
+    'gemini-2.0-flash': (0.10, 0.40),
+}
+LLM_PRICES.update({model: tuple(price) for model, price in json.loads(os.environ.get('LLM_PRICES', '{}')).items()})
+
+@contextlib.contextmanager
+def llm_call_tags(**tags):
+    """ Tag every LLM call issued inside the with-block (e.g. example_id, part, agent).
+    """
+    token = llm_call_context.set({**llm_call_context.get(), **tags})
+    try:
+        yield
+    finally:
+        llm_call_context.reset(token)
+
+def set_llm_call_tags(**tags):
+    """ Tag the following LLM calls of the current context. Use inside an llm_call_tags block so that the tags are reset.
+    """
+    llm_call_context.set({**llm_call_context.get(), **tags})
+
+def estimate_llm_cost(model, prompt_tokens, completion_tokens):
+    price_models = [price_model for price_model in LLM_PRICES if model.startswith(price_model)]
+    if not price_models or prompt_tokens is None or completion_tokens is None:
+        return None
+    prompt_price, completion_price = LLM_PRICES[max(price_models, key=len)]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+class LLMMetrics:
+    """ Per-call LLM telemetry.
+    Every call is appended to a JSONL file with its tags (LLM_CALL_TAG_KEYS: agent, phase, example_id, part, act, turn,
+    chunk of the editor's chunk and seam smoothing calls, benchmark mode of benchmark_chunk_edit.py), wall time, queue wait (rate limiter + concurrency limits),
+    prompt/completion tokens, retry count and estimated cost, and aggregated by (agent, phase).
+    Optionally exported to Prometheus.
+    Parameters
+    ----------
+    path : str
+            JSONL metrics file path
+    prometheus_port : int
+            (optional) port of the Prometheus exporter. 0 disables the exporter.
+    """
+    def __init__(self, path, prometheus_port=0):
+        self.path = path
+        self.summary = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._prometheus = None
+        
+        if path:
+            metrics_dir = os.path.dirname(path)
+            if metrics_dir:
+                os.makedirs(metrics_dir, exist_ok=True)
+            self._file = open(path, 'a', encoding='utf-8')
+        
+        if prometheus_port:
+            if prometheus_client is None:
+                logger.warning('prometheus_client is not installed. Prometheus exporter is disabled.')
+            else:
+                self._prometheus = _get_llm_prometheus_metrics()
+                prometheus_client.start_http_server(prometheus_port)
+                logger.info(f"Exporting LLM metrics to Prometheus on port {prometheus_port}")
+    
+    def record(self, record):
+        agent, phase = record.get('agent') or 'unknown', record.get('phase') or 'unknown'
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                self._file.flush()
             
+            summary = self.summary.setdefault(f'{agent}/{phase}', {
+                'calls': 0, 'errors': 0, 'retries': 0, 'wall_time': 0.0, 'queue_wait': 0.0,
+                'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0})
+            summary['calls'] += 1
+            summary['errors'] += int(record['status'] == 'error')
+            summary['retries'] += record['retries']
+            summary['wall_time'] += record['wall_time']
+            summary['queue_wait'] += record['queue_wait']
+            summary['prompt_tokens'] += record['prompt_tokens'] or 0
+            summary['completion_tokens'] += record['completion_tokens'] or 0
+            summary['cost'] += record['cost'] or 0.0
+        
+        if self._prometheus is not None:
+            labels = {'agent': agent, 'phase': phase, 'model': record['model']}
+            self._prometheus['calls'].labels(status=record['status'], **labels).inc()
+            self._prometheus['wall_time'].labels(**labels).observe(record['wall_time'])
+            self._prometheus['queue_wait'].labels(**labels).observe(record['queue_wait'])
+            self._prometheus['retries'].labels(**labels).inc(record['retries'])
+            self._prometheus['tokens'].labels(kind='prompt', **labels).inc(record['prompt_tokens'] or 0)
+            self._prometheus['tokens'].labels(kind='completion', **labels).inc(record['completion_tokens'] or 0)
+            self._prometheus['cost'].labels(**labels).inc(record['cost'] or 0.0)
+    
+    def format_summary(self):
+        """ Table of the aggregated metrics by agent/phase, sorted by wall time.
+        """
+        lines = [f"{'agent/phase':<32}{'calls':>7}{'errors':>7}{'retries':>8}{'wall(s)':>10}{'wait(s)':>10}{'prompt_tok':>12}{'compl_tok':>11}{'cost($)':>10}"]
+        with self._lock:
+            for key, summary in sorted(self.summary.items(), key=lambda item: -item[1]['wall_time']):
+                lines.append(
+                    f"{key:<32}{summary['calls']:>7}{summary['errors']:>7}{summary['retries']:>8}{summary['wall_time']:>10.1f}{summary['queue_wait']:>10.1f}"
+                    f"{summary['prompt_tokens']:>12}{summary['completion_tokens']:>11}{summary['cost']:>10.4f}")
+        return '\n'.join(lines)
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+_llm_prometheus_metrics = None
+
+def _get_llm_prometheus_metrics():
+    ## Prometheus collectors can be registered only once per process.
+    global _llm_prometheus_metrics
+    if _llm_prometheus_metrics is None:
+        labels = ['agent', 'phase', 'model']
+        _llm_prometheus_metrics = {
+            'calls': prometheus_client.Counter('llm_calls', 'LLM calls', labels + ['status']),
+            'wall_time': prometheus_client.Histogram('llm_call_seconds', 'Wall time of LLM calls', labels),
+            'queue_wait': prometheus_client.Histogram('llm_queue_wait_seconds', 'Time LLM calls waited for rate and concurrency limits', labels),
+            'retries': prometheus_client.Counter('llm_retries', 'Retried LLM attempts', labels),
+            'tokens': prometheus_client.Counter('llm_tokens', 'LLM tokens', labels + ['kind']),
+            'cost': prometheus_client.Counter('llm_cost_usd', 'Estimated LLM cost in USD', labels),
+        }
+    return _llm_prometheus_metrics
+
+_llm_metrics = None
+
+def configure_llm_metrics(path=None, prometheus_port=None):
+    """ (Re)configure the telemetry of run_llm / run_llm_async.
+    Parameters
+    ----------
+    path : str
+            JSONL metrics file path (default: LLM_METRICS_PATH)
+    prometheus_port : int
+            Prometheus exporter port, 0 disables it (default: LLM_PROMETHEUS_PORT)
+    """
+    global _llm_metrics
+    if _llm_metrics is not None:
+        _llm_metrics.close()
+    
+    _llm_metrics = LLMMetrics(
+        path=path or LLM_METRICS_PATH,
+        prometheus_port=LLM_PROMETHEUS_PORT if prometheus_port is None else prometheus_port)
+    return _llm_metrics
+
+def get_llm_metrics():
+    if _llm_metrics is None:
+        configure_llm_metrics()
+    return _llm_metrics
+
+
+LLM_PROVIDER_RUNNERS = {
+    'openai': run_gpt_async,
+    'deepseek': run_deepseek_async,
+    'gemini': run_gemini_async,
+}
+
+async def _call_llm_provider(provider, user_prompt, system_prompt, model, temperature, stream_parser, call_metrics):
+    wait_start_time = time.monotonic()
+    provider_semaphore = _get_llm_semaphore(('provider', provider), LLM_PROVIDER_CONCURRENCY[provider])
+    async with provider_semaphore:
+        if model in LLM_MODEL_CONCURRENCY:
+            model_semaphore = _get_llm_semaphore(('model', model), LLM_MODEL_CONCURRENCY[model])
+            async with model_semaphore:
+                call_metrics['queue_wait'] += time.monotonic() - wait_start_time
+                return await LLM_PROVIDER_RUNNERS[provider](user_prompt, system_prompt, model, temperature, stream_parser=stream_parser)
+        call_metrics['queue_wait'] += time.monotonic() - wait_start_time
+        return await LLM_PROVIDER_RUNNERS[provider](user_prompt, system_prompt, model, temperature, stream_parser=stream_parser)
+
+async def _run_llm_on_loop(user_prompt, system_prompt, model, temperature, stream_parser_factory=None, tags=None):
+    call_metrics = {'status': 'ok', 'retries': 0, 'queue_wait': 0.0, 'prompt_tokens': None, 'completion_tokens': None}
+    call_start_time = time.time()
+    try:
+        return await _run_llm_call(user_prompt, system_prompt, model, temperature, stream_parser_factory, call_metrics, tags=tags)
+    except Exception as e:
+        call_metrics['status'] = 'error'
+        call_metrics['error'] = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        call_metrics['cost'] = estimate_llm_cost(model, call_metrics['prompt_tokens'], call_metrics['completion_tokens'])
+        get_llm_metrics().record({
+            'timestamp': call_start_time,
+            'model': model,
+            **{tag_key: (tags or {}).get(tag_key) for tag_key in LLM_CALL_TAG_KEYS},
+            'wall_time': time.time() - call_start_time,
+            **call_metrics})
+
+def llm_occurrence_scope(tags):
+    """ Scope of the occurrence count of identical requests (cache and trace keys): the call tags of one story's call site.
+    """
+    return tuple((tags or {}).get(tag_key) for tag_key in LLM_CALL_TAG_KEYS)
+
+async def _run_llm_call(user_prompt, system_prompt, model, temperature, stream_parser_factory, call_metrics, tags=None):
+    provider = resolve_model_provider(model)
+    sampling_params = dict(LLM_SAMPLING_PARAMS[provider])
+    if stream_parser_factory is not None:
+        ## Responses cut off early are only reused by calls with the same cut-off rule.
+        sampling_params['stream_cutoff'] = stream_parser_factory.__name__
+    
+    llm_trace = get_llm_trace()
+    trace_key = None
+    if llm_trace.backend != 'live':
+        trace_key = llm_trace.build_key(model, system_prompt, user_prompt, temperature, sampling_params, scope=llm_occurrence_scope(tags))
+    if llm_trace.backend == 'replay':
+        replayed_response = await llm_trace.replay(trace_key)
+        call_metrics['status'] = 'replayed'
+        logger.debug(f"\nmodel: {model}\n===replayed response===\n{replayed_response}")
+        return preprocess_llm_response(replayed_response)
+    
+    llm_cache = get_llm_cache()
+    cache_key = None
+    if llm_cache.mode != 'bypass':
+        cache_key = llm_cache.build_key(model, system_prompt, user_prompt, temperature, sampling_params, scope=llm_occurrence_scope(tags))
+        cached_response = llm_cache.get(cache_key)
+        if cached_response is not None:
+            logger.debug(f"\nmodel: {model}\n===cached response===\n{cached_response}")
+            llm_trace.record(trace_key, model, system_prompt, user_prompt, temperature, cached_response, latency=0.0, cached=True)
+            call_metrics['status'] = 'cached'
+            return preprocess_llm_response(cached_response)
+    
+    logger.debug(f"\nmodel: {model}\n===system_prompt===\n{system_prompt}\n===user_prompt===\n{user_prompt}")
+    
+    estimated_tokens = count_prompt_tokens(system_prompt, user_prompt)
+    provider_name = LLM_PROVIDER_NAMES[provider]
+    
+    circuit_breaker = get_llm_circuit_breaker(provider)
+    
+    attempt = 0
+    while True:
+        circuit_breaker.before_call()
+        wait_start_time = time.monotonic()
+        await _llm_rate_limiter.acquire(provider, model, estimated_tokens)
+        call_metrics['queue_wait'] += time.monotonic() - wait_start_time
+        try:
+            stream_parser = stream_parser_factory() if stream_parser_factory is not None else None
+            call_start_time = time.monotonic()
+            response, usage = await _call_llm_provider(provider, user_prompt, system_prompt, model, temperature, stream_parser, call_metrics)
+            latency = time.monotonic() - call_start_time
+            if response is None:
+                raise LLMEmptyResponseError(f"{provider_name} API returned an empty response")
         except Exception as e:
-            logger.warning(f"Gemini API returned an API Error: {e}; waiting for {wait_time} seconds")
-            time.sleep(wait_time)
+            error_kind = LLM_RETRY_POLICY.classify(e)
+            if error_kind == 'unavailable':
+                circuit_breaker.record_failure()
+            else:
+                circuit_breaker.record_success()
             
+            attempt += 1
+            if error_kind == 'fatal':
+                logger.error(f"{provider_name} API returned a non-retryable error: {e}")
+                raise LLMCallError(f"{provider_name} API returned a non-retryable error ({model}): {e}") from e
+            if attempt >= LLM_RETRY_POLICY.max_attempts:
+                logger.error(f"{provider_name} API failed {attempt} times. Giving up: {e}")
+                raise LLMCallError(f"{provider_name} API failed after {attempt} attempts ({model}): {e}") from e
             
-def run_llm(user_prompt, system_prompt='You are a helpful assistant.', model='gpt-4o-mini-2024-07-18', temperature=1.0):
-    if 'gpt' in model:
-        return run_gpt(user_prompt, system_prompt, model, temperature)
-    elif 'deepseek' in model:
-        return run_deepseek(user_prompt, system_prompt, model, temperature)
-    elif 'gemini' in model:
-        return run_gemini(user_prompt, system_prompt, model, temperature)
-    else:
-        logger.error(f"Invalid model card: {model}")
-        raise KeyError
\ No newline at end of file
+            call_metrics['retries'] = attempt
+            retry_after = extract_retry_after(e)
+            if retry_after is not None:
+                logger.warning(f"{provider_name} API returned an API Error: {e}; retrying after {retry_after} seconds (Retry-After, attempt {attempt}/{LLM_RETRY_POLICY.max_attempts})")
+                _llm_rate_limiter.penalize(provider, model, retry_after)
+            else:
+                wait_time = LLM_RETRY_POLICY.backoff(attempt)
+                logger.warning(f"{provider_name} API returned an API Error: {e}; waiting for {wait_time:.1f} seconds (attempt {attempt}/{LLM_RETRY_POLICY.max_attempts})")
+                await asyncio.sleep(wait_time)
+            continue
+        
+        circuit_breaker.record_success()
+        _llm_rate_limiter.record_usage(provider, model, estimated_tokens, usage)
+        call_metrics['prompt_tokens'] = usage['prompt_tokens'] if usage['prompt_tokens'] is not None else estimated_tokens
+        call_metrics['completion_tokens'] = usage['completion_tokens'] if usage['completion_tokens'] is not None else count_prompt_tokens(response)
+        break
+    
+    logger.debug(f"\n===response===\n{response}")
+    
+    if cache_key is not None:
+        llm_cache.put(cache_key, model, response)
+    llm_trace.record(trace_key, model, system_prompt, user_prompt, temperature, response, latency=latency, usage=usage)
+    
+    return preprocess_llm_response(response)
+
+async def run_llm_async(user_prompt, system_prompt='You are a helpful assistant.', model='gpt-4o-mini-2024-07-18', temperature=1.0, stream_parser_factory=None, tags=None):
+    """ Async twin of run_llm. Can be awaited from any event loop.
+    The call itself runs on the LLM event loop under the provider/model concurrency limits.
+    """
+    ## Context tags are captured here; they do not cross to the LLM event loop thread.
+    call_tags = {**llm_call_context.get(), **(tags or {})}
+    llm_loop = get_llm_event_loop()
+    llm_call = _run_llm_on_loop(user_prompt, system_prompt, model, temperature, stream_parser_factory, call_tags)
+    if asyncio.get_running_loop() is llm_loop:
+        return await llm_call
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(llm_call, llm_loop))
+
+def run_llm(user_prompt, system_prompt='You are a helpful assistant.', model='gpt-4o-mini-2024-07-18', temperature=1.0, stream_parser_factory=None, tags=None):
+    """ Run an LLM call and return the preprocessed response.
+    Parameters
+    ----------
+    stream_parser_factory : callable
+            (optional) returns a fresh incremental parser with feed(text_delta) -> bool.
+            The response is streamed into the parser and generation stops once feed returns True.
+    tags : dict
+            (optional) telemetry tags (e.g. {'agent': 'director', 'phase': 'turn'}), merged over llm_call_tags of the context
+    """
+    llm_loop = get_llm_event_loop()
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is llm_loop:
+        raise RuntimeError('run_llm cannot block the LLM event loop. Use run_llm_async instead.')
+    
+    call_tags = {**llm_call_context.get(), **(tags or {})}
+    return asyncio.run_coroutine_threadsafe(_run_llm_on_loop(user_prompt, system_prompt, model, temperature, stream_parser_factory, call_tags), llm_loop).result()
+
+def submit_llm(user_prompt, system_prompt='You are a helpful assistant.', model='gpt-4o-mini-2024-07-18', temperature=1.0, tags=None):
+    """ Start an LLM call without waiting for it.
+    Returns a concurrent.futures.Future of the preprocessed response (same as run_llm); result() re-raises LLMCallError.
+    """
+    call_tags = {**llm_call_context.get(), **(tags or {})}
+    return asyncio.run_coroutine_threadsafe(_run_llm_on_loop(user_prompt, system_prompt, model, temperature, None, call_tags), get_llm_event_loop())
+
+def run_coroutine_sync(coro):
+    """ Run a coroutine of concurrent LLM calls (e.g. asyncio.gather over run_llm_async) from synchronous code and return its result.
+    The coroutine runs on a private event loop of the calling thread and inherits its llm_call_tags.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    coro.close()
+    raise RuntimeError('run_coroutine_sync cannot block a running event loop. Await the coroutine instead.')
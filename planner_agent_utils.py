@@ -2,6 +2,7 @@ import sys
 sys.path.insert(0, '.')
 import logging
 import os
+import asyncio
 from global_utils import *
 from character_agent_utils import *
 from prompts.planner_agent_prompt import *
@@ -88,7 +89,7 @@ def generate_initial_setup(data, logger, args):
         
         init_setup_prompt = build_init_setup_prompt(story_prompt=story_prompt)
         
-        initital_setup_draft = run_llm(user_prompt=init_setup_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model)
+        initital_setup_draft = run_llm(user_prompt=init_setup_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model, tags={'agent': 'planner', 'phase': 'setup'})
         
         logger.debug(f"===initial_setup_draft===\n{initital_setup_draft}")
 
@@ -100,7 +101,7 @@ def generate_initial_setup(data, logger, args):
                 story_prompt=story_prompt,
                 initital_setup=initial_setup_edited)
 
-            init_setup_feedback = run_llm(user_prompt=init_setup_feedback_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model)
+            init_setup_feedback = run_llm(user_prompt=init_setup_feedback_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model, tags={'agent': 'planner', 'phase': 'setup'})
 
             logger.debug(f'===initial_setup_feedback_{feedback_n+1}===\n{init_setup_feedback}')
 
@@ -109,7 +110,7 @@ def generate_initial_setup(data, logger, args):
                 feedback=init_setup_feedback,
                 initital_setup=initial_setup_edited)
 
-            initial_setup_edit_response = run_llm(user_prompt=init_setup_edit_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model)
+            initial_setup_edit_response = run_llm(user_prompt=init_setup_edit_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model, tags={'agent': 'planner', 'phase': 'setup'})
 
             if 'No Change' in initial_setup_edit_response:
                 break
@@ -129,6 +130,65 @@ def generate_initial_setup(data, logger, args):
 def preprocess_character_profile(profile):
     return profile.replace('## Profile', '').strip()
 
+async def build_character_agent_async(character_agent_json, initial_setup, logger, args):
+    """ Build one character agent: its profile, then the summarized profile and the
+    character utility function from the character's viewpoint (both depend only on the profile).
+    Parameters
+    ----------
+    character_agent_json : json
+            character agent from the role classification (name, role). Updated in place.
+    initial_setup : str
+            Initial Setup text
+    """
+    name = character_agent_json['name']
+    role = character_agent_json['role']
+    if role == 'main':
+        profile_format = PROFILE_FORMAT_MAIN
+    elif role == 'villain':
+        profile_format = PROFILE_FORMAT_VILLAIN
+    elif role == 'side':
+        profile_format = PROFILE_FORMAT_SIDE
+    else:
+        logger.error(f"ERROR: Unexpected Role {role}")
+        raise ValueError
+        
+    init_character_agent_prompt = INIT_CHARACTER_AGENT_PROMPT.format(
+        name=name,
+        initital_setup=initial_setup,
+        profile_format=profile_format
+    )
+    
+    profile = await run_llm_async(user_prompt=init_character_agent_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model, tags={'agent': 'planner', 'phase': 'character_creation'})
+    profile = preprocess_character_profile(profile)
+    character_agent_json['profile'] = profile
+    
+    character_utility = extract_character_utility(initial_setup, name)
+
+    character_agent_json['character_utility'] = character_utility
+    
+    summarize_character_agent_prompt = SUMMARIZE_CHARACTER_AGENT_PROMPT.format(
+        name=name,
+        profile=profile
+    )
+    
+    ## Initialize Character Utility Function from the character's viewpoint, along with the summary.
+    summarized_profile, updated_character_utility = await asyncio.gather(
+        run_llm_async(user_prompt=summarize_character_agent_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model, tags={'agent': 'planner', 'phase': 'character_creation'}),
+        update_character_utility_async(
+            setup=initial_setup,
+            target_character_agent=character_agent_json,
+            story_progress_list=[],
+            args=args))
+    character_agent_json['summarized_profile'] = summarized_profile
+    character_agent_json['character_utility'] = updated_character_utility
+    
+    return character_agent_json
+
+async def build_character_agents_async(character_agent_list, initial_setup, logger, args):
+    return await asyncio.gather(*[
+        build_character_agent_async(character_agent_json, initial_setup, logger, args)
+        for character_agent_json in character_agent_list])
+
 def generate_character_agents(data, logger, args):
     
     character_agent_list = None
@@ -148,55 +208,12 @@ def generate_character_agents(data, logger, args):
         role_classification_prompt = ROLE_CLASSIFICATION_PROMPT.format(
             initital_setup=initial_setup)
         
-        character_agent_list = run_llm(user_prompt=role_classification_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model)
+        character_agent_list = run_llm(user_prompt=role_classification_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model, tags={'agent': 'planner', 'phase': 'character_creation'})
 
         logger.debug(f'===character_agent_classification===\n{character_agent_list}')
         
-        for character_agent_json in character_agent_list:
-            name = character_agent_json['name']
-            role = character_agent_json['role']
-            if role == 'main':
-                profile_format = PROFILE_FORMAT_MAIN
-            elif role == 'villain':
-                profile_format = PROFILE_FORMAT_VILLAIN
-            elif role == 'side':
-                profile_format = PROFILE_FORMAT_SIDE
-            else:
-                logger.error(f"ERROR: Unexpected Role {role}")
-                raise ValueError
-                
-            init_character_agent_prompt = INIT_CHARACTER_AGENT_PROMPT.format(
-                name=name,
-                initital_setup=initial_setup,
-                profile_format=profile_format
-            )
-            
-            profile = run_llm(user_prompt=init_character_agent_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model)
-            profile = preprocess_character_profile(profile)
-            character_agent_json['profile'] = profile
-            
-            character_utility = extract_character_utility(initial_setup, name)
-   
-            character_agent_json['character_utility'] = character_utility
-            
-            summarize_character_agent_prompt = SUMMARIZE_CHARACTER_AGENT_PROMPT.format(
-                name=name,
-                profile=profile
-            )
-            
-            summarized_profile = run_llm(user_prompt=summarize_character_agent_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model)
-            character_agent_json['summarized_profile'] = summarized_profile
-
-        ## Initialize Character Utility Functions from the each character's viewpoint.
-        for character_agent_json in character_agent_list:
-   
-            updated_character_utility = update_character_utility(
-                setup=initial_setup,
-                target_character_agent=character_agent_json,
-                story_progress_list=[],
-                args=args)
-
-            character_agent_json['character_utility'] = updated_character_utility
+        ## Per character: profile -> (summary || utility). Characters are built concurrently, in place and in order.
+        run_coroutine_sync(build_character_agents_async(character_agent_list, initial_setup, logger, args))
     
         ## Update Initial Setup accordingly
         updated_initial_setup = update_setup_character_utility(initial_setup, character_agent_list)
@@ -303,7 +320,7 @@ def generate_plan(data, logger, args):
             
             retry_n = 0
             while retry_n < MAX_RETRY:
-                plan_response = run_llm(user_prompt=plan_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model, temperature= 1 - (0.1 * retry_n))
+                plan_response = run_llm(user_prompt=plan_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model, temperature= 1 - (0.1 * retry_n), tags={'agent': 'planner', 'phase': 'plan'})
                 plan_response = validate_plan(plan_response)
                 
                 if plan_response == False:
@@ -339,7 +356,7 @@ def generate_plan(data, logger, args):
                 
                 retry_n = 0
                 while retry_n < MAX_RETRY:
-                    sequence_of_acts_response = run_llm(user_prompt=convert_narrative_utility_to_act_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model, temperature= 1 - (0.1 * retry_n))
+                    sequence_of_acts_response = run_llm(user_prompt=convert_narrative_utility_to_act_prompt, system_prompt=PLANNER_AGENT_SYSTEM_PROMPT, model=args.planner_agent_base_model, temperature= 1 - (0.1 * retry_n), tags={'agent': 'planner', 'phase': 'plan'})
                     
                     sequence_of_acts_response = validate_act_sequence(sequence_of_acts_response)
                     
@@ -243,6 +243,16 @@ The story is defined by the Setup, and has progressed as described in the Story
 {story_progress}
 '''.strip()
 
+ROLLING_SUMMARY_PROMPT = '''
+The story has progressed as described in the Summary So Far, followed by the New Story Progress. Update the Summary So Far with the events of the New Story Progress. Write the updated plot summary in a single paragraph under {max_words} words. Keep what is needed to continue the story: what each character did, where each character is, and what has changed.
+
+## Summary So Far
+{summary}
+
+## New Story Progress
+{story_progress}
+'''.strip()
+
 def build_beginning_prompt(setup, story_prompt, utility_narrative=None, current_act=None):
    plan_phrase = '**Narrative Goal**'
    if current_act is not None:
@@ -72,6 +72,23 @@ Edit the **Simulated Narrative** by selectively removing characters' inner thoug
     
     return final_prompt
 
+def build_smooth_seam(previous_passage, opening_passage):
+    final_prompt = f"""
+The **Opening Passage** directly follows the **Previous Passage** in a story. The two passages were edited separately, so the transition between them may be abrupt or repeat details.
+Edit the **Opening Passage** via the following steps:
+1. Make the Opening Passage continue smoothly from the Previous Passage. Remove details repeated from the Previous Passage and fix broken transitions.
+2. Keep the content, the format and the original voice. Keep speech wrapped within "...", action + emotion wrapped within *...*, and inner thoughts wrapped within [...]. Do not summarize. Do not omit any details.
+3. Output only the edited Opening Passage in natural language without any visible traces of editing, such as diff marks, annotations, or version control symbols.
+
+=== Previous Passage ===
+{previous_passage}
+
+=== Opening Passage ===
+{opening_passage}
+    """
+    
+    return final_prompt
+
 def build_feedback_narrative(story_segment, plan_segment, future_context, previous_context=None, plan_mode=False, is_last_part=False, act_seq_mode=False, is_last_act=False):
     edit_context_description, plan_description = build_edit_prompt_templetes(plan_mode, is_last_part, act_seq_mode, is_last_act, previous_context)
     
@@ -32,6 +32,19 @@ def parse_args():
     parser.add_argument('--evaluate-story-quality-ab', action='store_true')
     ## Base models of agents
     parser.add_argument('--evaluator-agent-base-model', type=str, default='None')
+    ## Output backend: monolithic (one eval_*.json) / sharded (one file per example + index, exported to eval_*.json at the end)
+    parser.add_argument('--output-backend', type=str, default='monolithic', choices=['monolithic', 'sharded'])
+    ## LLM response cache (readwrite / readonly / bypass; default: LLM_CACHE_MODE env)
+    parser.add_argument('--llm-cache-mode', type=str, default='None')
+    parser.add_argument('--llm-cache-path', type=str, default='None')
+    ## LLM backend (live / record / replay; default: LLM_BACKEND env)
+    parser.add_argument('--llm-backend', type=str, default='None')
+    parser.add_argument('--llm-trace-path', type=str, default='None')
+    parser.add_argument('--llm-replay-order', type=str, default='None')
+    parser.add_argument('--llm-replay-latency', action='store_true')
+    ## LLM telemetry (JSONL per call; Prometheus exporter port, 0: disabled)
+    parser.add_argument('--llm-metrics-path', type=str, default='None')
+    parser.add_argument('--llm-prometheus-port', type=int, default=0)
     
     args = parser.parse_args()
     
@@ -65,7 +78,21 @@ def log_evaluation_setting(logger, args):
     logger.info(f'What to Evaluate: {what_to_evaluate}')
     logger.info(f'Evaluator agent base model: {args.evaluator_agent_base_model}')
 
+def evaluation_save_path(args):
+    gen_data_file_name = args.data_file.rstrip('/').split('/')[-1]
+    save_file_name = gen_data_file_name.replace('gen', 'eval', 1)
+    if save_file_name.endswith('.shards'):
+        save_file_name = save_file_name[:-len('.shards')] + '.json'
+    return os.path.join(args.out_dir, save_file_name)
+
 def save_evaluation_result(in_data, out_dataset, logger, args):
+    save_path = evaluation_save_path(args)
+    
+    if isinstance(out_dataset, ShardedStore):
+        out_dataset.save(in_data)
+        logger.debug(f"===Saved {in_data['example_id']} to {out_dataset.shard_dir}===")
+        return save_path
+    
     if any(out_data['example_id'] == in_data['example_id'] for out_data in out_dataset):
         
         for i, out_data in enumerate(out_dataset):
@@ -76,10 +103,6 @@ def save_evaluation_result(in_data, out_dataset, logger, args):
         
         out_dataset.append(in_data)
     
-    gen_data_file_name = args.data_file.split('/')[-1]
-    save_file_name = gen_data_file_name.replace('gen', 'eval', 1)
-    save_path = os.path.join(args.out_dir, save_file_name)
-    
     save_json(out_dataset, save_path)
     logger.debug(f'===Saved {save_path}===')
     
@@ -272,7 +295,7 @@ def evaluate_plan_adherence(target_data, logger, args):
     retry_n = 0
     while retry_n < RETRY_N_MAX:
         evaluate_plan_adherence_prompt = build_plan_adherence_prompt(story, plan)
-        llm_response = run_llm(user_prompt=evaluate_plan_adherence_prompt, model=args.evaluator_agent_base_model, temperature=max(0, EVALUATOR_TEMP - retry_n*0.1))
+        llm_response = run_llm(user_prompt=evaluate_plan_adherence_prompt, model=args.evaluator_agent_base_model, temperature=max(0, EVALUATOR_TEMP - retry_n*0.1), tags={'agent': 'evaluator', 'phase': 'plan_adherence'})
         logger.debug(f"===Plan Adherence Response==={llm_response}")
         
         try:
@@ -305,7 +328,7 @@ def evaluate_plan_theory_adherence(target_data, logger, args):
     retry_n = 0
     while retry_n < RETRY_N_MAX:
         evaluate_plan_theory_adherence_prompt = build_plan_theory_adherence_prompt(story, plan_theory_text)
-        llm_response = run_llm(user_prompt=evaluate_plan_theory_adherence_prompt, model=args.evaluator_agent_base_model, temperature=max(0, EVALUATOR_TEMP - retry_n*0.1))
+        llm_response = run_llm(user_prompt=evaluate_plan_theory_adherence_prompt, model=args.evaluator_agent_base_model, temperature=max(0, EVALUATOR_TEMP - retry_n*0.1), tags={'agent': 'evaluator', 'phase': 'plan_theory_adherence'})
         logger.debug(f"===Plan Theory Adherence Response==={llm_response}")
         
         try:
@@ -345,14 +368,14 @@ def evaluate_story_ab(target_data_a, target_data_b, logger, args):
         prompt_ab = EVALUATE_STORY_AB_PROMPT_VS_GOLD.format(story_a=story_a, story_b=story_b)
     else:
         prompt_ab = EVALUATE_STORY_AB_PROMPT.format(character_profiles=character_profiles_text, story_a=story_a, story_b=story_b)
-    llm_response_ab = run_llm(user_prompt=prompt_ab, model=args.evaluator_agent_base_model, temperature=EVALUATOR_TEMP)
+    llm_response_ab = run_llm(user_prompt=prompt_ab, model=args.evaluator_agent_base_model, temperature=EVALUATOR_TEMP, tags={'agent': 'evaluator', 'phase': 'ab_test'})
     logger.debug(f"===Story AB Test Response==={llm_response_ab}")
     
     if target_data_b.get('targets') is not None:
         prompt_ba = EVALUATE_STORY_AB_PROMPT_VS_GOLD.format(story_a=story_b, story_b=story_a)
     else:
         prompt_ba = EVALUATE_STORY_AB_PROMPT.format(character_profiles=character_profiles_text, story_a=story_b, story_b=story_a)
-    llm_response_ba = run_llm(user_prompt=prompt_ba, model=args.evaluator_agent_base_model, temperature=EVALUATOR_TEMP)
+    llm_response_ba = run_llm(user_prompt=prompt_ba, model=args.evaluator_agent_base_model, temperature=EVALUATOR_TEMP, tags={'agent': 'evaluator', 'phase': 'ab_test'})
     logger.debug(f"===Story BA Test Response==={llm_response_ba}")
     
     final_result = {}
@@ -371,13 +394,27 @@ def main():
     #### args ####
     args = parse_args()
     log_evaluation_setting(logger=logger, args=args)
+    configure_llm_cache(
+        mode=args.llm_cache_mode if args.llm_cache_mode != 'None' else None,
+        path=args.llm_cache_path if args.llm_cache_path != 'None' else None)
+    logger.info(f'LLM cache mode: {get_llm_cache().mode}')
+    configure_llm_backend(
+        backend=args.llm_backend if args.llm_backend != 'None' else None,
+        trace_path=args.llm_trace_path if args.llm_trace_path != 'None' else None,
+        replay_order=args.llm_replay_order if args.llm_replay_order != 'None' else None,
+        replay_latency=True if args.llm_replay_latency else None)
+    logger.info(f'LLM backend: {get_llm_trace().backend}')
+    configure_llm_metrics(
+        path=args.llm_metrics_path if args.llm_metrics_path != 'None' else None,
+        prometheus_port=args.llm_prometheus_port if args.llm_prometheus_port else None)
+    logger.info(f'LLM metrics: {get_llm_metrics().path}')
     
     #### load ####
-    target_data_list = read_json(args.data_file)
+    target_data_list = load_dataset(args.data_file)
     
     loaded_eval_list = []
     if args.load_file != 'None':
-        loaded_eval_list = read_json(args.load_file)
+        loaded_eval_list = load_dataset(args.load_file)
     else:
         try:
             temp_load_file_name = args.data_file.replace('generation', 'evaluation').replce('gen_', 'eval_')
@@ -385,29 +422,44 @@ def main():
         except:
             logger.info('Could not find any files to load. Evaluate without Load File.')
     
+    if args.evaluate_story_quality_ab:
+        if 'gen' in args.data_file_b:
+            target_data_b_list = load_dataset(args.data_file_b)
+            generation_mode = 'gen'
+            if 'hollmwood' in args.data_file_b:
+                generation_mode += '_hollmwood'
+            else:
+                if 'nointervention' in args.data_file_b:
+                    generation_mode += '_nointervention'
+                if 'nodescription' in args.data_file_b:
+                    generation_mode += '_nodescription'
+                if 'plan' in args.data_file_b:
+                    generation_mode += '_plan'
+                if 'actseq' in args.data_file_b:
+                    generation_mode += '_actseq'
+        else:
+            target_data_b_list = read_jsonl(args.data_file_b)
+            generation_mode = 'gold'
+        if isinstance(target_data_b_list, list):
+            target_data_b_list = {target_data_b['example_id']: target_data_b for target_data_b in target_data_b_list}
+    
     #### evaluate ####
-    out_eval_json_list = []
-    for target_data in target_data_list:
-        example_id = target_data['example_id']
-        loaded_data = {}
-        for loaded_eval in loaded_eval_list:
-            if loaded_eval['example_id'] == example_id:
-                out_eval_json_list.append(loaded_eval)
-                break
+    loaded_eval_index = {loaded_eval['example_id']: loaded_eval for loaded_eval in loaded_eval_list}
+    out_eval_json_list = [loaded_eval_index[example_id] for example_id in dataset_example_ids(target_data_list) if example_id in loaded_eval_index]
+    if args.output_backend == 'sharded':
+        out_eval_json_list = ShardedStore(evaluation_save_path(args)[:-len('.json')] + '.shards', out_dataset=out_eval_json_list)
+    loaded_data = {}
     
     for target_data in tqdm(target_data_list):
         example_id = target_data['example_id']
+        set_llm_call_tags(example_id=example_id)
         if args.evaluate_draft:
             version_key = 'draft'
         else:
             version_key = 'edit'
         
         ## Load
-        eval_json = {}
-        for out_eval_json in out_eval_json_list:
-            if out_eval_json['example_id'] == example_id:
-                eval_json = out_eval_json
-                break
+        eval_json = find_example(out_eval_json_list, example_id) or {}
         
         ## Load data not exist. Create new one.
         if eval_json == {}:
@@ -436,29 +488,7 @@ def main():
             
         if args.evaluate_story_quality_ab:
             
-            if 'gen' in args.data_file_b:
-                target_data_b_list = read_json(args.data_file_b)
-                generation_mode = 'gen'
-                if 'hollmwood' in args.data_file_b:
-                    generation_mode += '_hollmwood'
-                else:
-                    if 'nointervention' in args.data_file_b:
-                        generation_mode += '_nointervention'
-                    if 'nodescription' in args.data_file_b:
-                        generation_mode += '_nodescription'
-                    if 'plan' in args.data_file_b:
-                        generation_mode += '_plan'
-                    if 'actseq' in args.data_file_b:
-                        generation_mode += '_actseq'
-            else:
-                target_data_b_list = read_jsonl(args.data_file_b)
-                generation_mode = 'gold'
-                
-            target_data_b = None
-            for target_data_b_candidate in target_data_b_list:
-                if target_data_b_candidate['example_id'] == example_id:
-                    target_data_b = target_data_b_candidate
-                    break
+            target_data_b = find_example(target_data_b_list, example_id)
 
             if loaded_data.get(version_key, {}).get('story_quality_ab', {}).get(f'vs_{generation_mode}') is None or 'gold' in generation_mode:
                 logger.debug(f"==={eval_json['example_id']}... Evaluating Story Quality AB Test... B: {generation_mode}===")
@@ -471,20 +501,24 @@ def main():
         _ = save_evaluation_result(eval_json, out_eval_json_list, logger, args)
         
     eval_save_path = save_evaluation_result(eval_json, out_eval_json_list, logger, args)
+    if isinstance(out_eval_json_list, ShardedStore):
+        out_eval_json_list.close()
+        ## Statistics and downstream tools read the monolithic eval_*.json
+        out_eval_json_list.export(eval_save_path)
+    logger.info(f'LLM cache stats: {get_llm_cache_stats()}')
+    logger.info(f'LLM trace stats: {get_llm_trace_stats()}')
+    logger.info(f'LLM usage by agent/phase:\n{get_llm_metrics().format_summary()}')
     
     #### stat ####
     from score_stat import stat_from_eval, save_stat_result, summarize_stat
-    generated_json_list = read_json(args.data_file)
+    generated_json_list = load_dataset(args.data_file)
     evaluated_json_list = read_json(eval_save_path)
     
     stat_json_list = []
     for target_eval_json in tqdm(evaluated_json_list):
         target_example_id = target_eval_json['example_id']
         
-        target_gen_json = None
-        for gen_json in generated_json_list:
-            if gen_json['example_id'] == target_example_id:
-                target_gen_json = gen_json
+        target_gen_json = find_example(generated_json_list, target_example_id)
                 
         if target_gen_json is None:
             logger.error(f"{target_example_id} data not found in the gen data")
@@ -56,6 +56,20 @@ def estimate_character_reaction_count(text):
             character_reaction_cnt += 1
     return character_reaction_cnt
 
+def count_character_reaction(turn_parent, text):
+    """ Count reaction events of the turns under turn_parent.
+    Data generated without turn events falls back to estimate_character_reaction_count(text).
+    """
+    turn_events = []
+    turn_storytelling = 1
+    while turn_parent.get(f'turn_{turn_storytelling}', {}).get('story_progress') is not None:
+        turn_events.append(turn_parent[f'turn_{turn_storytelling}'].get('event'))
+        turn_storytelling += 1
+    
+    if turn_events == [] or None in turn_events:
+        return estimate_character_reaction_count(text)
+    return sum(1 for turn_event in turn_events if turn_event['kind'] == 'reaction')
+
 def append_story_ab_result(llm_response_ab, llm_response_ba, logger, is_vs_gold=False):
     def extract_story_ab_result(llm_response, logger, is_vs_gold=False):
         
@@ -173,7 +187,7 @@ def stat_from_eval(gen_data, eval_data, logger, args):
             stat_result[f'part_{part_storytelling}']['word_cnt'] = estimate_word_count(story_segment)
             stat_result[f'part_{part_storytelling}']['token_cnt'] = estimate_token_count(story_segment)
             stat_result[f'part_{part_storytelling}']['turn_cnt'] = estimate_turn_count(story_segment)
-            stat_result[f'part_{part_storytelling}']['character_reaction_cnt'] = estimate_character_reaction_count(story_segment)
+            stat_result[f'part_{part_storytelling}']['character_reaction_cnt'] = count_character_reaction(gen_data['narrative'][f'part_{part_storytelling}'], story_segment)
             turn_story_telling = 1
             while gen_data['narrative'][f'part_{part_storytelling}'].get(f'turn_{turn_story_telling}') is not None:
                 if gen_data['narrative'][f'part_{part_storytelling}'][f'turn_{turn_story_telling}'].get('direct_response_pass') is not None:
@@ -188,7 +202,7 @@ def stat_from_eval(gen_data, eval_data, logger, args):
                 stat_result[f'part_{part_storytelling}'][f'act_{act_storytelling}']['word_cnt'] = estimate_word_count(story_segment)
                 stat_result[f'part_{part_storytelling}'][f'act_{act_storytelling}']['token_cnt'] = estimate_token_count(story_segment)
                 stat_result[f'part_{part_storytelling}'][f'act_{act_storytelling}']['turn_cnt'] = estimate_turn_count(story_segment)
-                stat_result[f'part_{part_storytelling}'][f'act_{act_storytelling}']['character_reaction_cnt'] = estimate_character_reaction_count(story_segment)
+                stat_result[f'part_{part_storytelling}'][f'act_{act_storytelling}']['character_reaction_cnt'] = count_character_reaction(gen_data['narrative'][f'part_{part_storytelling}'][f'act_{act_storytelling}'], story_segment)
                 turn_story_telling = 1
                 while gen_data['narrative'][f'part_{part_storytelling}'][f'act_{act_storytelling}'].get(f'turn_{turn_story_telling}') is not None:
                     if gen_data['narrative'][f'part_{part_storytelling}'][f'act_{act_storytelling}'][f'turn_{turn_story_telling}'].get('direct_response_pass') is not None:
@@ -205,7 +219,7 @@ def stat_from_eval(gen_data, eval_data, logger, args):
         stat_result['word_cnt'] = estimate_word_count(story)
         stat_result['token_cnt'] = estimate_token_count(story)
         stat_result['turn_cnt'] = estimate_turn_count(story)
-        stat_result['character_reaction_cnt'] = estimate_character_reaction_count(story)
+        stat_result['character_reaction_cnt'] = count_character_reaction(gen_data['narrative'], story)
         turn_story_telling = 1
         while gen_data['narrative'].get(f'turn_{turn_story_telling}') is not None:
             if gen_data['narrative'][f'turn_{turn_story_telling}'].get('direct_response_pass') is not None:
@@ -567,18 +581,15 @@ def main():
     log_stat_setting(logger=logger, args=args)
     
     #### load ####
-    generated_json_list = read_json(args.data_file)
-    evaluated_json_list = read_json(args.eval_data_file)
+    generated_json_list = load_dataset(args.data_file)
+    evaluated_json_list = load_dataset(args.eval_data_file)
     
     #### stat ####
     stat_json_list = []
     for target_eval_json in tqdm(evaluated_json_list):
         target_example_id = target_eval_json['example_id']
         
-        target_gen_json = None
-        for gen_json in generated_json_list:
-            if gen_json['example_id'] == target_example_id:
-                target_gen_json = gen_json
+        target_gen_json = find_example(generated_json_list, target_example_id)
                 
         if target_gen_json is None:
             logger.error(f"{target_example_id} data not found in the gen data")
@@ -0,0 +1,9 @@
+#!/bin/bash
+source scripts/env.sh
+
+## Serial vs --parallel-chunk-edit: wall time, editor calls, and Story Quality AB Test (A: serial, B: parallel)
+python benchmark_chunk_edit.py --out-dir ./outputs/benchmark \
+    --data-file $GEN_DIR/gen_d_gemini-2.0-flash_c_gemini-2.0-flash.json \
+    --editor-agent-base-model gemini-2.0-flash \
+    --evaluator-agent-base-model gpt-4o-2024-11-20 \
+    --max-examples 10
@@ -12,4 +12,24 @@ STAT_DIR=./outputs/evaluation_stat
 ## API keys
 export OPENAI_API_KEY='Your API Key'
 export DEEPSEEK_API_KEY='Your API Key'
-export GOOGLE_API_KEY='Your API Key'
\ No newline at end of file
+export GOOGLE_API_KEY='Your API Key'
+
+## LLM response cache (readwrite / readonly / bypass)
+export LLM_CACHE_MODE=bypass
+export LLM_CACHE_PATH=./cache/llm_cache.sqlite
+## LLM backend (live / record / replay). record/replay use a JSONL trace of every call
+export LLM_BACKEND=live
+export LLM_TRACE_PATH=./cache/llm_trace.jsonl
+## RPM/TPM budgets per model card or provider (JSON, empty = no client-side limit)
+## e.g. '{"gemini-2.0-flash": {"rpm": 2000, "tpm": 4000000}, "gpt-4o-2024-11-20": {"rpm": 500, "tpm": 30000}}'
+export LLM_RATE_LIMITS='{}'
+
+## Retry policy and circuit breaker of LLM calls
+export LLM_MAX_ATTEMPTS=6
+export LLM_BACKOFF_MAX=60
+export LLM_CIRCUIT_FAILURE_THRESHOLD=5
+export LLM_CIRCUIT_RESET_SECONDS=60
+
+## Per-call LLM telemetry (JSONL) and optional Prometheus exporter port (0: disabled)
+export LLM_METRICS_PATH=$LOG_DIR/llm_metrics.jsonl
+export LLM_PROMETHEUS_PORT=0
@@ -0,0 +1,6 @@
+#!/bin/bash
+source scripts/env.sh
+
+## Export a sharded output store (--output-backend sharded) to the monolithic gen_*.json
+python export_store.py \
+    --shard-dir $GEN_DIR/gen_d_gemini-2.0-flash_c_gemini-2.0-flash.shards